@@ -0,0 +1,84 @@
+import logging
+import os
+import psutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+FNAME=os.path.basename(__file__)
+PID=os.getpid()
+HOST=socket.gethostname()
+
+# set up logging
+log_filename='autoscaler_{}.log'.format(os.getpid())
+log_format = '%(levelname)s %(asctime)s {pid} {filename} %(lineno)d %(message)s'.format(
+        pid=PID, filename=FNAME)
+logging.basicConfig(format=log_format,
+    filename='/var/log/systemmonitorlogs/{}'.format(log_filename),
+    datefmt='%Y-%m-%dT%H:%M:%S%z',
+    level=logging.INFO)
+logger = logging.getLogger('autoscaler')
+
+# Usage: python autoscaler.py <worker command ...>
+#
+# Keeps between AUTOSCALE_MIN and AUTOSCALE_MAX copies of a worker (reducer,
+# sentencer) running, from the same psutil readings system_monitor.py logs:
+# another worker is started while the cpu is idle enough and there's room in
+# memory for one more (going by how much the running ones use), the newest is
+# stopped when the box runs out of either. Its unacked messages are redelivered
+# to the others.
+AUTOSCALE_CPU_LOW = float(os.environ.get('AUTOSCALE_CPU_LOW', 60)) # %, add one below
+AUTOSCALE_CPU_HIGH = float(os.environ.get('AUTOSCALE_CPU_HIGH', 95)) # %, drop one above
+AUTOSCALE_INTERVAL = int(os.environ.get('AUTOSCALE_INTERVAL', 60)) # s between changes
+AUTOSCALE_MAX = int(os.environ.get('AUTOSCALE_MAX', psutil.cpu_count()))
+AUTOSCALE_MEM_HIGH = float(os.environ.get('AUTOSCALE_MEM_HIGH', 90)) # %, drop one above
+AUTOSCALE_MIN = int(os.environ.get('AUTOSCALE_MIN', 1))
+
+
+def worker_memory(workers):
+    """Average resident memory of the workers and their children, bytes"""
+    sizes = []
+    for worker in workers:
+        try:
+            process = psutil.Process(worker.pid)
+            sizes.append(sum(p.memory_info().rss for p in
+                [process] + process.children(recursive=True)))
+        except psutil.NoSuchProcess:
+            pass
+    return sum(sizes) / len(sizes) if sizes else 0
+
+def scale(workers, command):
+    """Start or stop at most one worker, returns the change"""
+    cpu = psutil.cpu_percent(interval=5)
+    memory = psutil.virtual_memory()
+    if len(workers) > AUTOSCALE_MIN and (cpu > AUTOSCALE_CPU_HIGH or
+            memory.percent > AUTOSCALE_MEM_HIGH):
+        worker = workers.pop()
+        worker.send_signal(signal.SIGTERM)
+        worker.wait()
+        logger.info('stopped a worker, cpu {}% memory {}%, {} left'.format(
+            cpu, memory.percent, len(workers)))
+        return -1
+    if len(workers) < AUTOSCALE_MAX and cpu < AUTOSCALE_CPU_LOW and \
+            memory.available > 1.5 * worker_memory(workers):
+        workers.append(subprocess.Popen(command))
+        logger.info('started a worker, cpu {}% memory {}%, {} running'.format(
+            cpu, memory.percent, len(workers)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    command = sys.argv[1:]
+    workers = [subprocess.Popen(command) for i in range(AUTOSCALE_MIN)]
+    while True:
+        time.sleep(AUTOSCALE_INTERVAL)
+        # replace workers that died, then see if we should have more or fewer
+        for worker in [w for w in workers if w.poll() is not None]:
+            logger.info('worker {} exited with {}'.format(worker.pid, worker.returncode))
+            workers.remove(worker)
+        while len(workers) < AUTOSCALE_MIN:
+            workers.append(subprocess.Popen(command))
+        scale(workers, command)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Postgres and RabbitMQ connections that survive the ssh tunnels dropping.
+
+Database stands in for a psycopg2 connection (cursor, commit, rollback, close)
+and reconnects, backing off, when the one it has is broken. A connection that
+sat idle is pinged before it's handed out, every session gets a statement
+timeout. Session state (advisory locks, temp tables) goes with a connection,
+on_reconnect gets to restore it. run(work) runs a whole transaction and
+commits it, if the connection breaks (or the statement times out, or
+deadlocks) it rolls back and runs all of work again, backing off. Each
+process is single threaded (the sentencer's pool forks before connecting), so
+the pool is one connection deep.
+
+Rabbit holds a pika BlockingConnection and channel. run(work) calls
+work(connection, channel) and, if the connection drops, reconnects with
+exponential backoff, calls setup(connection, channel) again to re-declare
+queues, QoS and consumers, then retries work. Messages that weren't acked are redelivered by
+RabbitMQ, so on_reconnect should forget any it was holding. A host of
+local:<port> is a LocalBroker rather than RabbitMQ, see local_broker.py.
+"""
+from local_broker import LOCAL_PREFIX, local_address, LocalConnection
+from time import sleep, time
+import logging
+import os
+import pika
+import psycopg2
+
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 120000)) # ms
+DB_HEALTH_CHECK_AFTER = int(os.environ.get('DB_HEALTH_CHECK_AFTER', 30)) # idle s
+MAX_BACKOFF = int(os.environ.get('CONNECTION_MAX_BACKOFF', 60))
+DB_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+RABBIT_ERRORS = (pika.exceptions.AMQPConnectionError,
+        pika.exceptions.AMQPChannelError)
+
+logger = logging.getLogger('connections')
+
+
+def backoff_delays():
+    """1, 2, 4, ... seconds, up to MAX_BACKOFF"""
+    delay = 1
+    while True:
+        yield delay
+        delay = min(delay * 2, MAX_BACKOFF)
+
+
+class Database():
+    """A psycopg2 connection that reconnects, use it like one"""
+    def __init__(self, dbname, user, password, host='localhost',
+            on_reconnect=None):
+        self.on_reconnect = on_reconnect
+        self.params = dict(dbname=dbname, user=user, password=password,
+                host=host, connect_timeout=10, keepalives=1, keepalives_idle=30,
+                options='-c statement_timeout={}'.format(DB_STATEMENT_TIMEOUT))
+        self.conn = None
+        self.last_used = 0
+        self.connection()
+
+    def connection(self):
+        """The current connection, (re)connected and checked if need be"""
+        if self.conn is not None and not self.conn.closed and \
+                time() - self.last_used > DB_HEALTH_CHECK_AFTER:
+            self._check()
+        if self.conn is None or self.conn.closed:
+            reconnecting = self.conn is not None
+            self.conn = self._connect()
+            self.last_used = time()
+            if reconnecting and self.on_reconnect is not None:
+                self.on_reconnect()
+        self.last_used = time()
+        return self.conn
+
+    def cursor(self, *args, **kwargs):
+        return self.connection().cursor(*args, **kwargs)
+
+    def commit(self):
+        self.connection().commit()
+
+    def rollback(self):
+        """Roll back, or drop the connection if it's broken (that rolls the
+        transaction back too)"""
+        if self.conn is None or self.conn.closed:
+            return
+        try:
+            self.conn.rollback()
+        except DB_ERRORS as e:
+            logger.warning('dropping broken database connection - {}'.format(e))
+            self._drop()
+
+    def run(self, work):
+        """Return work() once it's committed, running it again on a fresh
+        transaction for as long as that fails. work must be the whole
+        transaction, what was pending before it is rolled back with it"""
+        for delay in backoff_delays():
+            try:
+                result = work()
+                self.commit()
+                return result
+            except DB_ERRORS as e:
+                logger.warning('database transaction failed, retrying in {}s - {}'
+                        .format(delay, e))
+                self.rollback()
+                sleep(delay)
+
+    def close(self):
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+
+    def _check(self):
+        """Ping an idle connection, drop it if it doesn't answer"""
+        try:
+            cur = self.conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            self.conn.rollback()
+        except DB_ERRORS as e:
+            logger.warning('database connection failed health check - {}'.format(e))
+            self._drop()
+
+    def _drop(self):
+        """Close the connection, the next use reconnects"""
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _connect(self):
+        for delay in backoff_delays():
+            try:
+                return psycopg2.connect(**self.params)
+            except psycopg2.OperationalError as e:
+                logger.warning('cannot connect to database, retrying in {}s - {}'
+                        .format(delay, e))
+                sleep(delay)
+
+
+class Rabbit():
+    """A pika connection and channel that reconnect, see run()"""
+    def __init__(self, host, setup=None, on_reconnect=None):
+        self.host = host
+        self.setup = setup
+        self.on_reconnect = on_reconnect
+        self.connection = None
+        self.channel = None
+        self.connect()
+
+    def connect(self):
+        for delay in backoff_delays():
+            try:
+                if self.host.startswith(LOCAL_PREFIX):
+                    self.connection = LocalConnection(local_address(self.host))
+                else:
+                    self.connection = pika.BlockingConnection(
+                            pika.ConnectionParameters(self.host))
+                self.channel = self.connection.channel()
+                if self.setup is not None:
+                    self.setup(self.connection, self.channel)
+                return
+            except RABBIT_ERRORS as e:
+                logger.warning('cannot connect to rabbitmq, retrying in {}s - {}'
+                        .format(delay, e))
+                self.close()
+                sleep(delay)
+
+    def run(self, work):
+        """Return work(connection, channel), reconnecting and retrying it for
+        as long as the connection drops"""
+        while True:
+            try:
+                return work(self.connection, self.channel)
+            except RABBIT_ERRORS as e:
+                logger.warning('lost rabbitmq connection, reconnecting - {}'.format(e))
+                self.close()
+                if self.on_reconnect is not None:
+                    self.on_reconnect()
+                self.connect()
+
+    def close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except RABBIT_ERRORS:
+            pass
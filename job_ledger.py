@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Job progress ledger and leader election, shared by publishers, workers and
+writers through the database.
+
+A job moves through stages (pre-sentences => sentences, pre-reductions =>
+reductions). Whoever publishes a message to a stage's queue records it as
+published, whoever is done with it records it as committed. A worker records
+what it published downstream and its own message as committed in one
+transaction, and only then acks the message, so once the first stage has
+finished publishing and committed catches up with published in every stage,
+the job is done.
+
+Leaders (there's one publisher and one writer per job) hold a session level
+advisory lock, it is released when their connection closes, even if they die.
+Publishers publish in key order and checkpoint the last key they published,
+a restarted publisher resumes after it. Delivery is at least once (a batch
+published but not checkpointed is published again, a message is acked only
+after it's counted), so every count is kept once per key: publishers count a
+batch with its checkpoint, workers count a message under its key in
+job_progress_keys (see commit_message), writers count only the rows they
+didn't already have. A stage is complete once committed == published. The
+keys are dropped once the job's stages are (see forget_keys).
+
+The ledger's own transactions go through Database.run (see connections.py),
+a dropped connection or a statement that timed out is retried rather than
+taking the worker down. record(commit=False) is part of the caller's
+transaction, the caller retries that.
+
+Usage: python job_ledger.py <stage> [<stage> ...]
+    waits until the stages of JOB_ID are complete
+"""
+from connections import Database
+from time import sleep
+import os
+import sys
+
+
+class JobLedger():
+    def __init__(self, conn, job_id):
+        self.conn = conn # a Database, see connections.py
+        self.job_id = job_id
+
+    def create_table(self):
+        def create():
+            cur = self.conn.cursor()
+            # serialize, concurrent CREATE TABLE IF NOT EXISTS can still collide
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('job_progress'))")
+            cur.execute("""CREATE TABLE IF NOT EXISTS job_progress (
+                            job_id integer NOT NULL,
+                            stage text NOT NULL,
+                            published bigint NOT NULL DEFAULT 0,
+                            committed bigint NOT NULL DEFAULT 0,
+                            publishing_done boolean NOT NULL DEFAULT false,
+                            PRIMARY KEY (job_id, stage)
+                        )""")
+            cur.execute("""CREATE TABLE IF NOT EXISTS job_progress_keys (
+                            job_id integer NOT NULL,
+                            stage text NOT NULL,
+                            key bigint NOT NULL,
+                            PRIMARY KEY (job_id, stage, key)
+                        )""")
+            cur.execute("""CREATE TABLE IF NOT EXISTS publish_checkpoints (
+                            job_id integer NOT NULL,
+                            publisher text NOT NULL,
+                            last_key bigint NOT NULL,
+                            PRIMARY KEY (job_id, publisher)
+                        )""")
+            cur.close()
+        self.conn.run(create)
+
+    def try_lead(self, role):
+        """True if this process is (now) the job's only <role>"""
+        def lead():
+            cur = self.conn.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))",
+                    ('{}:{}'.format(role, self.job_id),))
+            leading = cur.fetchone()[0]
+            cur.close()
+            return leading
+        return self.conn.run(lead)
+
+    def _add(self, stage, published=0, committed=0):
+        if not (published or committed):
+            return
+        cur = self.conn.cursor()
+        cur.execute("""INSERT INTO job_progress (job_id, stage, published, committed)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (job_id, stage) DO UPDATE SET
+                        published=job_progress.published + EXCLUDED.published,
+                        committed=job_progress.committed + EXCLUDED.committed
+                    """, (self.job_id, stage, published, committed))
+        cur.close()
+
+    def record(self, stage, published=0, committed=0, commit=True):
+        """Add to the stage's counts. Writers pass commit=False and commit with
+        the rows they wrote, so the counts are exactly what is in the table"""
+        if not commit:
+            return self._add(stage, published, committed)
+        self.conn.run(lambda: self._add(stage, published, committed))
+
+    def commit_message(self, stage, key, published=None, also=None):
+        """Count a message of stage as committed, with what was published
+        downstream for it ({stage: count}), in one transaction. A message
+        that was already counted under its key (redelivered after it was)
+        isn't counted again, returns False. Unkeyed messages always count.
+        also() is run first in the same transaction, for the worker's own
+        writes, and again with it on a retry"""
+        def count():
+            if also is not None:
+                also()
+            if key is not None:
+                cur = self.conn.cursor()
+                cur.execute("""INSERT INTO job_progress_keys (job_id, stage, key)
+                                VALUES (%s, %s, %s)
+                                ON CONFLICT (job_id, stage, key) DO NOTHING
+                            """, (self.job_id, stage, key))
+                seen = cur.rowcount == 0
+                cur.close()
+                if seen:
+                    return False
+            for downstream, n in (published or {}).items():
+                self._add(downstream, published=n)
+            self._add(stage, committed=1)
+            return True
+        return self.conn.run(count)
+
+    def forget_keys(self, stages):
+        """Drop the stages' message keys, once they're complete no message
+        of theirs is counted again"""
+        def forget():
+            cur = self.conn.cursor()
+            cur.execute("""DELETE FROM job_progress_keys
+                            WHERE job_id=%s AND stage IN %s
+                        """, (self.job_id, tuple(stages)))
+            cur.close()
+        self.conn.run(forget)
+
+    def finish_publishing(self, stage):
+        """Mark that nothing more will be published to the (first) stage"""
+        def finish():
+            cur = self.conn.cursor()
+            cur.execute("""INSERT INTO job_progress (job_id, stage, publishing_done)
+                            VALUES (%s, %s, true)
+                            ON CONFLICT (job_id, stage) DO UPDATE SET
+                            publishing_done=true
+                        """, (self.job_id, stage))
+            cur.close()
+        self.conn.run(finish)
+
+    def checkpoint(self, publisher):
+        """The last key publisher published for the job, 0 if it hasn't yet"""
+        def read():
+            cur = self.conn.cursor()
+            cur.execute("""SELECT last_key FROM publish_checkpoints
+                            WHERE job_id=%s AND publisher=%s
+                        """, (self.job_id, publisher))
+            row = cur.fetchone()
+            cur.close()
+            return row[0] if row else 0
+        return self.conn.run(read)
+
+    def save_checkpoint(self, publisher, last_key, published=None):
+        """Checkpoint a published batch with its counts ({stage: count}), a
+        batch is either both or neither"""
+        def save():
+            for stage, n in (published or {}).items():
+                self._add(stage, published=n)
+            cur = self.conn.cursor()
+            cur.execute("""INSERT INTO publish_checkpoints (job_id, publisher, last_key)
+                            VALUES (%s, %s, %s)
+                            ON CONFLICT (job_id, publisher) DO UPDATE SET
+                            last_key=EXCLUDED.last_key
+                        """, (self.job_id, publisher, last_key))
+            cur.close()
+        self.conn.run(save)
+
+    def is_complete(self, stages):
+        """True once the first stage is done publishing and every stage has
+        committed what was published to it"""
+        def read():
+            cur = self.conn.cursor()
+            cur.execute("""SELECT stage, published, committed, publishing_done
+                            FROM job_progress WHERE job_id=%s AND stage IN %s
+                        """, (self.job_id, tuple(stages)))
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+        progress = {row[0]: row[1:] for row in self.conn.run(read)}
+        if stages[0] not in progress or not progress[stages[0]][2]:
+            return False
+        return all(progress.get(stage, (0, 0))[1] == progress.get(stage, (0, 0))[0]
+                for stage in stages)
+
+    def wait(self, stages, interval=5):
+        while not self.is_complete(stages):
+            sleep(interval)
+
+
+if __name__ == '__main__':
+    DB_NAME = os.environ.get('DB_NAME', 'nlp')
+    conn = Database(DB_NAME, os.environ.get('DB_USER', DB_NAME),
+            os.environ.get('DB_PASS', ''))
+    ledger = JobLedger(conn, os.environ['JOB_ID'])
+    ledger.create_table()
+    ledger.wait(sys.argv[1:])
+    conn.close()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A stand-in for RabbitMQ, for running the whole pipeline on one machine.
+
+LocalBroker keeps its queues in memory and serves them on a local socket, so
+publishers, workers and writers still run as separate processes.
+connections.Rabbit talks to it instead of RabbitMQ when RABBITMQ_LOCATION is
+local:<port>. It covers the parts of AMQP the pipeline uses:
+
+- the default exchange and queue_declare (passive, x-max-length);
+- basic_qos, per consumer or global;
+- basic_consume, basic_publish and basic_ack (multiple);
+- consume(inactivity_timeout) and add_timeout.
+
+When a client disconnects, the messages it hadn't acked go back to the front
+of their queues, marked redelivered. Nothing is persisted.
+
+pipeline.py runs one and reports on its queues.
+"""
+from collections import deque, OrderedDict
+from heapq import heappop, heappush
+from itertools import count
+from multiprocessing.connection import Client, Listener
+from time import sleep, time
+from types import SimpleNamespace
+import logging
+import pika
+import threading
+
+AUTHKEY = b'nlp-sva-job'
+LOCAL_PREFIX = 'local:'
+DELIVERIES_MAX = 1000 # a client fetches at most this many messages at once
+ONE_WAY = {'publish', 'ack', 'qos'} # requests the client doesn't wait on
+
+logger = logging.getLogger('local_broker')
+
+
+def local_address(location):
+    """local:<port> => (host, port)"""
+    return ('localhost', int(location[len(LOCAL_PREFIX):]))
+
+
+class BrokerError(Exception):
+    pass
+
+
+class LocalQueue():
+    def __init__(self, name, max_length=None):
+        self.name = name
+        self.max_length = max_length
+        self.messages = deque() # (properties, body, redelivered)
+        self.unacked = 0
+        self.consumers = 0
+        self.published = 0
+        self.acked = 0
+        self.dropped = 0
+
+
+class LocalBroker():
+    """Queues and the clients consuming them, start() serves them"""
+    def __init__(self, port=0):
+        self.listener = Listener(('localhost', port), authkey=AUTHKEY)
+        self.port = self.listener.address[1]
+        self.queues = {}
+        self.changed = threading.Condition()
+        self.channel_ids = count(1)
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def stats(self):
+        """{queue: (ready, unacked, consumers, published, acked, dropped)}"""
+        with self.changed:
+            return {q.name: (len(q.messages), q.unacked, q.consumers,
+                q.published, q.acked, q.dropped) for q in self.queues.values()}
+
+    def _accept(self):
+        while True:
+            client = self.listener.accept()
+            threading.Thread(target=self._serve, args=(client,),
+                    daemon=True).start()
+
+    def _serve(self, client):
+        channels = {}
+        try:
+            while True:
+                op, *args = client.recv()
+                try:
+                    with self.changed:
+                        result = getattr(self, '_' + op)(channels, *args)
+                except BrokerError as e:
+                    if op in ONE_WAY:
+                        logger.warning('{} failed - {}'.format(op, e))
+                    else:
+                        client.send(('error', str(e)))
+                    continue
+                if op not in ONE_WAY:
+                    client.send(('ok', result))
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.changed:
+                for channel in channels.values():
+                    self._close_channel(channel)
+                self.changed.notify_all()
+            client.close()
+
+    def _close_channel(self, channel):
+        """Requeue what the channel hadn't acked, in order, and drop its consumers"""
+        for consumer, queue, properties, body in reversed(channel.unacked.values()):
+            queue.messages.appendleft((properties, body, True))
+            queue.unacked -= 1
+        channel.unacked.clear()
+        for consumer in channel.consumers.values():
+            self.queues[consumer.queue].consumers -= 1
+        channel.consumers.clear()
+
+    # requests, called holding self.changed
+
+    def _channel(self, channels):
+        id = next(self.channel_ids)
+        channels[id] = SimpleNamespace(prefetch=0, consumer_prefetch=0,
+                consumers=OrderedDict(), unacked=OrderedDict(), tags=count(1))
+        return id
+
+    def _declare(self, channels, channel_id, queue, passive, arguments):
+        if queue not in self.queues:
+            if passive:
+                raise BrokerError('NOT_FOUND - no queue {}'.format(queue))
+            self.queues[queue] = LocalQueue(queue,
+                    (arguments or {}).get('x-max-length'))
+        q = self.queues[queue]
+        return len(q.messages), q.consumers
+
+    def _qos(self, channels, channel_id, prefetch, all_channels):
+        channel = channels[channel_id]
+        if all_channels:
+            channel.prefetch = prefetch
+        else:
+            channel.consumer_prefetch = prefetch
+        self.changed.notify_all()
+
+    def _consume(self, channels, channel_id, queue, tag, no_ack):
+        if queue not in self.queues:
+            raise BrokerError('NOT_FOUND - no queue {}'.format(queue))
+        channel = channels[channel_id]
+        channel.consumers[tag] = SimpleNamespace(tag=tag, queue=queue,
+                no_ack=no_ack, prefetch=channel.consumer_prefetch, unacked=0)
+        self.queues[queue].consumers += 1
+        return tag
+
+    def _publish(self, channels, channel_id, routing_key, properties, body):
+        q = self.queues.get(routing_key)
+        if q is None:
+            return # unroutable, the default exchange drops it
+        q.messages.append((properties, body, False))
+        q.published += 1
+        while q.max_length is not None and len(q.messages) > q.max_length:
+            q.messages.popleft()
+            q.dropped += 1
+        self.changed.notify_all()
+
+    def _ack(self, channels, channel_id, delivery_tag, multiple):
+        channel = channels[channel_id]
+        if multiple:
+            tags = [t for t in channel.unacked if t <= delivery_tag]
+        elif delivery_tag in channel.unacked:
+            tags = [delivery_tag]
+        else:
+            raise BrokerError('PRECONDITION_FAILED - unknown delivery tag {}'
+                    .format(delivery_tag))
+        for tag in tags:
+            consumer, queue, properties, body = channel.unacked.pop(tag)
+            consumer.unacked -= 1
+            queue.unacked -= 1
+            queue.acked += 1
+        self.changed.notify_all()
+
+    def _get(self, channels, channel_id, timeout):
+        """Deliveries for the channel's consumers, waiting up to timeout for
+        the first"""
+        deadline = None if timeout is None else time() + timeout
+        deliveries = self._deliveries(channels[channel_id])
+        while not deliveries:
+            remaining = None if deadline is None else deadline - time()
+            if remaining is not None and remaining <= 0:
+                break
+            self.changed.wait(remaining)
+            deliveries = self._deliveries(channels[channel_id])
+        return deliveries
+
+    def _deliveries(self, channel):
+        """Hand out messages a consumer at a time, within prefetch limits"""
+        deliveries = []
+        progress = True
+        while progress and len(deliveries) < DELIVERIES_MAX:
+            progress = False
+            for consumer in channel.consumers.values():
+                if channel.prefetch and len(channel.unacked) >= channel.prefetch:
+                    return deliveries
+                if consumer.prefetch and consumer.unacked >= consumer.prefetch:
+                    continue
+                queue = self.queues[consumer.queue]
+                if not queue.messages:
+                    continue
+                properties, body, redelivered = queue.messages.popleft()
+                tag = next(channel.tags)
+                if consumer.no_ack:
+                    queue.acked += 1
+                else:
+                    channel.unacked[tag] = (consumer, queue, properties, body)
+                    consumer.unacked += 1
+                    queue.unacked += 1
+                deliveries.append((consumer.tag, tag, queue.name, redelivered,
+                    properties, body))
+                progress = True
+        return deliveries
+
+
+class LocalConnection():
+    """What connections.Rabbit uses of a pika BlockingConnection, against a
+    LocalBroker"""
+    def __init__(self, address):
+        try:
+            self.client = Client(address, authkey=AUTHKEY)
+        except OSError as e:
+            raise pika.exceptions.AMQPConnectionError(str(e))
+        self.is_open = True
+        self.channels = []
+        self.timeouts = [] # heap of (when, id, callback)
+        self.timeout_ids = count(1)
+
+    def request(self, *request):
+        """Send a request, return the broker's answer unless it's one way"""
+        if not self.is_open:
+            raise pika.exceptions.ConnectionClosed(320, 'connection closed')
+        try:
+            self.client.send(request)
+            if request[0] in ONE_WAY:
+                return None
+            status, result = self.client.recv()
+        except (EOFError, OSError) as e:
+            self.is_open = False
+            raise pika.exceptions.ConnectionClosed(320, str(e))
+        if status == 'error':
+            raise pika.exceptions.ChannelClosed(404, result)
+        return result
+
+    def channel(self):
+        channel = LocalChannel(self, self.request('channel'))
+        self.channels.append(channel)
+        return channel
+
+    def add_timeout(self, deadline, callback):
+        id = next(self.timeout_ids)
+        heappush(self.timeouts, (time() + deadline, id, callback))
+        return id
+
+    def remove_timeout(self, timeout_id):
+        self.timeouts = [t for t in self.timeouts if t[1] != timeout_id]
+        self.timeouts.sort()
+
+    def process_data_events(self, time_limit=0):
+        """Run due timeouts and deliver messages to consumers, waiting up to
+        time_limit (None is until something happens) for them"""
+        self._run_timeouts()
+        wait = time_limit
+        if self.timeouts:
+            until_timeout = max(0, self.timeouts[0][0] - time())
+            wait = until_timeout if wait is None else min(wait, until_timeout)
+        consuming = [channel for channel in self.channels if channel.consumers]
+        for channel in consuming:
+            channel.dispatch(self.request('get', channel.id, wait))
+            wait = 0
+        if not consuming and wait:
+            sleep(wait)
+        self._run_timeouts()
+
+    def sleep(self, duration):
+        end = time() + duration
+        while time() < end:
+            self.process_data_events(end - time())
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self.client.close()
+
+    def _run_timeouts(self):
+        while self.timeouts and self.timeouts[0][0] <= time():
+            heappop(self.timeouts)[2]()
+
+
+class LocalChannel():
+    """What the pipeline uses of a pika BlockingChannel"""
+    def __init__(self, connection, id):
+        self.connection = connection
+        self.id = id
+        self.consumers = {} # tag => callback, None for consume()
+        self.consumer_tags = count(1)
+        self.pending = deque() # deliveries for consume()
+        self.consuming = False
+
+    def queue_declare(self, queue, passive=False, durable=False,
+            exclusive=False, auto_delete=False, arguments=None):
+        message_count, consumer_count = self.connection.request('declare',
+                self.id, queue, passive, arguments)
+        return SimpleNamespace(method=SimpleNamespace(queue=queue,
+            message_count=message_count, consumer_count=consumer_count))
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self.connection.request('qos', self.id, prefetch_count, all_channels)
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False,
+            exclusive=False, consumer_tag=None, arguments=None):
+        tag = consumer_tag or 'ctag{}.{}'.format(self.id, next(self.consumer_tags))
+        self.connection.request('consume', self.id, queue, tag, no_ack)
+        self.consumers[tag] = consumer_callback
+        return tag
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+            mandatory=False, immediate=False):
+        if isinstance(body, str):
+            body = body.encode('utf_8')
+        self.connection.request('publish', self.id, routing_key, properties,
+                body)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.connection.request('ack', self.id, delivery_tag, multiple)
+
+    def start_consuming(self):
+        self.consuming = True
+        while self.consuming and self.consumers:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def consume(self, queue, no_ack=False, exclusive=False, arguments=None,
+            inactivity_timeout=None):
+        """Yield (method, properties, body), (None, None, None) after
+        inactivity_timeout seconds without a message"""
+        tag = 'consume.' + queue
+        if tag not in self.consumers:
+            self.connection.request('consume', self.id, queue, tag, no_ack)
+            self.consumers[tag] = None
+        while True:
+            if not self.pending:
+                self.connection.process_data_events(inactivity_timeout)
+            if self.pending:
+                yield self.pending.popleft()
+            elif inactivity_timeout is not None:
+                yield None, None, None
+
+    def dispatch(self, deliveries):
+        for consumer_tag, delivery_tag, routing_key, redelivered, properties, \
+                body in deliveries:
+            method = SimpleNamespace(consumer_tag=consumer_tag,
+                    delivery_tag=delivery_tag, redelivered=redelivered,
+                    exchange='', routing_key=routing_key)
+            callback = self.consumers.get(consumer_tag)
+            if callback is None:
+                self.pending.append((method, properties, body))
+            else:
+                callback(self, method, properties, body)
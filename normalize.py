@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Text cleanup, in one pass over the text.
+
+decode_book turns an archive member's bytes into text. normalize collapses
+runs of whitespace to a space, straightens curly quotes and apostrophes and,
+with contractions=True, unpacks contractions the way textacy's
+unpack_contractions does ("don't" => "do not", "won't" => "will not", ...,
+"I'd" and "he's" are left alone). Each is one compiled regex and one re.sub,
+rather than a pass for each rule.
+
+The sentencer normalizes books without unpacking, so sentences are stored as
+written, the reducer unpacks before parsing (see preprocess.py).
+"""
+import re
+
+# tried in order, latin-1 decodes anything
+BOOK_ENCODINGS = ('utf_8_sig', 'cp1252', 'latin_1')
+
+APOSTROPHE = "['’]"
+SINGLE_QUOTES = '‘’‚‛′'
+DOUBLE_QUOTES = '“”„‟″'
+# (group, stems, contraction, what the stem gets instead), textacy's rules
+CONTRACTIONS = (
+    ('not', 'Are|Could|Did|Does|Do|Had|Has|Have|Is|Might|Must|Should|Were|Would',
+        "n{}t", ' not'),
+    ('will', 'He|I|She|They|We|What|Who|You', '{}ll', ' will'),
+    ('are', 'They|We|What|Who|You', '{}re', ' are'),
+    ('have', 'I|Should|They|We|What|Who|Would|You', '{}ve', ' have'),
+    ('can', 'Ca', "n{}t", 'n not'),
+    ('am', 'I', '{}m', ' am'),
+    ('us', 'Let', '{}s', ' us'),
+    ('wont', 'W', "on{}t", 'ill not'),
+    ('shant', 'S', "han{}t", 'hall not'),
+    ('yall', 'Y', "(?:{0}all|a{0}ll)", 'ou all'),
+)
+
+
+def either_case(stems):
+    """'Are|Could' => '[Aa]re|[Cc]ould', like textacy"""
+    return '|'.join('[{}{}]{}'.format(stem[0], stem[0].lower(), stem[1:])
+            for stem in stems.split('|'))
+
+def compile_rules(contractions):
+    rules = [r'(?P<space>\s+)', '(?P<single>[{}])'.format(SINGLE_QUOTES),
+            '(?P<double>[{}])'.format(DOUBLE_QUOTES)]
+    if contractions:
+        rules += [r'\b(?P<{}>{}){}'.format(group, either_case(stems),
+            contraction.format(APOSTROPHE))
+            for group, stems, contraction, unpacked in CONTRACTIONS]
+    return re.compile('|'.join(rules))
+
+RULES = compile_rules(contractions=False)
+RULES_AND_CONTRACTIONS = compile_rules(contractions=True)
+REPLACEMENTS = {'space': ' ', 'single': "'", 'double': '"'}
+UNPACKED = {group: unpacked for group, stems, contraction, unpacked in CONTRACTIONS}
+
+
+def replace(match):
+    group = match.lastgroup
+    if group in REPLACEMENTS:
+        return REPLACEMENTS[group]
+    return match.group(group) + UNPACKED[group]
+
+def normalize(text, contractions=False):
+    """Whitespace, quotes and, if asked, contractions, in one pass"""
+    rules = RULES_AND_CONTRACTIONS if contractions else RULES
+    return rules.sub(replace, text).strip()
+
+def decode_book(raw):
+    """An archive member's bytes as text, Gutenberg has books in each of
+    BOOK_ENCODINGS"""
+    for encoding in BOOK_ENCODINGS:
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
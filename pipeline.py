@@ -0,0 +1,127 @@
+from local_broker import LocalBroker
+import csv
+import os
+import subprocess
+import sys
+import time
+
+# Usage: python pipeline.py [seconds]
+#
+# Runs the whole job on this machine, for measuring throughput and
+# backpressure without droplets: a LocalBroker (local_broker.py)
+# stands in for RabbitMQ, and the two publishers, the sentencer, the reducer
+# and the two writers run against it as they would on a droplet. Postgres is
+# not stood in for, the stages use DB_* from the environment as usual (its SQL
+# is postgres only), so point them at a local database holding the job's
+# books. Run it with the sentencer's venv, the reducer stages use
+# PIPELINE_REDUCER_PYTHON (defaults to the same python).
+#
+# Every PIPELINE_REPORT_INTERVAL seconds it prints each stage's input queue
+# depth (ready and unacked) and the messages a second going in and out of it,
+# and adds them to PIPELINE_REPORT_PATH (csv). Stops after the given seconds
+# or on ctrl-c, stopping the stages.
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+PIPELINE_REDUCER_PYTHON = os.environ.get('PIPELINE_REDUCER_PYTHON', sys.executable)
+PIPELINE_REPORT_INTERVAL = float(os.environ.get('PIPELINE_REPORT_INTERVAL', 5))
+PIPELINE_REPORT_PATH = os.environ.get('PIPELINE_REPORT_PATH', 'pipeline_report.csv')
+LOG_DIRS = ['/var/log/sentencerlogs', '/var/log/reducerlogs']
+# queue names the stages need, as the playbook sets them
+QUEUE_BASES = {
+    'PRE_REDUCTIONS_QUEUE_BASE': 'pre-reductions',
+    'PRE_SENTENCES_QUEUE_BASE': 'pre-sentences',
+    'REDUCTIONS_QUEUE_BASE': 'reductions',
+    'SENTENCES_QUEUE_BASE': 'sentences',
+}
+# (stage, directory, script, python, env var naming its input queues' base)
+STAGES = [
+    ('sentence publisher', 'sentencer', 'publisher.py', sys.executable, None),
+    ('sentencer', 'sentencer', 'sentencer.py', sys.executable,
+        'PRE_SENTENCES_QUEUE_BASE'),
+    ('sentence writer', 'sentencer', 'writer.py', sys.executable,
+        'SENTENCES_QUEUE_BASE'),
+    ('reduction publisher', 'reducer', 'publisher.py', PIPELINE_REDUCER_PYTHON,
+        None),
+    ('reducer', 'reducer', 'reducer.py', PIPELINE_REDUCER_PYTHON,
+        'PRE_REDUCTIONS_QUEUE_BASE'),
+    ('reduction writer', 'reducer', 'writer.py', PIPELINE_REDUCER_PYTHON,
+        'REDUCTIONS_QUEUE_BASE'),
+]
+
+
+def stage_queue_prefixes(env):
+    """{stage: prefix of its input queues}, buckets and shards included"""
+    return {stage: env[base] + '_' + env['JOB_NAME']
+            for stage, directory, script, python, base in STAGES if base}
+
+def stage_stats(stats, prefixes):
+    """{stage: [ready, unacked, consumers, published, acked]} from broker stats"""
+    totals = {stage: [0, 0, 0, 0, 0] for stage in prefixes}
+    for queue, numbers in stats.items():
+        for stage, prefix in prefixes.items():
+            if queue == prefix or queue.startswith(prefix + '_'):
+                totals[stage] = [t + n for t, n in zip(totals[stage], numbers)]
+    return totals
+
+def start_stages(env):
+    processes = []
+    for stage, directory, script, python, base in STAGES:
+        processes.append((stage, subprocess.Popen([python, script],
+            cwd=os.path.join(ROOT, directory), env=env)))
+    return processes
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if sys.argv[1:] else None
+    for log_dir in LOG_DIRS:
+        os.makedirs(log_dir, exist_ok=True)
+
+    broker = LocalBroker()
+    broker.start()
+    env = dict(os.environ, RABBITMQ_LOCATION='local:{}'.format(broker.port))
+    # the stages import the shared modules from here
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT,
+        os.environ.get('PYTHONPATH')]))
+    for name, base in QUEUE_BASES.items():
+        env.setdefault(name, base)
+    prefixes = stage_queue_prefixes(env)
+    processes = start_stages(env)
+
+    start = last = time.time()
+    previous = stage_stats(broker.stats(), prefixes)
+    with open(PIPELINE_REPORT_PATH, 'w', newline='') as report_file:
+        report = csv.writer(report_file)
+        report.writerow(['seconds', 'stage', 'ready', 'unacked', 'consumers',
+            'in_per_second', 'out_per_second'])
+        try:
+            while seconds is None or time.time() - start < seconds:
+                time.sleep(PIPELINE_REPORT_INTERVAL)
+                now = time.time()
+                current = stage_stats(broker.stats(), prefixes)
+                print('--- {:.0f}s'.format(now - start))
+                for stage in prefixes:
+                    ready, unacked, consumers, published, acked = current[stage]
+                    rate_in = (published - previous[stage][3]) / (now - last)
+                    rate_out = (acked - previous[stage][4]) / (now - last)
+                    print('{:<17} ready {:>7} unacked {:>5} in {:>8.1f}/s out {:>8.1f}/s'
+                            .format(stage, ready, unacked, rate_in, rate_out))
+                    report.writerow([round(now - start, 1), stage, ready,
+                        unacked, consumers, round(rate_in, 1), round(rate_out, 1)])
+                for stage, process in processes:
+                    if process.poll() is not None:
+                        print('{} exited with {}'.format(stage, process.returncode))
+                processes = [(s, p) for s, p in processes if p.poll() is None]
+                report_file.flush()
+                previous, last = current, now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for stage, process in processes:
+                process.terminate()
+
+    elapsed = time.time() - start
+    print('=== over {:.0f}s'.format(elapsed))
+    for stage, (ready, unacked, consumers, published, acked) in \
+            stage_stats(broker.stats(), prefixes).items():
+        print('{:<17} {:>9} handled, {:>8.1f}/s'.format(stage, acked,
+            acked / elapsed))
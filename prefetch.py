@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Adjust a worker's prefetch to how fast it is and how much work is left.
+
+A worker keeps about PREFETCH_TARGET_SECONDS of work (at the service time it
+has measured, moving average) prefetched, so fast boxes take more messages at
+a time and slow ones fewer. It never takes more than its share of what's
+waiting in its queues, so near the end of a job one worker can't sit on
+messages others could be working on.
+
+The limit is set on the whole channel (global QoS), which RabbitMQ applies to
+consumers that are already running. Per consumer limits still apply on top,
+set them with consumer_prefetch() so they don't cap the controller, or keep
+them and give the controller their sum as its maximum, so it only moves the
+channel's limit within them (the reducer's length buckets, see buckets.py).
+"""
+from math import ceil
+from time import time
+import logging
+import os
+
+ADAPTIVE_PREFETCH = os.environ.get('ADAPTIVE_PREFETCH', '1') == '1'
+PREFETCH_ADJUST_INTERVAL = float(os.environ.get('PREFETCH_ADJUST_INTERVAL', 10))
+PREFETCH_MAX = int(os.environ.get('PREFETCH_MAX', 500))
+PREFETCH_MIN = int(os.environ.get('PREFETCH_MIN', 1))
+PREFETCH_TARGET_SECONDS = float(os.environ.get('PREFETCH_TARGET_SECONDS', 5))
+SERVICE_TIME_SMOOTHING = .2 # weight of the newest measurement
+
+logger = logging.getLogger('prefetch')
+
+
+def prefetch_for(service_time, waiting, consumers, maximum=PREFETCH_MAX):
+    """Prefetch for a worker taking service_time seconds a message, with
+    waiting messages ready in its queues shared by consumers"""
+    wanted = ceil(PREFETCH_TARGET_SECONDS / max(service_time, 1e-6))
+    fair_share = ceil(waiting / max(consumers, 1)) + 1
+    return max(PREFETCH_MIN, min(wanted, fair_share, maximum))
+
+def consumer_prefetch(static):
+    """Per consumer prefetch, out of the controller's way when it's on"""
+    return PREFETCH_MAX if ADAPTIVE_PREFETCH else static
+
+
+class PrefetchController():
+    """Call observe() with each message's service time and adjust() often,
+    it sets the channel's prefetch at most every PREFETCH_ADJUST_INTERVAL"""
+    def __init__(self, queues, prefetch, maximum=PREFETCH_MAX):
+        self.queues = queues
+        self.prefetch = prefetch
+        self.maximum = maximum
+        self.service_time = None
+        self.last_adjusted = time()
+
+    def observe(self, seconds):
+        if self.service_time is None:
+            self.service_time = seconds
+        else:
+            self.service_time += SERVICE_TIME_SMOOTHING * (seconds - self.service_time)
+
+    def apply(self, channel):
+        """Set the current prefetch on a (new) channel"""
+        if ADAPTIVE_PREFETCH:
+            channel.basic_qos(prefetch_count=self.prefetch, all_channels=True)
+
+    def adjust(self, channel):
+        if not ADAPTIVE_PREFETCH or self.service_time is None or \
+                time() - self.last_adjusted < PREFETCH_ADJUST_INTERVAL:
+            return
+        self.last_adjusted = time()
+        waiting, consumers = 0, 0
+        for queue in self.queues:
+            q = channel.queue_declare(queue=queue, passive=True)
+            waiting += q.method.message_count
+            consumers = max(consumers, q.method.consumer_count)
+        prefetch = prefetch_for(self.service_time, waiting, consumers,
+                self.maximum)
+        if prefetch != self.prefetch:
+            logger.info('prefetch {} => {} ({:.3f}s a message, {} waiting)'.format(
+                self.prefetch, prefetch, self.service_time, waiting))
+            self.prefetch = prefetch
+            self.apply(channel)
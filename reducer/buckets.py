@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Route sentences to pre-reduction queues by length.
+
+Parse time grows faster than sentence length, so sentences are published to
+one queue per length bucket (<base>_16, <base>_32, ...) and reducers take more
+of the short ones at a time than of the long ones. Sentences longer than the
+last bucket follow LONG_SENTENCE_POLICY: 'side' sends them to a <base>_long
+queue, 'truncate' cuts them down to the last bucket, 'drop' drops them. The
+publisher stops while the long queue holds LONG_QUEUE_MAX_LEN sentences, as it
+does for the others, rather than the queue dropping any.
+
+Reducers send sentences that are over their parse budget to <base>_quarantine
+(see parse_budget.py). Reducers take the long and quarantine queues as well as
+the length buckets unless REDUCER_BUCKETS says otherwise, one sentence at a
+time, so both always have a consumer. A dedicated slow lane is a reducer with
+REDUCER_BUCKETS=long,quarantine.
+"""
+import os
+
+SENTENCE_LENGTH_BUCKETS = [int(b) for b in
+        os.environ.get('SENTENCE_LENGTH_BUCKETS', '16,32,64').split(',')]
+LONG_SENTENCE_POLICY = os.environ.get('LONG_SENTENCE_POLICY', 'side')
+LONG_QUEUE_MAX_LEN = int(os.environ.get('LONG_QUEUE_MAX_LEN', 10000))
+LONG_BUCKET = 'long'
+QUARANTINE_BUCKET = 'quarantine'
+
+
+def bucket_names():
+    return [str(b) for b in SENTENCE_LENGTH_BUCKETS]
+
+def consumed_buckets():
+    """The buckets a reducer takes by default, every one"""
+    return bucket_names() + [LONG_BUCKET, QUARANTINE_BUCKET]
+
+def bucket_queue(base_queue, bucket):
+    return base_queue + '_' + bucket
+
+def bucket_queues(base_queue):
+    """The queues every sentence short enough ends up in"""
+    return [bucket_queue(base_queue, b) for b in bucket_names()]
+
+def declare_bucket_queues(channel, base_queue):
+    """Declare every bucket queue and the long and quarantine queues, returns
+    {bucket name: declare result}"""
+    return {bucket: channel.queue_declare(queue=bucket_queue(base_queue, bucket))
+            for bucket in consumed_buckets()}
+
+def route(sentence, base_queue):
+    """Returns (queue, sentence) to publish, or (None, None) if the sentence is
+    dropped. Length is counted in whitespace separated tokens"""
+    tokens = sentence.split()
+    for limit in SENTENCE_LENGTH_BUCKETS:
+        if len(tokens) <= limit:
+            return bucket_queue(base_queue, str(limit)), sentence
+    if LONG_SENTENCE_POLICY == 'truncate':
+        limit = SENTENCE_LENGTH_BUCKETS[-1]
+        return bucket_queue(base_queue, str(limit)), ' '.join(tokens[:limit])
+    if LONG_SENTENCE_POLICY == 'drop':
+        return None, None
+    return bucket_queue(base_queue, LONG_BUCKET), sentence
+
+def bucket_prefetch(bucket, base_prefetch):
+    """Prefetch for a bucket, base_prefetch for the shortest bucket and
+    proportionally fewer for longer ones (1 for the long and quarantine
+    queues)"""
+    if bucket in (LONG_BUCKET, QUARANTINE_BUCKET):
+        return 1
+    return max(1, base_prefetch * SENTENCE_LENGTH_BUCKETS[0] // int(bucket))
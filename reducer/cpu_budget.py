@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Split a box's cores between reducer processes and their threads.
+
+Left alone, torch (and the OpenMP/MKL/BLAS libraries under it) gives every
+process as many threads as the box has cores, so a few reducers on a c-8 fight
+over 8 cores each. REDUCER_WORKERS processes with REDUCER_THREADS threads each
+share the cores instead. Either can be left out and is worked out from the
+other (by default one single threaded reducer a core), thread_sweep.py finds
+the best pair for a box. With REDUCER_PIN_CORES=1 each reducer is also pinned
+to its own REDUCER_THREADS cores.
+
+Thread counts have to be in the environment before torch is imported, so run
+reducers through this:
+
+    python cpu_budget.py python3 reducer.py
+
+which starts REDUCER_WORKERS of them with their budget in the environment
+(restarting any that die), and reducer.py calls apply_budget() to hold torch
+to it.
+"""
+import logging
+import os
+import subprocess
+import sys
+import time
+
+REDUCER_PIN_CORES = os.environ.get('REDUCER_PIN_CORES', '0') == '1'
+REDUCER_THREADS = os.environ.get('REDUCER_THREADS')
+REDUCER_WORKERS = os.environ.get('REDUCER_WORKERS')
+# the cores a worker is pinned to, set by the launcher, e.g. '2,3'
+REDUCER_CPUS = os.environ.get('REDUCER_CPUS')
+THREAD_ENV = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+        'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+logger = logging.getLogger('cpu_budget')
+
+
+def usable_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def budget(cores, workers=None, threads=None):
+    """(workers, threads a worker) sharing cores, either can be given"""
+    if workers is None and threads is None:
+        threads = 1
+    if workers is None:
+        workers = max(1, cores // threads)
+    if threads is None:
+        threads = max(1, cores // workers)
+    return workers, threads
+
+def worker_cpus(index, threads, cores):
+    """The cores worker index is pinned to, blocks of threads wrapping around"""
+    return [cores[(index * threads + i) % len(cores)] for i in range(threads)]
+
+def worker_env(index, threads, cores, pin=REDUCER_PIN_CORES, env=None):
+    """Environment for worker index, its thread limits and maybe its cores"""
+    env = dict(os.environ if env is None else env)
+    for name in THREAD_ENV:
+        env[name] = str(threads)
+    env['REDUCER_THREADS'] = str(threads)
+    if pin:
+        env['REDUCER_CPUS'] = ','.join(str(c) for c in
+                worker_cpus(index, threads, cores))
+    else:
+        env.pop('REDUCER_CPUS', None)
+    return env
+
+def apply_budget():
+    """Hold this process to its budget, call before loading the model"""
+    if REDUCER_CPUS and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [int(c) for c in REDUCER_CPUS.split(',')])
+    if REDUCER_THREADS:
+        try:
+            import torch
+        except ImportError:
+            return
+        torch.set_num_threads(int(REDUCER_THREADS))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
+            level=logging.INFO)
+    command = sys.argv[1:]
+    cores = usable_cores()
+    workers, threads = budget(len(cores),
+            None if REDUCER_WORKERS is None else int(REDUCER_WORKERS),
+            None if REDUCER_THREADS is None else int(REDUCER_THREADS))
+    logger.info('{} workers x {} threads on {} cores{}'.format(workers, threads,
+        len(cores), ', pinned' if REDUCER_PIN_CORES else ''))
+    if workers * threads > len(cores):
+        logger.warning('{} threads for {} cores, the box is oversubscribed'
+                .format(workers * threads, len(cores)))
+    processes = [subprocess.Popen(command, env=worker_env(i, threads, cores))
+            for i in range(workers)]
+    while True:
+        time.sleep(10)
+        for i, process in enumerate(processes):
+            if process.poll() is not None:
+                logger.info('worker {} exited with {}, restarting'.format(
+                    process.pid, process.returncode))
+                processes[i] = subprocess.Popen(command,
+                        env=worker_env(i, threads, cores))
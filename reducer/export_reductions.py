@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Export a job's reductions for training, so it doesn't query the database.
+
+Usage: python export_reductions.py <directory>
+
+Writes, in directory:
+
+    mood_id.npy, vp_id.npy, np_id.npy   uint32, one entry a row
+    count.npy                           uint64, how many times the row's
+                                        reduction was seen
+    components.json                     [[id, component], ...], see vocabulary.py
+    export.json                         what was exported
+
+Load the columns with numpy.load(path, mmap_mode='r'). With EXPORT_FORMAT=parquet
+(needs pyarrow) the four columns go into one zstd compressed reductions.parquet
+instead.
+
+Rows come from reduction_counts (one per distinct reduction) or, for jobs
+written with REDUCTION_WRITER_MODE=raw, from reductions (one per reduction,
+count 1). They're streamed through a server side cursor EXPORT_CHUNK rows at a
+time, so memory stays bounded however big the job is.
+"""
+from connections import Database
+from vocabulary import parse_reduction
+import json
+import numpy
+import os
+import sys
+
+try:
+    DB_NAME = os.environ.get('DB_NAME', 'nlp')
+    DB_PASSWORD = os.environ.get('DB_PASS', '')
+    DB_USER = os.environ.get('DB_USER', DB_NAME)
+    EXPORT_CHUNK = int(os.environ.get('EXPORT_CHUNK', 100000))
+    EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', 'npy')
+    JOB_ID = os.environ['JOB_ID']
+    WRITER_MODE = os.environ.get('REDUCTION_WRITER_MODE', 'aggregate')
+except KeyError as e:
+    raise Exception('important environment variables were not set')
+
+COLUMNS = (('mood_id', numpy.uint32), ('vp_id', numpy.uint32),
+        ('np_id', numpy.uint32), ('count', numpy.uint64))
+
+
+def components(conn):
+    """{component: id} and [[id, component], ...] for the whole vocabulary"""
+    cur = conn.cursor()
+    cur.execute("SELECT id, component FROM reduction_components ORDER BY id")
+    rows = cur.fetchall()
+    cur.close()
+    return {component: id for id, component in rows}, rows
+
+def row_count(conn):
+    cur = conn.cursor()
+    if WRITER_MODE == 'raw':
+        cur.execute("SELECT count(*) FROM reductions WHERE job_id=%s", (JOB_ID,))
+    else:
+        cur.execute("SELECT count(*) FROM reduction_counts WHERE job_id=%s",
+                (JOB_ID,))
+    n = cur.fetchone()[0]
+    cur.close()
+    return n
+
+def chunks(conn, ids):
+    """Lists of (mood id, vp id, np id, count) rows, EXPORT_CHUNK at a time"""
+    cur = conn.cursor(name='export_reductions_{}'.format(JOB_ID))
+    if WRITER_MODE == 'raw':
+        cur.execute("SELECT reduction FROM reductions WHERE job_id=%s",
+                (JOB_ID,))
+    else:
+        cur.execute("""SELECT mood_id, vp_id, np_id, count FROM reduction_counts
+                        WHERE job_id=%s
+                    """, (JOB_ID,))
+    while True:
+        rows = cur.fetchmany(EXPORT_CHUNK)
+        if not rows:
+            break
+        if WRITER_MODE == 'raw':
+            rows = [tuple(ids[c] for c in parse_reduction(r)) + (1,)
+                    for r, in rows]
+        yield rows
+    cur.close()
+    conn.commit()
+
+def write_npy(directory, rows, chunks):
+    """Fill a memory mapped .npy a column, chunk by chunk"""
+    columns = [numpy.lib.format.open_memmap(
+        os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype,
+        shape=(rows,)) for name, dtype in COLUMNS]
+    written = 0
+    for chunk in chunks:
+        # rows written since the count was taken are left out, rows deleted
+        # since leave count 0 rows at the end
+        chunk = chunk[:rows - written]
+        if not chunk:
+            break
+        chunk = numpy.array(chunk, dtype=numpy.uint64)
+        for i, column in enumerate(columns):
+            column[written:written + len(chunk)] = chunk[:, i]
+        written += len(chunk)
+    for column in columns:
+        column.flush()
+    return written
+
+def write_parquet(directory, chunks):
+    import pyarrow
+    import pyarrow.parquet
+    schema = pyarrow.schema([(name, pyarrow.from_numpy_dtype(dtype))
+        for name, dtype in COLUMNS])
+    written = 0
+    with pyarrow.parquet.ParquetWriter(os.path.join(directory,
+            'reductions.parquet'), schema, compression='zstd') as writer:
+        for chunk in chunks:
+            chunk = numpy.array(chunk, dtype=numpy.uint64)
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(chunk[:, i].astype(dtype))
+                    for i, (name, dtype) in enumerate(COLUMNS)],
+                schema=schema))
+            written += len(chunk)
+    return written
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1]
+    os.makedirs(directory, exist_ok=True)
+    conn = Database(DB_NAME, DB_USER, DB_PASSWORD)
+
+    ids, vocabulary = components(conn)
+    with open(os.path.join(directory, 'components.json'), 'w') as f:
+        json.dump(vocabulary, f)
+    if EXPORT_FORMAT == 'parquet':
+        written = write_parquet(directory, chunks(conn, ids))
+    else:
+        written = write_npy(directory, row_count(conn), chunks(conn, ids))
+    with open(os.path.join(directory, 'export.json'), 'w') as f:
+        json.dump({'job_id': JOB_ID, 'rows': written, 'format': EXPORT_FORMAT,
+            'source': 'reductions' if WRITER_MODE == 'raw' else 'reduction_counts',
+            'columns': [name for name, dtype in COLUMNS]}, f)
+    print('exported {} rows to {}'.format(written, directory))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""How often each reduction was seen, in a file that's memory mapped for
+lookups.
+
+The index is an open addressing hash table of 64 bit keys and counts, built
+once from an export (see export_reductions.py) and never changed. Keys are
+hashes of reduction strings, so looking one up needs neither the database nor
+the component ids. As well as each reduction's count it has each context's,
+the count of (mood, any verb phrase, noun phrase), which is what a reduction's
+frequency is relative to when scoring (see scorer.py).
+
+Lookups hash the string and probe the mapped table, a few microseconds and no
+loading. Processes that map the same file share its pages.
+
+Build an index with:
+
+    python frequency_index.py <export directory> <index path>
+"""
+from array import array
+from hashlib import blake2b
+from reduction_vectors import key_ids, reduction_keys
+from vocabulary import format_reduction
+import json
+import mmap
+import numpy
+import os
+import struct
+import sys
+
+MAGIC = b'SVAFREQ1'
+# magic, slots, reductions seen, distinct reductions, distinct verb phrases,
+# then slots keys and slots counts, all little endian like the machines
+HEADER = struct.Struct('<8sQQQQ')
+EMPTY = 0 # an empty slot's key
+
+
+def reduction_hash(components):
+    """(mood, verb phrase, noun phrase) => its key in the index"""
+    return _key(format_reduction(components).encode('utf-8'), b'reduction')
+
+def context_hash(m, np):
+    """(mood, noun phrase) => the key of its count over all verb phrases"""
+    return _key('{}>{}'.format(m, np).encode('utf-8'), b'context')
+
+def _key(data, person):
+    key = int.from_bytes(blake2b(data, digest_size=8, person=person).digest(),
+            'little')
+    return key or 1 # 0 marks empty slots
+
+
+class FrequencyIndex():
+    """A built index, mapped read only"""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.total, self.reductions, self.verb_phrases = \
+                HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError('{} is not a frequency index'.format(path))
+        table = memoryview(self.map)[HEADER.size:].cast('Q')
+        self.keys = table[:self.slots]
+        self.counts = table[self.slots:]
+        self.mask = self.slots - 1
+
+    def count(self, key):
+        i = key & self.mask
+        while True:
+            found = self.keys[i]
+            if found == key:
+                return self.counts[i]
+            if found == EMPTY:
+                return 0
+            i = (i + 1) & self.mask
+
+    def reduction_count(self, components):
+        return self.count(reduction_hash(components))
+
+    def context_count(self, components):
+        m, vp, np = components
+        return self.count(context_hash(m, np))
+
+
+def distinct_counts(export_directory):
+    """((mood id, vp id, np id), count) for each distinct reduction of an
+    export"""
+    load = lambda name: numpy.load(os.path.join(export_directory, name + '.npy'),
+            mmap_mode='r')
+    keys = reduction_keys(numpy.stack([load('mood_id'), load('vp_id'),
+        load('np_id')], axis=1))
+    # raw exports have a row per reduction seen
+    distinct, which = numpy.unique(keys, return_inverse=True)
+    totals = numpy.bincount(which, weights=load('count'))
+    return zip(map(tuple, key_ids(distinct).tolist()), totals.astype(
+        numpy.uint64).tolist())
+
+def build_index(export_directory, path):
+    """Write the index of an export to path, returns its header"""
+    with open(os.path.join(export_directory, 'components.json')) as f:
+        component = dict(json.load(f))
+    table = {}
+    verb_phrases = set()
+    total = reductions = 0
+    for (m, vp, np), n in distinct_counts(export_directory):
+        m, vp, np = component[m], component[vp], component[np]
+        table[reduction_hash((m, vp, np))] = n
+        context = context_hash(m, np)
+        table[context] = table.get(context, 0) + n
+        verb_phrases.add(vp)
+        total += n
+        reductions += 1
+    slots = 1
+    while slots < 2 * len(table): # at most half full, probes stay short
+        slots <<= 1
+    keys, counts = array('Q', [EMPTY]) * slots, array('Q', [0]) * slots
+    for key, n in table.items():
+        i = key & (slots - 1)
+        while keys[i] != EMPTY:
+            i = (i + 1) & (slots - 1)
+        keys[i], counts[i] = key, n
+    header = (MAGIC, slots, total, reductions, len(verb_phrases))
+    # renamed into place, services mapping the old index keep it until reopened
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(*header))
+        keys.tofile(f)
+        counts.tofile(f)
+    os.replace(path + '.tmp', path)
+    return header
+
+
+if __name__ == '__main__':
+    export_directory, path = sys.argv[1], sys.argv[2]
+    magic, slots, total, reductions, verb_phrases = build_index(export_directory, path)
+    print('{} reductions ({} seen, {} verb phrases) in {} slots, {}'.format(
+        reductions, total, verb_phrases, slots, path))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Subject verb pairs kept per sentence, so reductions can be redone without
+parsing again.
+
+The reducer stores each keyed sentence's pairs, as tree_reductions.pairs()
+finds them, with its mood in sentence_pairs. They're stored as compact JSON,
+[[verb words, subject words], ...] with words as [word, label]. rereduce.py
+turns them back into reduction counts after the rules change.
+"""
+from psycopg2.extras import Json
+
+
+def stored_pairs(data):
+    """The stored JSON back into pairs of (word, label) tuples, hashable"""
+    return [(tuple(map(tuple, vw)), tuple(map(tuple, sw))) for vw, sw in data]
+
+
+class PairStore():
+    def __init__(self, conn, job_id):
+        self.conn = conn
+        self.job_id = job_id
+
+    def create_table(self):
+        cur = self.conn.cursor()
+        # serialize, concurrent CREATE TABLE IF NOT EXISTS can still collide
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('sentence_pairs'))")
+        cur.execute("""CREATE TABLE IF NOT EXISTS sentence_pairs (
+                        job_id integer NOT NULL,
+                        sentence_key bigint NOT NULL,
+                        mood text,
+                        pairs jsonb NOT NULL,
+                        PRIMARY KEY (job_id, sentence_key)
+                    )""")
+        self.conn.commit()
+        cur.close()
+
+    def save(self, sentence_key, mood, pairs, commit=True):
+        """Store a sentence's pairs, a sentence parsed again replaces them. The
+        reducer passes commit=False and commits them with the sentence's
+        counts, see job_ledger.py"""
+        cur = self.conn.cursor()
+        cur.execute("""INSERT INTO sentence_pairs (job_id, sentence_key, mood, pairs)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (job_id, sentence_key) DO UPDATE SET
+                        mood=EXCLUDED.mood, pairs=EXCLUDED.pairs
+                    """, (self.job_id, sentence_key, mood, Json(pairs)))
+        if commit:
+            self.conn.commit()
+        cur.close()
+
+    def sentences(self, with_text=False, itersize=10000):
+        """(sentence key, mood, pairs[, sentence]) for every stored sentence of
+        the job, streamed"""
+        # named, so rows come from the server itersize at a time
+        cur = self.conn.cursor(name='sentence_pairs_{}'.format(self.job_id))
+        cur.itersize = itersize
+        if with_text:
+            cur.execute("""SELECT p.sentence_key, p.mood, p.pairs, s.sentence
+                            FROM sentence_pairs p
+                            JOIN sentences s ON s.id = p.sentence_key
+                            WHERE p.job_id=%s
+                        """, (self.job_id,))
+        else:
+            cur.execute("""SELECT sentence_key, mood, pairs FROM sentence_pairs
+                            WHERE job_id=%s
+                        """, (self.job_id,))
+        for row in cur:
+            yield (row[0], row[1], stored_pairs(row[2])) + tuple(row[3:])
+        cur.close()
+        self.conn.commit()
+
+    def count(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT count(*) FROM sentence_pairs WHERE job_id=%s",
+                (self.job_id,))
+        n = cur.fetchone()[0]
+        cur.close()
+        return n
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Budgets for a sentence's parse, so one bad sentence can't stall a reducer.
+
+A sentence longer than REDUCER_MAX_TOKENS isn't parsed at all, the parser's
+chart grows with the square of the length, and so does its memory. A parse
+still going after REDUCER_PARSE_SECONDS is abandoned, a SIGALRM watchdog
+raises OverBudget in the middle of it. Either way the reducer sends the
+sentence to the quarantine queue (see buckets.py) with what it cost. Sentences
+from the quarantine queue get the bigger REDUCER_QUARANTINE_MAX_TOKENS and
+REDUCER_QUARANTINE_PARSE_SECONDS, one over those as well is dropped and logged
+for someone to look at. 0 turns a budget off.
+
+Signals only reach the main thread, which is where pika calls handle_message.
+The alarm goes off between Python bytecodes, so a torch op that's running
+finishes first, a parse is a great many of them.
+"""
+from contextlib import contextmanager
+import os
+import signal
+
+REDUCER_MAX_TOKENS = int(os.environ.get('REDUCER_MAX_TOKENS', 150))
+REDUCER_PARSE_SECONDS = float(os.environ.get('REDUCER_PARSE_SECONDS', 10))
+REDUCER_QUARANTINE_MAX_TOKENS = int(os.environ.get('REDUCER_QUARANTINE_MAX_TOKENS', 400))
+REDUCER_QUARANTINE_PARSE_SECONDS = float(os.environ.get(
+    'REDUCER_QUARANTINE_PARSE_SECONDS', 60))
+
+
+class OverBudget(Exception):
+    """reason is 'tokens' or 'seconds'"""
+    def __init__(self, reason):
+        Exception.__init__(self, 'over the {} budget'.format(reason))
+        self.reason = reason
+
+
+def check_tokens(sentence, max_tokens=REDUCER_MAX_TOKENS):
+    """Returns the sentence's whitespace separated tokens, raises OverBudget
+    if there are too many to parse"""
+    tokens = len(sentence.split())
+    if max_tokens and tokens > max_tokens:
+        raise OverBudget('tokens')
+    return tokens
+
+def budgets(quarantined):
+    """(max tokens, parse seconds) for a sentence, bigger for quarantined ones"""
+    if quarantined:
+        return REDUCER_QUARANTINE_MAX_TOKENS, REDUCER_QUARANTINE_PARSE_SECONDS
+    return REDUCER_MAX_TOKENS, REDUCER_PARSE_SECONDS
+
+@contextmanager
+def time_budget(seconds=REDUCER_PARSE_SECONDS):
+    """Raise OverBudget in the block if it runs longer than seconds"""
+    if not seconds:
+        yield
+        return
+    def expired(signum, frame):
+        raise OverBudget('seconds')
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
@@ -1,12 +1,16 @@
 from sva_utils import drop_modifiers, remove_prepositional_phrases
 from sva_utils import substitute_infinitives_as_subjects
 from sva_utils import simplify_compound_subjects, remove_adverbial_clauses
+from normalize import normalize
 from preprocess_utils import remove_double_commas, remove_leading_noise
+import json
+import sys
 import textacy
+import time
 
 def preprocess_sent(sentence_str):
-    sentence_str = textacy.preprocess.normalize_whitespace(sentence_str)
-    sentence_str = textacy.preprocess.unpack_contractions(sentence_str)
+    # whitespace, quotes and contractions in one pass, see normalize.py
+    sentence_str = normalize(sentence_str, contractions=True)
     # sentence_str = drop_modifiers(sentence_str)
     # sentence_str = remove_double_commas(sentence_str)
     # sentence_str = remove_leading_noise(sentence_str)
@@ -19,3 +23,34 @@ def preprocess_sent(sentence_str):
     # sentence_str = textacy.preprocess.normalize_whitespace(sentence_str)
     # sentence_str = sentence_str[0].upper() + sentence_str[1:]
     return sentence_str
+
+def textacy_preprocess_sent(sentence_str):
+    """ What preprocess_sent did before normalize.py, to compare against """
+    sentence_str = textacy.preprocess.normalize_whitespace(sentence_str)
+    return textacy.preprocess.unpack_contractions(sentence_str)
+
+
+if __name__ == '__main__':
+    # python preprocess.py [sentences.txt], one sentence a line, compares
+    # preprocess_sent with the textacy chain it replaced
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            sents = [line.rstrip('\n') for line in f]
+    else:
+        with open('../test/data/sentences.json') as f:
+            sents = [s['text'] for s in json.load(f)['sentences']]
+    for preprocess in (textacy_preprocess_sent, preprocess_sent):
+        start = time.time()
+        for _ in range(10):
+            for sent in sents:
+                preprocess(sent)
+        print('{}: {:.1f}us a sentence'.format(preprocess.__name__,
+            1e6 * (time.time() - start) / (10 * len(sents))))
+    differences = [(sent, textacy_preprocess_sent(sent), preprocess_sent(sent))
+            for sent in sents
+            if textacy_preprocess_sent(sent) != preprocess_sent(sent)]
+    # expected for curly quotes, which textacy left alone
+    for sent, old, new in differences[:10]:
+        print('{!r}\n  textacy   {!r}\n  normalize {!r}'.format(sent, old, new))
+    print('{} of {} sentences preprocessed differently'.format(len(differences),
+        len(sents)))
@@ -1,10 +1,12 @@
+from buckets import bucket_queue, bucket_queues, declare_bucket_queues, route
+from buckets import LONG_BUCKET, LONG_QUEUE_MAX_LEN
+from connections import Database, Rabbit
+from job_ledger import JobLedger
+from wire import encode_text
 from time import sleep
 import json
 import logging
 import os
-import pika
-import psycopg2
-import random
 import socket
 
 FNAME=os.path.basename(__file__)
@@ -42,79 +44,131 @@ except KeyError as e:
 # 1. Connect to the database
 # 2. Start adding sentences to PRE_REDUCTIONS_QUEUE
 
+def stay_leader():
+    """The advisory lock went with the old connection, take it back"""
+    if not ledger.try_lead('reduction_publisher'):
+        logger.critical('lost the pre-reductions publisher lock, exiting')
+        raise Exception('Lost the reduction publisher lock. Exiting')
+
+def declare_queues(connection, channel):
+    """Sentences go to a queue per length bucket, see buckets.py"""
+    declare_bucket_queues(channel, PRE_REDUCTIONS_QUEUE)
+
+def publish_rows(connection, channel, rows):
+    """Publish the page of sentences, returns (queued, queued to the long
+    queue, log messages)"""
+    messages = []
+    queued, queued_long = 0, 0
+    for key, sentence in rows:
+        queue, sent_str = route(sentence, PRE_REDUCTIONS_QUEUE)
+        if queue is None:
+            messages.append('dropped long pre-reduction')
+            continue
+        # the sentence id keys its reductions, so the writer can drop repeats
+        body, properties = encode_text(sent_str, headers={'key': key})
+        channel.basic_publish(exchange='', routing_key=queue, body=body,
+                properties=properties)
+        if queue.endswith('_' + LONG_BUCKET):
+            queued_long += 1
+        else:
+            queued += 1
+        messages.append('queued pre-reduction')
+    return queued, queued_long, messages
+
+def forget_reduced_sentences(conn):
+    """The writers' record of which sentences they counted (see writer.py),
+    a row per sentence, isn't needed once the job's counts are final"""
+    cur = conn.cursor()
+    # raw writers don't keep one
+    cur.execute("SELECT to_regclass('reduced_sentences')")
+    if cur.fetchone()[0] is not None:
+        cur.execute("DELETE FROM reduced_sentences WHERE job_id=%s", (JOB_ID,))
+    conn.commit()
+    cur.close()
+
+def at_capacity(connection, channel):
+    """True while the length bucket queues hold MAX_QUEUE_LEN sentences or
+    the long queue LONG_QUEUE_MAX_LEN"""
+    queued = sum(channel.queue_declare(queue=q).method.message_count
+            for q in bucket_queues(PRE_REDUCTIONS_QUEUE))
+    queued_long = channel.queue_declare(queue=bucket_queue(PRE_REDUCTIONS_QUEUE,
+        LONG_BUCKET)).method.message_count
+    return queued > MAX_QUEUE_LEN or queued_long >= LONG_QUEUE_MAX_LEN
+
 
 if __name__ == '__main__':
     # Connect to the database
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            host='localhost')
+    conn = Database(DB_NAME, DB_USER, DB_PASSWORD, on_reconnect=stay_leader)
     cur = conn.cursor()
 
+    ledger = JobLedger(conn, JOB_ID)
+    ledger.create_table()
+
     # Check if a publisher is already running for this job, if so exit, if not
-    # mark that one is running then continue.
+    # mark that one is running then continue. The advisory lock is released if
+    # this process dies, the meta flag just shows who it is.
+    if not ledger.try_lead('reduction_publisher'):
+        logger.info('job already has dedicated pre-reductions publisher, exiting')
+        raise Exception('This job already has a dedicated reduction publisher. Exiting')
     cur.execute("""UPDATE jobs SET meta=jsonb_set(meta, '{reduction_publisher}', %s), updated=DEFAULT
-                    WHERE NOT(meta ? 'reduction_publisher')
-                    AND id=%s
+                    WHERE id=%s
                 """, (json.dumps(DROPLET_NAME),JOB_ID))
     conn.commit()
-    cur.execute("""SELECT COUNT(*) FROM jobs WHERE
-                    meta->'reduction_publisher'=%s
-                    AND id=%s
-                """,
-            (json.dumps(DROPLET_NAME), JOB_ID))
-    continue_running = cur.fetchone()[0] == 1
-    if not continue_running:
-        logger.info('job already has dedicated pre-reductions publisher, exiting')
-        raise Exception('This job already has a dedicated reduction publisher. Exiting')
+    cur.close()
 
-    # Issue select statements
-    cur.execute("SELECT sentence from sentences WHERE job_id=%s ORDER BY RANDOM()",
-            (JOB_ID,))
-
-    # Connect to pika
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBIT))
-    channel = connection.channel()
-
-    # Declare queue if doesn't exist, get reference to queue
-    q = channel.queue_declare(queue=PRE_REDUCTIONS_QUEUE)
-    q_len = q.method.message_count
-    some_pre_reductions_not_queued = True
-    while some_pre_reductions_not_queued:
-        messages = []
-        some_pre_reductions_not_queued = False
-        for row in cur.fetchmany(MAX_QUEUE_LEN):
-            some_pre_reductions_not_queued = True # at least one row
-            sent_str = row[0]
-            channel.basic_publish(exchange='', routing_key=PRE_REDUCTIONS_QUEUE,
-                    body=json.dumps(sent_str))
-            messages.append('queued pre-reduction')
+    # Sentences go out in id order, resuming after the last one a previous
+    # publisher checkpointed
+    last_key = ledger.checkpoint('reduction_publisher')
+    if last_key:
+        logger.info('resuming after sentence {}'.format(last_key))
+
+    # Connect to pika, declare queues if they don't exist
+    rabbit = Rabbit(RABBIT, setup=declare_queues)
+
+    while True:
+        # a page at a time, by key, so a dropped connection loses nothing
+        cur = conn.cursor()
+        cur.execute("""SELECT id, sentence from sentences WHERE job_id=%s AND id > %s
+                        ORDER BY id LIMIT %s
+                    """, (JOB_ID, last_key, MAX_QUEUE_LEN))
+        rows = cur.fetchall()
+        cur.close()
+        if not rows:
+            break
+        queued, queued_long, messages = rabbit.run(
+                lambda connection, channel: publish_rows(connection, channel, rows))
+        last_key = rows[-1][0]
+        # the long queue is its own stage. Counts and checkpoint together, a
+        # batch is either both or neither
+        ledger.save_checkpoint('reduction_publisher', last_key,
+                {'pre-reductions': queued, 'pre-reductions-long': queued_long})
         for message in messages:
             logger.info(message)
-        q = channel.queue_declare(queue=PRE_REDUCTIONS_QUEUE)
-        q_len = q.method.message_count
-        while q_len > MAX_QUEUE_LEN:
+        while rabbit.run(at_capacity):
             sleep(.1) # max speed w sleep (1) is MAX_QUEUE_LEN / s
             logger.info('pre reductions queue at capacity, sleeping')
-            q = channel.queue_declare(queue=PRE_REDUCTIONS_QUEUE)
-            q_len = q.method.message_count
 
     # update state to pre-reductions-queued
+    ledger.finish_publishing('pre-reductions')
+    cur = conn.cursor()
     cur.execute("""UPDATE jobs SET state=%s, updated=DEFAULT
                     WHERE id=%s
                 """, ('pre-reductions-queued',JOB_ID))
     conn.commit()
     logger.info('all pre-reductions have been queued. waiting for acks')
 
-    # wait until all messages have been acked
-    q = channel.queue_declare(queue=PRE_REDUCTIONS_QUEUE)
-    q_len = q.method.message_count
-    while q_len > 0:
-        sleep(2)
-        q = channel.queue_declare(queue=PRE_REDUCTIONS_QUEUE)
-        q_len = q.method.message_count
+    # wait until every sentence has been reduced (long and quarantined ones
+    # too) and every reduction written
+    ledger.wait(['pre-reductions', 'pre-reductions-long',
+        'pre-reductions-quarantine', 'reductions'])
+    ledger.forget_keys(['pre-reductions', 'pre-reductions-long',
+        'pre-reductions-quarantine'])
+    forget_reduced_sentences(conn)
 
-    logger.info('all pre-reductions have been acked. setting state to reduced.')
+    logger.info('all reductions have been written. setting state to reduced.')
 
     # update state to reduced
+    cur = conn.cursor()
     cur.execute("""UPDATE jobs SET state=%s, updated=DEFAULT
                     WHERE id=%s
                 """, ('reduced',JOB_ID))
@@ -122,4 +176,5 @@ if __name__ == '__main__':
 
     logger.info('exiting')
     cur.close()
+    rabbit.close()
     conn.close()
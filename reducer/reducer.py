@@ -1,13 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from allennlp.service.predictors import Predictor
-from reducer_helper import get_reduction, load_predictor
+from buckets import bucket_prefetch, bucket_queue, consumed_buckets
+from buckets import declare_bucket_queues, LONG_BUCKET, QUARANTINE_BUCKET
+from connections import Database, Rabbit
+from cpu_budget import apply_budget
+from job_ledger import JobLedger
+from prefetch import PrefetchController
+from pair_store import PairStore
+from parse_budget import budgets, check_tokens, OverBudget, time_budget
+from reducer_helper import load_predictor, sentence_tree
+from shards import declare_shard_queues, route_to_shard
+from tree_reductions import pair_reductions, pairs, sentence_mood
+from vocabulary import ReductionVocabulary, encode_reduction_ids
+from vocabulary import REDUCTION_IDS_CONTENT_TYPE
+from wire import decode_text, encode_text
 import logging
 import os
 import pika
+import psycopg2
 import io
 import re
 import socket
+import time
 
 FNAME=os.path.basename(__file__)
 PID=os.getpid()
@@ -23,41 +37,167 @@ logging.basicConfig(format=log_format,
     level=logging.INFO)
 logger = logging.getLogger('reducer')
 
-# set up AllenNLP Predictor
+# set up AllenNLP Predictor, within this worker's share of the cpu
+apply_budget()
 allen_predictor = load_predictor()
 
 try:
+    DB_NAME = os.environ.get('DB_NAME', 'nlp')
+    DB_PASSWORD = os.environ.get('DB_PASS', '')
+    DB_USER = os.environ.get('DB_USER', DB_NAME)
+    JOB_ID = os.environ['JOB_ID']
     JOB_NAME = os.environ['JOB_NAME']
     PRE_REDUCTIONS_BASE = os.environ['PRE_REDUCTIONS_QUEUE_BASE']
     PRE_REDUCTIONS_QUEUE = PRE_REDUCTIONS_BASE + '_' + JOB_NAME
+    QUARANTINE_QUEUE = bucket_queue(PRE_REDUCTIONS_QUEUE, QUARANTINE_BUCKET)
     RABBIT = os.environ.get('RABBITMQ_LOCATION', 'localhost')
+    # buckets this worker consumes, all of them by default, e.g. '16,32' or
+    # 'long,quarantine' for a slow lane, see buckets.py
+    REDUCER_BUCKETS = os.environ.get('REDUCER_BUCKETS', ','.join(consumed_buckets())).split(',')
     REDUCER_PREFETCH_COUNT = int(os.environ.get('REDUCER_PREFETCH_COUNT', 10))
     REDUCTIONS_BASE = os.environ['REDUCTIONS_QUEUE_BASE']
     REDUCTIONS_QUEUE = REDUCTIONS_BASE + '_' + JOB_NAME
+    # keep each sentence's subject verb pairs, so rereduce.py can redo its
+    # reductions without parsing it again
+    STORE_PAIRS = os.environ.get('STORE_PAIRS', '1') == '1'
+    # 'queue' also sends reductions to the vectorizer, see vectorizer.py
+    VECTORIZER_MODE = os.environ.get('VECTORIZER_MODE', 'off')
+    if VECTORIZER_MODE == 'queue':
+        PRE_VECTORS_QUEUE = os.environ['PRE_VECTORS_QUEUE_BASE'] + '_' + JOB_NAME
 except KeyError as e:
     logger.critical("important environment variables were not set.")
     raise Exception('important environment variables were not set')
 
+# Connect to the database, reduction components are interned there
+conn = Database(DB_NAME, DB_USER, DB_PASSWORD)
+vocabulary = ReductionVocabulary(conn)
+ledger = JobLedger(conn, JOB_ID)
+pair_store = PairStore(conn, JOB_ID)
+
+def ids_properties(sentence_key, index):
+    """Reductions are keyed by their sentence and position in it, so a sentence
+    reduced twice (after a restart) is only counted once"""
+    if sentence_key is None:
+        return pika.BasicProperties(content_type=REDUCTION_IDS_CONTENT_TYPE)
+    return pika.BasicProperties(content_type=REDUCTION_IDS_CONTENT_TYPE,
+            headers={'key': sentence_key, 'index': index})
+
+def is_quarantined(method):
+    return method.routing_key.endswith('_' + QUARANTINE_BUCKET)
+
+def quarantine(ch, method, sentence, sentence_key, reason, tokens, seconds):
+    """Send a sentence that was over its parse budget to the quarantine queue,
+    with what it cost, returns how many were sent. One that came from there is
+    dropped, so it can't go round for ever"""
+    if is_quarantined(method):
+        logger.error('dropping quarantined sentence {}, over the {} budget again'
+                ' ({} tokens, {:.1f}s)'.format(sentence_key, reason, tokens, seconds))
+        return 0
+    body, properties = encode_text(sentence, headers={'key': sentence_key,
+        'reason': reason, 'tokens': tokens, 'seconds': round(seconds, 3),
+        'queue': method.routing_key, 'host': HOST})
+    ch.basic_publish(exchange='', routing_key=QUARANTINE_QUEUE, body=body,
+            properties=properties)
+    logger.warning('quarantined sentence {}, over the {} budget ({} tokens, '
+            '{:.1f}s)'.format(sentence_key, reason, tokens, seconds))
+    return 1
+
 def handle_message(ch, method, properties, body):
+    started = time.time()
+    published = quarantined = 0
+    sentence_key = tokens = store_pairs = None
     try:
-        body = body.decode('utf-8')
-        for reduction in get_reduction(body, allen_predictor):
-            channel.basic_publish(exchange='', routing_key=REDUCTIONS_QUEUE,
-                    body=reduction)
+        body = decode_text(properties, body)
+        sentence_key = (properties.headers or {}).get('key')
+        # a sentence's reductions all go to the same writer shard, in order
+        queue = route_to_shard(REDUCTIONS_QUEUE, sentence_key)
+        max_tokens, parse_seconds = budgets(is_quarantined(method))
+        tokens = check_tokens(body, max_tokens)
+        # the watchdog only covers the parse, an abandoned one has sent nothing
+        with time_budget(parse_seconds):
+            tree = sentence_tree(body, allen_predictor)
+        found = pairs(tree)
+        m = sentence_mood(found, body)
+        if STORE_PAIRS and sentence_key is not None:
+            # committed with the sentence's counts, not on their own
+            store_pairs = lambda: pair_store.save(sentence_key, m, found,
+                    commit=False)
+        for components in pair_reductions(found, m):
+            ids = vocabulary.encode(components)
+            ch.basic_publish(exchange='', routing_key=queue,
+                    body=encode_reduction_ids(ids),
+                    properties=ids_properties(sentence_key, published))
+            if VECTORIZER_MODE == 'queue':
+                ch.basic_publish(exchange='', routing_key=PRE_VECTORS_QUEUE,
+                        body=encode_reduction_ids(ids),
+                        properties=ids_properties(sentence_key, published))
+            published += 1
         logger.info("queued reductions")
+    except OverBudget as e:
+        quarantined = quarantine(ch, method, body, sentence_key, e.reason,
+                tokens or len(body.split()), time.time() - started)
+    except psycopg2.Error as e:
+        logger.error("problem interning reduction - {}".format(e))
+        conn.rollback()
     except Exception as e:
         logger.error("problem handling message - {}".format(e))
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    if method.routing_key.endswith('_' + LONG_BUCKET):
+        stage = 'pre-reductions-long'
+    elif is_quarantined(method):
+        stage = 'pre-reductions-quarantine'
+    else:
+        stage = 'pre-reductions'
+    # what we published and the sentence (and its pairs), together and once
+    # per sentence, before the sentence is acked, see job_ledger.py. A
+    # dropped connection is retried there, anything else and the sentence
+    # comes back
+    try:
+        ledger.commit_message(stage, sentence_key, {'reductions': published,
+            'pre-reductions-quarantine': quarantined}, also=store_pairs)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+    except psycopg2.Error as e:
+        logger.error("problem counting sentence, requeueing it - {}".format(e))
+        conn.rollback()
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+    prefetch_controller.observe(time.time() - started)
+    prefetch_controller.adjust(ch)
 
 
-if __name__ == '__main__':
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBIT))
-    channel = connection.channel()
-    channel.queue_declare(queue=PRE_REDUCTIONS_QUEUE) # create queue if doesn't exist
-    channel.queue_declare(queue=REDUCTIONS_QUEUE)
+def setup(connection, channel):
+    """Declare queues, QoS and consumers, again on every reconnect"""
+    declare_bucket_queues(channel, PRE_REDUCTIONS_QUEUE) # create queues if they don't exist
+    declare_shard_queues(channel, REDUCTIONS_QUEUE)
+    if VECTORIZER_MODE == 'queue':
+        channel.queue_declare(queue=PRE_VECTORS_QUEUE)
 
     # NOTE: if the prefetch count is too high, some workers could starve. If it
-    # is too low, we make an unneccessary amount of requests to rabbitmq server
-    channel.basic_qos(prefetch_count=REDUCER_PREFETCH_COUNT) # limit num of unackd msgs on channel
-    channel.basic_consume(handle_message, queue=PRE_REDUCTIONS_QUEUE, no_ack=False)
-    channel.start_consuming()
+    # is too low, we make an unneccessary amount of requests to rabbitmq server.
+    # Each bucket gets its own consumer, qos applies to consumers started after
+    # it, so short sentences are prefetched in bigger batches than long ones.
+    # These stay as they are with adaptive prefetch, so long sentences can't
+    # take the whole window.
+    for bucket in REDUCER_BUCKETS:
+        channel.basic_qos(prefetch_count=bucket_prefetch(bucket,
+            REDUCER_PREFETCH_COUNT)) # limit num of unackd msgs per consumer
+        channel.basic_consume(handle_message, no_ack=False,
+                queue=bucket_queue(PRE_REDUCTIONS_QUEUE, bucket))
+    # and a limit over all of them that follows how fast we are, within their
+    # sum, see prefetch.py
+    prefetch_controller.apply(channel)
+
+
+if __name__ == '__main__':
+    vocabulary.create_table()
+    ledger.create_table()
+    if STORE_PAIRS:
+        pair_store.create_table()
+
+    bucket_prefetches = sum(bucket_prefetch(b, REDUCER_PREFETCH_COUNT)
+            for b in REDUCER_BUCKETS)
+    prefetch_controller = PrefetchController(
+            [bucket_queue(PRE_REDUCTIONS_QUEUE, b) for b in REDUCER_BUCKETS],
+            bucket_prefetches, maximum=bucket_prefetches)
+
+    # a dropped connection reconnects, the model stays loaded
+    rabbit = Rabbit(RABBIT, setup=setup)
+    rabbit.run(lambda connection, channel: channel.start_consuming())
@@ -1,17 +1,78 @@
-from allennlp.service.predictors import Predictor
 from nltk.tree import Tree
 from preprocess import preprocess_sent
+from replay_predictor import RecordingPredictor, ReplayPredictor
+from spacy_predictor import SpacyPredictor
+from tree_reductions import batch_reductions, tree_reductions
 from pattern.en import mood, tenses, lemma
 from hashlib import sha256
+from vocabulary import format_reduction
 import top100
 import json
+import os
+import re
+import sys
+import time
 
 import subjects_with_verbs_to_reductions
 
 
-def load_predictor():
-    """Load model from AllenNLP, which we've downloaded"""
-    return Predictor.from_path("elmo-constituency-parser-2018.03.14.tar.gz")
+MODEL_PATH = "elmo-constituency-parser-2018.03.14.tar.gz"
+# 'allennlp' parses with the model, 'replay' answers from recorded parses
+# without loading it, 'record' parses with the model and records the parses,
+# 'spacy' converts spacy dependency parses (much faster, less accurate),
+# 'int8' parses with the model's LSTM and linear weights quantized to int8
+# (needs torch >= 1.3, see the README, compare it with
+# python reducer_helper.py allennlp int8)
+PREDICTOR_BACKEND = os.environ.get('PREDICTOR_BACKEND', 'allennlp')
+PREDICTOR_PARSES_PATH = os.environ.get('PREDICTOR_PARSES_PATH', 'parses.jsonl')
+
+def load_predictor(backend=PREDICTOR_BACKEND, parses_path=PREDICTOR_PARSES_PATH):
+    """Load model from AllenNLP, which we've downloaded, or a stand-in for it"""
+    if backend == 'replay':
+        return ReplayPredictor(parses_path)
+    if backend == 'spacy':
+        return SpacyPredictor()
+    if backend == 'int8':
+        check_quantization() # before spending a minute loading the model
+    from allennlp.service.predictors import Predictor
+    predictor = Predictor.from_path(MODEL_PATH)
+    if backend == 'record':
+        return RecordingPredictor(predictor, parses_path)
+    if backend == 'int8':
+        predictor._model = quantize_model(predictor._model)
+    return predictor
+
+def check_quantization():
+    """Raise if this torch can't quantize, torch.quantization is 1.3 on"""
+    import torch
+    version = tuple(int(n) for n in re.findall(r'\d+', torch.__version__)[:2])
+    if version < (1, 3):
+        raise RuntimeError('PREDICTOR_BACKEND=int8 needs torch >= 1.3, this is '
+                'torch {}, the pinned allennlp brings it. See the README for '
+                'the upgrade'.format(torch.__version__))
+
+def quantize_model(model):
+    """The model with its LSTM and linear layers dynamically quantized to int8,
+    activations stay float and are quantized on the fly"""
+    import torch
+    return torch.quantization.quantize_dynamic(model,
+            {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+
+def weight_bytes(predictor):
+    """Size of the predictor's model weights as saved, None without a model"""
+    model = getattr(predictor, '_model', None)
+    if model is None:
+        return None
+    import io
+    import torch
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def resident_bytes():
+    """This process's resident memory, linux only"""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
 
 def get_verb_subject_pairs(tree):
     """ Returns the individual words associated with each verb and noun phraseself.
@@ -267,11 +328,37 @@ def sentence_to_pairs(sent, predictor):
     }
 
 def get_reduction(sent, predictor):
-    print("Inside get_reduction")
+    return [format_reduction(c) for c in get_reduction_components(sent, predictor)]
+
+def sentence_tree(sent, predictor):
+    parse = predictor.predict_json({"sentence": preprocess_sent(sent)})
+    return Tree.fromstring(parse["trees"])
+
+def get_reduction_components(sent, predictor):
+    """ Takes a sentence and AllenNLP predictor, returns a
+    (mood, verb phrase, noun phrase) tuple for each subject_verb pair
+    """
+    return tree_reductions(sentence_tree(sent, predictor), sent)
+
+def batch_reduction_components(sents, predictor):
+    """ get_reduction_components for a list of sentences, parsed as one batch
+    when the predictor can (AllenNLP's can)
+    """
+    inputs = [{"sentence": preprocess_sent(sent)} for sent in sents]
+    if hasattr(predictor, 'predict_batch_json'):
+        parses = predictor.predict_batch_json(inputs)
+    else:
+        parses = [predictor.predict_json(i) for i in inputs]
+    return batch_reductions([Tree.fromstring(p["trees"]) for p in parses], sents)
+
+def pairwise_reduction_components(sent, predictor):
+    """ The reductions the long way round, pair dicts then one pair at a time.
+    tree_reductions should always agree with it
+    """
     svpair_info = sentence_to_pairs(sent, predictor)
-    print("svpairinfo is: ", svpair_info)
     text, pairs = svpair_info['text'], svpair_info['subjects_with_verbs']
-    return [subjects_with_verbs_to_reductions.get_reduction(pair, text) for pair in pairs]
+    return [subjects_with_verbs_to_reductions.get_reduction_components(pair, text)
+            for pair in pairs]
 
 # MARK: Test Sentences and Pipeline
 
@@ -301,8 +388,8 @@ def test_pipeline(sent, predictor):
     print(pairs)
     return pairs
 
-def evaluate_subjects_with_verbs(actual, expected):
-    """ Evaluates two given subjects_with_verbs object to check their equality, prints """
+def same_subjects_with_verbs(actual, expected):
+    """ True if two subjects_with_verbs objects hold the same pairs """
     # We do some really tedious checking here because sorting this list of
     # dictionaries is otherwise sorta annoying
     equal = True
@@ -312,8 +399,11 @@ def evaluate_subjects_with_verbs(actual, expected):
     for pair in expected:
         if pair not in actual:
             equal = False
+    return equal
 
-    if equal:
+def evaluate_subjects_with_verbs(actual, expected):
+    """ Evaluates two given subjects_with_verbs object to check their equality, prints """
+    if same_subjects_with_verbs(actual, expected):
         print("PASSED $$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$ ")
         return 1
     else:
@@ -322,20 +412,59 @@ def evaluate_subjects_with_verbs(actual, expected):
         print("Got:", actual)
         return 0
 
+def agreement(predictor, test_path='../test/data/sentences.json'):
+    """ Returns the fraction of test sentences the predictor gets exactly the
+    expected subject verb pairs for, and the seconds it took per sentence """
+    with open(test_path) as test_file:
+        tests = json.load(test_file)["sentences"]
+    num_correct = 0
+    start = time.time()
+    for example in tests:
+        pairs = sentence_to_pairs(example["text"], predictor)['subjects_with_verbs']
+        if same_subjects_with_verbs(pairs, example["subjects_with_verbs"]):
+            num_correct += 1
+    return num_correct/len(tests), (time.time() - start)/len(tests)
+
 # MARK: Test Script
 
 if __name__ == '__main__':
+    # Compare parser backends: python reducer_helper.py allennlp int8 spacy
+    if sys.argv[1:]:
+        for backend in sys.argv[1:]:
+            before = resident_bytes()
+            predictor = load_predictor(backend)
+            loaded = resident_bytes() - before
+            weights = weight_bytes(predictor)
+            accuracy, seconds = agreement(predictor)
+            print("{}: TEST ACCURACY: {}, SECONDS PER SENTENCE: {}, "
+                    "WEIGHTS MB: {}, RESIDENT MB AFTER LOAD: {:.1f}".format(
+                backend, accuracy, seconds,
+                'n/a' if weights is None else '{:.1f}'.format(weights / 2**20),
+                loaded / 2**20))
+            del predictor
+        sys.exit()
+
     # Test our subject-verb accuracy
     with open('../test/data/sentences.json') as test_file:
         tests = json.load(test_file)
 
     test_sents = [(example["text"], example["subjects_with_verbs"]) for example in tests["sentences"]]
+    # PREDICTOR_BACKEND=record once, then PREDICTOR_BACKEND=replay runs this
+    # without the model
     predictor = load_predictor()
 
     num_correct = 0
+    fused_mismatches = 0
+    start = time.time()
     for (text, expected) in test_sents:
         pairs = test_pipeline(text, predictor)
         num_correct += evaluate_subjects_with_verbs(pairs, expected)
+        if get_reduction_components(text, predictor) != \
+                pairwise_reduction_components(text, predictor):
+            print("FUSED REDUCTIONS DIFFER !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            fused_mismatches += 1
         print("\n\n")
 
     print("TEST ACCURACY: ", num_correct/len(test_sents))
+    print("FUSED REDUCTION MISMATCHES: ", fused_mismatches)
+    print("SECONDS PER SENTENCE: ", (time.time() - start)/len(test_sents))
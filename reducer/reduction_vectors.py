@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Reductions as sparse count vectors, a row a sentence.
+
+A fixed vocabulary of reductions, a .npy of (mood id, vp id, np id) rows
+(VECTORIZER_VOCABULARY), gives reduction i column i, the ones not in it share
+the last column. VectorShards collects (sentence, index, reduction) in flat
+arrays and writes them out as CSR count matrices, scipy .npz shards, each with
+a .npy of the sentence keys of its rows (-1 for reductions that had none).
+Nothing is done a reduction at a time but appending three numbers.
+
+A shard can be bigger than what's held in memory: spill() moves what was
+collected to a spill file in the output directory, so the messages can be
+acked, and the next flush() puts the spills into the shard. Spills a dead
+process left behind are picked up by the next VectorShards on the directory.
+
+A sentence's reductions can be split over two shards, sum rows by key to put
+them back together. Repeats within a shard are dropped, but a sentence
+redelivered after a restart can be counted again in a later shard.
+
+Build a vocabulary from the most frequent reductions of an export (see
+export_reductions.py) with:
+
+    python reduction_vectors.py <export directory> <size> <vocabulary.npy>
+"""
+from array import array
+import numpy
+import os
+import re
+import scipy.sparse
+import sys
+
+ID_BITS = 21 # component ids are packed three to a uint64
+ID_LIMIT = 1 << ID_BITS
+
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def reduction_key(ids):
+    """(mood id, vp id, np id) => one int"""
+    m, vp, np = ids
+    if max(ids) >= ID_LIMIT:
+        raise ValueError('component id too large to pack, {}'.format(max(ids)))
+    return m << 2 * ID_BITS | vp << ID_BITS | np
+
+def reduction_keys(ids):
+    """(n, 3) array of component ids => n uint64 keys"""
+    ids = numpy.asarray(ids, dtype=numpy.uint64).reshape(-1, 3)
+    if len(ids) and ids.max() >= ID_LIMIT:
+        raise ValueError('component id too large to pack, {}'.format(ids.max()))
+    bits = numpy.uint64(ID_BITS)
+    return (ids[:, 0] << bits + bits) | (ids[:, 1] << bits) | ids[:, 2]
+
+def key_ids(keys):
+    """n uint64 keys => (n, 3) array of component ids"""
+    bits, mask = numpy.uint64(ID_BITS), numpy.uint64(ID_LIMIT - 1)
+    keys = numpy.asarray(keys, dtype=numpy.uint64)
+    return numpy.stack([keys >> bits + bits, (keys >> bits) & mask,
+        keys & mask], axis=1)
+
+
+class ReductionColumns():
+    """Maps reduction keys to vocabulary columns, a batch at a time"""
+    def __init__(self, path):
+        keys = reduction_keys(numpy.load(path))
+        self.size = len(keys) + 1 # and one for the rest
+        self.order = numpy.argsort(keys)
+        self.sorted_keys = keys[self.order]
+
+    def columns(self, keys):
+        if not len(self.sorted_keys):
+            return numpy.zeros(len(keys), dtype=numpy.int64)
+        positions = numpy.searchsorted(self.sorted_keys, keys)
+        positions = numpy.minimum(positions, len(self.sorted_keys) - 1)
+        found = self.sorted_keys[positions] == keys
+        return numpy.where(found, self.order[positions], self.size - 1)
+
+
+class VectorShards():
+    """Collects reductions and writes them as .npz shards of
+    max_reductions at most"""
+    def __init__(self, columns, directory, max_reductions):
+        self.columns = columns
+        self.directory = directory
+        self.max_reductions = max_reductions
+        self.written = 0
+        self.spills = [] # paths, in the order they were spilled
+        self.spilled = 0 # reductions in them
+        os.makedirs(directory, exist_ok=True)
+        self.forget()
+        self.adopt_spills()
+
+    def __len__(self):
+        return self.spilled + len(self.keys)
+
+    def spill_path(self, n):
+        return os.path.join(self.directory, 'spill_{}_{:06d}.npz'.format(
+            os.getpid(), n))
+
+    def adopt_spills(self):
+        """Take over the spills of processes that died before writing them"""
+        for name in sorted(os.listdir(self.directory)):
+            found = re.match(r'spill_(\d+)_\d+\.npz$', name)
+            if found is None or running(int(found.group(1))):
+                continue
+            path = self.spill_path(len(self.spills))
+            os.replace(os.path.join(self.directory, name), path)
+            self.spills.append(path)
+            with numpy.load(path) as spill:
+                self.spilled += len(spill['keys'])
+
+    def spill(self):
+        """Move what was collected to a spill file, returns its path (None if
+        there was nothing). It goes in the next shard"""
+        if not self.keys:
+            return None
+        path = self.spill_path(len(self.spills))
+        # renamed into place, a spill is there or it isn't
+        with open(path + '.tmp', 'wb') as f:
+            numpy.savez(f, rows=numpy.frombuffer(self.rows, dtype=numpy.int64),
+                    indexes=numpy.frombuffer(self.indexes, dtype=numpy.int64),
+                    keys=numpy.frombuffer(self.keys, dtype=numpy.uint64))
+        os.replace(path + '.tmp', path)
+        self.spills.append(path)
+        self.spilled += len(self.keys)
+        self.forget()
+        return path
+
+    def add(self, sentence_key, index, ids):
+        """Add a reduction, True once the shard is full"""
+        if sentence_key is None:
+            sentence_key = -1
+        if sentence_key == -1 or index is None:
+            index = -1 - len(self) # can't tell repeats, keep them all
+        self.rows.append(sentence_key)
+        self.indexes.append(index)
+        self.keys.append(reduction_key(ids))
+        return len(self) >= self.max_reductions
+
+    def collected(self):
+        """(rows, indexes, keys) of the spills and what's in memory"""
+        parts = []
+        for path in self.spills:
+            with numpy.load(path) as spill:
+                parts.append((spill['rows'], spill['indexes'], spill['keys']))
+        if self.keys:
+            parts.append((numpy.frombuffer(self.rows, dtype=numpy.int64),
+                numpy.frombuffer(self.indexes, dtype=numpy.int64),
+                numpy.frombuffer(self.keys, dtype=numpy.uint64)))
+        return [numpy.concatenate(arrays) for arrays in zip(*parts)]
+
+    def flush(self):
+        """Write what was collected (and spilled) as a shard, returns its path
+        (None if there was nothing)"""
+        if not len(self):
+            return None
+        rows, indexes, keys = self.collected()
+        # a reduction delivered twice is counted once
+        _, first = numpy.unique(numpy.stack([rows, indexes]), axis=1,
+                return_index=True)
+        row_keys, row_numbers = numpy.unique(rows[first], return_inverse=True)
+        counts = scipy.sparse.csr_matrix(
+                (numpy.ones(len(first), dtype=numpy.uint32),
+                    (row_numbers, self.columns.columns(keys[first]))),
+                shape=(len(row_keys), self.columns.size))
+        name = os.path.join(self.directory, 'vectors_{}_{:06d}'.format(
+            os.getpid(), self.written))
+        # the matrix last and renamed into place, a shard is there or it isn't
+        numpy.save(name + '_rows.npy', row_keys)
+        scipy.sparse.save_npz(name + '.tmp.npz', counts)
+        os.replace(name + '.tmp.npz', name + '.npz')
+        self.written += 1
+        for path in self.spills:
+            os.remove(path)
+        self.spills = []
+        self.spilled = 0
+        self.forget()
+        return name + '.npz'
+
+    def forget(self):
+        """Drop what's in memory, spills are kept"""
+        self.rows = array('q')
+        self.indexes = array('q')
+        self.keys = array('Q')
+
+
+def build_vocabulary(export_directory, size):
+    """The size most frequent reductions of an export, as (n, 3) ids"""
+    load = lambda name: numpy.load(os.path.join(export_directory, name + '.npy'),
+            mmap_mode='r')
+    keys = reduction_keys(numpy.stack([load('mood_id'), load('vp_id'),
+        load('np_id')], axis=1))
+    distinct, which = numpy.unique(keys, return_inverse=True)
+    totals = numpy.bincount(which, weights=load('count'))
+    top = numpy.argsort(-totals, kind='stable')[:size]
+    return key_ids(distinct[top]).astype(numpy.uint32)
+
+
+if __name__ == '__main__':
+    export_directory, size, path = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    vocabulary = build_vocabulary(export_directory, size)
+    numpy.save(path, vocabulary)
+    print('{} reductions in {}'.format(len(vocabulary), path))
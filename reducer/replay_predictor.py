@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Stand-ins for the AllenNLP predictor that replay recorded parses."""
+from hashlib import sha1
+import json
+import os
+
+
+def sentence_key(sentence):
+    """Key parses by a hash of the (preprocessed) sentence they're for"""
+    return sha1(sentence.encode('utf_8')).hexdigest()
+
+def load_parses(path):
+    """Load {sentence key: bracketed tree} from a file of recorded parses, one
+    json object per line"""
+    parses = {}
+    if not os.path.exists(path):
+        return parses
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                parse = json.loads(line)
+                parses[parse['key']] = parse['trees']
+    return parses
+
+
+class ReplayPredictor():
+    """Answers predict_json from recorded parses, no model needed.
+
+    Raises a KeyError for sentences that were never recorded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.parses = load_parses(path)
+
+    def predict_json(self, inputs):
+        key = sentence_key(inputs['sentence'])
+        if key not in self.parses:
+            raise KeyError('no recorded parse for sentence: {}'.format(
+                inputs['sentence']))
+        return {'trees': self.parses[key]}
+
+
+class RecordingPredictor():
+    """Wraps a real predictor, appending each new parse it makes to the file
+    ReplayPredictor reads"""
+    def __init__(self, predictor, path):
+        self.predictor = predictor
+        self.path = path
+        self.parses = load_parses(path)
+
+    def predict_json(self, inputs):
+        key = sentence_key(inputs['sentence'])
+        if key in self.parses:
+            return {'trees': self.parses[key]}
+        result = self.predictor.predict_json(inputs)
+        self.parses[key] = result['trees']
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'key': key, 'sentence': inputs['sentence'],
+                'trees': result['trees']}) + '\n')
+        return result
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Redo a job's reduction counts from its stored subject verb pairs.
+
+Usage: python rereduce.py [--mood] [--force] [--dry-run]
+
+After a change to the reduction rules (top100, literals, the noun phrase
+classes, tense codes) the pairs the reducer stored (see pair_store.py) are
+reduced again, no parsing. Reductions only depend on a pair's words, so each
+distinct verb phrase and subject is reduced once, across REREDUCE_PROCESSES
+processes, and the pairs are counted from those. Verb phrase reductions are
+kept in verb_phrase_reductions under the version of the rules that made them
+(see rules_version), only the phrases the current rules haven't reduced yet,
+for this job or another, are reduced. Moods are the stored ones unless
+--mood, which works them out again from the sentences (slower, it's per
+sentence).
+
+Only reduction_counts rows whose count changed are written (or deleted), in
+one transaction. Run it once the job's reduction writers are done. If the job
+counted more reductions than it has stored pairs (sentences reduced before
+pairs were kept), their counts would be lost, so it stops unless --force.
+"""
+from collections import Counter
+from connections import Database
+from itertools import islice
+from multiprocessing import Pool
+from pair_store import PairStore
+from psycopg2.extras import execute_values
+from subjects_with_verbs_to_reductions import get_mood, noun_phrase_reduction
+from subjects_with_verbs_to_reductions import rules_version, verb_phrase_reduction
+from vocabulary import ReductionVocabulary
+import json
+import os
+import sys
+import time
+
+try:
+    DB_NAME = os.environ.get('DB_NAME', 'nlp')
+    DB_PASSWORD = os.environ.get('DB_PASS', '')
+    DB_USER = os.environ.get('DB_USER', DB_NAME)
+    JOB_ID = os.environ['JOB_ID']
+    REREDUCE_PROCESSES = int(os.environ.get('REREDUCE_PROCESSES', os.cpu_count()))
+    REREDUCE_MOOD_BATCH = 10000 # sentences given to the pool at a time
+except KeyError as e:
+    raise Exception('important environment variables were not set')
+
+
+def reduce_distinct(pool, reduce, phrases):
+    """{phrase: reduction} for each distinct phrase"""
+    phrases = list(phrases)
+    chunksize = max(1, len(phrases) // (REREDUCE_PROCESSES * 4))
+    return dict(zip(phrases, pool.map(reduce, phrases, chunksize)))
+
+def upper_mood(sentence):
+    return get_mood(sentence).upper()
+
+def recount(store, pool, new_moods, known):
+    """({(mood, verb phrase, noun phrase): count}, {verb phrase: reduction} of
+    the ones that weren't known) from the stored pairs"""
+    # first pass, the distinct phrases
+    verb_phrases, subjects = set(), set()
+    for sentence_key, m, found in store.sentences():
+        for vw, sw in found:
+            verb_phrases.add(vw)
+            subjects.add(sw)
+    vp_reductions = {vw: known[phrase_key(vw)] for vw in verb_phrases
+            if phrase_key(vw) in known}
+    reduced = reduce_distinct(pool, verb_phrase_reduction,
+            verb_phrases.difference(vp_reductions))
+    vp_reductions.update(reduced)
+    np_reductions = {sw: noun_phrase_reduction(sw) for sw in subjects}
+    print('{} distinct verb phrases ({} new to these rules), {} distinct '
+            'subjects'.format(len(vp_reductions), len(reduced), len(np_reductions)))
+
+    # second pass, count
+    counts = Counter()
+    rows = store.sentences(with_text=new_moods)
+    if new_moods:
+        rows = with_new_moods(pool, rows)
+    for sentence_key, m, found in rows:
+        for vw, sw in found:
+            counts[(m, vp_reductions[vw], np_reductions[sw])] += 1
+    return counts, reduced
+
+def with_new_moods(pool, rows):
+    """(key, mood, pairs, sentence) rows => (key, new mood, pairs)"""
+    while True:
+        batch = list(islice(rows, REREDUCE_MOOD_BATCH))
+        if not batch:
+            return
+        moods = pool.map(upper_mood, [row[3] for row in batch],
+                max(1, len(batch) // (REREDUCE_PROCESSES * 4)))
+        for (key, old, found, sentence), m in zip(batch, moods):
+            yield key, m, found
+
+def phrase_key(words):
+    """A verb phrase's (word, label) tuples as they're kept, JSON"""
+    return json.dumps(words)
+
+def create_phrase_table(conn):
+    cur = conn.cursor()
+    # serialize, concurrent CREATE TABLE IF NOT EXISTS can still collide
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('verb_phrase_reductions'))")
+    cur.execute("""CREATE TABLE IF NOT EXISTS verb_phrase_reductions (
+                    rules_version text NOT NULL,
+                    phrase text NOT NULL,
+                    reduction text NOT NULL,
+                    PRIMARY KEY (rules_version, phrase)
+                )""")
+    conn.commit()
+    cur.close()
+
+def known_reductions(conn, version):
+    """{phrase key: reduction} of the verb phrases reduced under version"""
+    cur = conn.cursor(name='verb_phrase_reductions_{}'.format(JOB_ID))
+    cur.itersize = 10000
+    cur.execute("""SELECT phrase, reduction FROM verb_phrase_reductions
+                    WHERE rules_version=%s
+                """, (version,))
+    known = dict(cur)
+    cur.close()
+    conn.commit()
+    return known
+
+def save_reductions(conn, version, reduced):
+    """Keep the verb phrases just reduced, older rules' reductions go"""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM verb_phrase_reductions WHERE rules_version<>%s",
+            (version,))
+    execute_values(cur, """INSERT INTO verb_phrase_reductions
+                    (rules_version, phrase, reduction) VALUES %s
+                    ON CONFLICT (rules_version, phrase) DO NOTHING
+                """, [(version, phrase_key(vw), r) for vw, r in reduced.items()],
+                page_size=1000)
+    conn.commit()
+    cur.close()
+
+def current_counts(conn):
+    cur = conn.cursor()
+    cur.execute("""SELECT mood_id, vp_id, np_id, count FROM reduction_counts
+                    WHERE job_id=%s
+                """, (JOB_ID,))
+    counts = {tuple(row[:3]): row[3] for row in cur.fetchall()}
+    cur.close()
+    return counts
+
+def unstored_reductions(conn):
+    """Reductions the job's writers counted beyond its stored pairs, a pair
+    is one reduction"""
+    cur = conn.cursor()
+    cur.execute("""SELECT (SELECT coalesce(sum(count), 0) FROM reduction_counts
+                            WHERE job_id=%(job_id)s)
+                        - (SELECT coalesce(sum(jsonb_array_length(pairs)), 0)
+                            FROM sentence_pairs WHERE job_id=%(job_id)s)
+                """, {'job_id': JOB_ID})
+    n = cur.fetchone()[0]
+    cur.close()
+    return max(n, 0)
+
+def write_changes(conn, old, new):
+    """Make reduction_counts new, touching only the rows that differ"""
+    changed = [(JOB_ID,) + ids + (n,) for ids, n in new.items() if old.get(ids) != n]
+    removed = [ids for ids in old if ids not in new]
+    cur = conn.cursor()
+    if removed:
+        cur.execute("""DELETE FROM reduction_counts
+                        WHERE job_id=%s AND (mood_id, vp_id, np_id) IN %s
+                    """, (JOB_ID, tuple(removed)))
+    if changed:
+        execute_values(cur, """INSERT INTO reduction_counts
+                        (job_id, mood_id, vp_id, np_id, count) VALUES %s
+                        ON CONFLICT (job_id, mood_id, vp_id, np_id)
+                        DO UPDATE SET count=EXCLUDED.count
+                    """, changed, page_size=1000)
+    conn.commit()
+    cur.close()
+    return len(changed), len(removed)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    # fork the pool before connecting, it doesn't need the database
+    pool = Pool(REREDUCE_PROCESSES)
+    conn = Database(DB_NAME, DB_USER, DB_PASSWORD)
+    store = PairStore(conn, JOB_ID)
+    vocabulary = ReductionVocabulary(conn)
+
+    missing = unstored_reductions(conn)
+    if missing:
+        print('{} counted reductions have no stored pairs'.format(missing))
+        if '--force' not in args:
+            sys.exit('their counts would be lost, --force to go ahead anyway')
+
+    create_phrase_table(conn)
+    version = rules_version()
+    start = time.time()
+    counts, reduced = recount(store, pool, '--mood' in args,
+            known_reductions(conn, version))
+    pool.close()
+    print('reduced {} pairs of {} sentences in {:.0f}s'.format(
+        sum(counts.values()), store.count(), time.time() - start))
+
+    new = Counter()
+    for components, n in counts.items():
+        new[vocabulary.encode(components)] += n
+    old = current_counts(conn)
+    if '--dry-run' in args:
+        print('{} reduction counts would change, {} would go'.format(
+            sum(1 for ids, n in new.items() if old.get(ids) != n),
+            sum(1 for ids in old if ids not in new)))
+        sys.exit()
+    changed, removed = write_changes(conn, old, new)
+    save_reductions(conn, version, reduced)
+    print('{} reduction counts changed, {} removed, {} unchanged'.format(
+        changed, removed, len(new) - changed))
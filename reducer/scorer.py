@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future
+from cpu_budget import apply_budget
+from frequency_index import FrequencyIndex
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from reducer_helper import batch_reduction_components, get_reduction_components
+from reducer_helper import load_predictor
+from socketserver import ThreadingMixIn
+from vocabulary import format_reduction
+import json
+import logging
+import math
+import os
+import queue
+import socket
+import threading
+import time
+
+FNAME=os.path.basename(__file__)
+PID=os.getpid()
+HOST=socket.gethostname()
+
+# set up logging
+log_filename='scorer_{}.log'.format(os.getpid())
+log_format = '%(levelname)s %(asctime)s {pid} {filename} %(lineno)d %(message)s'.format(
+        pid=PID, filename=FNAME)
+logging.basicConfig(format=log_format,
+    filename='/var/log/scorerlogs/{}'.format(log_filename),
+    datefmt='%Y-%m-%dT%H:%M:%S%z',
+    level=logging.INFO)
+logger = logging.getLogger('scorer')
+
+try:
+    # sentences parsed together at most, and how long (seconds) the first
+    # waits for company
+    SCORER_BATCH_SIZE = int(os.environ.get('SCORER_BATCH_SIZE', 16))
+    SCORER_BATCH_WAIT = float(os.environ.get('SCORER_BATCH_WAIT', 0.005))
+    SCORER_INDEX = os.environ['SCORER_INDEX']
+    SCORER_PORT = int(os.environ.get('SCORER_PORT', 8080))
+except KeyError as e:
+    logger.critical('important environment variables were not set')
+    raise Exception('Warning: Important environment variables were not set')
+
+# Scores sentences for subject verb agreement errors over HTTP.
+#
+#   POST /score {"sentences": ["He go home.", ...]}
+#
+# returns each sentence's reductions, with how often each was seen in the
+# job's corpus (see frequency_index.py), and an anomaly score, the surprisal
+# (bits) of its least likely reduction given its mood and subject. A verb
+# phrase that's rare for its subject scores high. GET /health returns the
+# index's totals.
+#
+# The predictor is loaded once and kept warm. Sentences from requests that
+# arrive together are parsed as one batch. Run several scorers on a box
+# through cpu_budget.py, they share the port and the index's pages.
+
+
+def score(components):
+    count = index.reduction_count(components)
+    context = index.context_count(components)
+    # add one smoothing over every verb phrase the context could have had
+    surprisal = -math.log2((count + 1) / (context + index.verb_phrases + 1))
+    return {'reduction': format_reduction(components), 'count': count,
+            'context_count': context, 'surprisal': round(surprisal, 3)}
+
+def score_sentence(sentence, reductions):
+    scored = [score(components) for components in reductions]
+    return {'sentence': sentence, 'reductions': scored,
+            'anomaly': max((s['surprisal'] for s in scored), default=None)}
+
+
+class Batcher():
+    """Hands sentences to the predictor in batches, from one thread"""
+    def __init__(self, predictor, size, wait):
+        self.predictor = predictor
+        self.size = size
+        self.wait = wait
+        self.pending = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def reductions(self, sentences):
+        """Reduction components for each sentence, waits for their batch"""
+        futures = []
+        for sentence in sentences:
+            future = Future()
+            self.pending.put((sentence, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time.time() + self.wait
+        while len(batch) < self.size:
+            try:
+                batch.append(self.pending.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            sentences = [sentence for sentence, future in batch]
+            try:
+                results = batch_reduction_components(sentences, self.predictor)
+            except Exception as e:
+                # one at a time, so only the sentence at fault fails
+                logger.warning('problem reducing a batch, {}'.format(e))
+                results = []
+                for sentence in sentences:
+                    try:
+                        results.append(get_reduction_components(sentence,
+                            self.predictor))
+                    except Exception as e:
+                        results.append(e)
+            for (sentence, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_error(404)
+        self.reply(200, {'reductions': index.reductions, 'seen': index.total,
+            'verb_phrases': index.verb_phrases})
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self.send_error(404)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            sentences = request['sentences'] if 'sentences' in request \
+                    else [request['sentence']]
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {'error': 'expected {{"sentences": [...]}}, {}'
+                .format(e)})
+        start = time.time()
+        try:
+            reductions = batcher.reductions(sentences)
+        except Exception as e:
+            logger.error('problem reducing {}, {}'.format(sentences, e))
+            return self.reply(422, {'error': 'could not reduce, {}'.format(e)})
+        self.reply(200, {'scores': [score_sentence(sentence, found)
+            for sentence, found in zip(sentences, reductions)],
+            'ms': round(1000 * (time.time() - start), 1)})
+
+    def reply(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+class ScoreServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # scorers started together all listen on the port, the kernel spreads
+        # connections between them
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+
+if __name__ == '__main__':
+    # within this worker's share of the cpu, see cpu_budget.py
+    apply_budget()
+    index = FrequencyIndex(SCORER_INDEX)
+    batcher = Batcher(load_predictor(), SCORER_BATCH_SIZE, SCORER_BATCH_WAIT)
+    server = ScoreServer(('', SCORER_PORT), ScoreHandler)
+    logger.info('scoring on port {} with {} reductions'.format(SCORER_PORT,
+        index.reductions))
+    server.serve_forever()
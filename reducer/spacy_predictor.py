@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A fast, less accurate stand-in for the AllenNLP constituency parser.
+
+Parses with spacy's dependency parser and converts the dependencies into the
+bracketed, Penn Treebank style tree the verb_subject_for_* functions expect:
+clauses with a subject become (S (NP ..) (VP ..)), relative clauses with a
+wh-subject (SBAR (WHNP ..) (S ..)), prepositions (PP ..) and so on.
+"""
+import spacy
+
+SUBJECT_DEPS = ['nsubj', 'nsubjpass', 'expl']
+CLAUSAL_SUBJECT_DEPS = ['csubj', 'csubjpass']
+AUX_DEPS = ['aux', 'auxpass', 'neg']
+NOUN_POS = ['NOUN', 'PROPN', 'PRON', 'DET', 'NUM']
+PHRASE_LABELS = {'ADJ': 'ADJP', 'ADV': 'ADVP', 'ADP': 'PP'}
+
+
+def is_verb(token):
+    return token.tag_.startswith('VB') or token.tag_ == 'MD'
+
+def leaf(token):
+    text = token.text.replace('(', '-LRB-').replace(')', '-RRB-')
+    tag = token.tag_.replace('(', '-LRB-').replace(')', '-RRB-')
+    return '({} {})'.format(tag or 'X', text)
+
+def bracket(label, children):
+    return '({} {})'.format(label, ' '.join(children))
+
+
+def flatten(token):
+    """Leaves of the token's subtree in order, prepositions and clauses kept
+    as phrases so their words don't count as part of a noun phrase"""
+    parts = []
+    for child in token.lefts:
+        parts += phrase_in_flat(child)
+    parts.append(leaf(token))
+    for child in token.rights:
+        parts += phrase_in_flat(child)
+    return parts
+
+def phrase_in_flat(token):
+    if token.dep_ == 'prep':
+        return [prepositional_phrase(token)]
+    if is_verb(token):
+        return [clause(token)]
+    return flatten(token)
+
+def noun_phrase(token):
+    return bracket('NP', flatten(token))
+
+def prepositional_phrase(token):
+    parts = [leaf(token)]
+    for child in token.children:
+        if is_verb(child):
+            parts.append(clause(child))
+        elif child.dep_ == 'pobj':
+            parts.append(noun_phrase(child))
+        else:
+            parts += flatten(child)
+    return bracket('PP', parts)
+
+def phrase(token):
+    """A dependent of a verb, as a phrase that won't be mistaken for verbs"""
+    if is_verb(token):
+        return clause(token)
+    if token.dep_ == 'prep':
+        return prepositional_phrase(token)
+    if token.pos_ in NOUN_POS:
+        return noun_phrase(token)
+    if token.pos_ in PHRASE_LABELS or len(list(token.subtree)) > 1:
+        return bracket(PHRASE_LABELS.get(token.pos_, 'X'), flatten(token))
+    return leaf(token)
+
+def subject_phrase(token):
+    """Gerunds and infinitives as subjects are clauses: (S (VP ..))"""
+    if is_verb(token):
+        return bracket('S', [verb_phrase(token)])
+    return noun_phrase(token)
+
+def verb_phrase(verb):
+    """The verb with its auxiliaries and objects, coordinated verbs sharing its
+    subject become sibling verb phrases: (VP (VP ..) (CC and) (VP ..))"""
+    parts, conjuncts = [], []
+    for token in sorted(list(verb.children) + [verb], key=lambda t: t.i):
+        if token != verb and (token.dep_ in SUBJECT_DEPS + CLAUSAL_SUBJECT_DEPS
+                or token.dep_ == 'punct'):
+            continue
+        if token == verb or token.dep_ in AUX_DEPS:
+            parts.append(leaf(token))
+        elif token.dep_ == 'conj' and is_verb(token) and not has_subject(token):
+            conjuncts.append(verb_phrase(token))
+        elif token.dep_ == 'conj' and is_verb(token):
+            continue # its own clause, a sibling of ours
+        elif token.dep_ == 'cc' and any(c.dep_ == 'conj' and is_verb(c)
+                for c in verb.children):
+            conjuncts.append(leaf(token))
+        else:
+            parts.append(phrase(token))
+    vp = bracket('VP', parts)
+    if conjuncts:
+        return bracket('VP', [vp] + conjuncts)
+    return vp
+
+def has_subject(verb):
+    return any(c.dep_ in SUBJECT_DEPS + CLAUSAL_SUBJECT_DEPS for c in verb.children)
+
+def clause(verb):
+    """A clause headed by verb, (S (NP ..) (VP ..)) if it has a subject"""
+    subject = [c for c in verb.children if c.dep_ in SUBJECT_DEPS]
+    clausal_subject = [c for c in verb.children if c.dep_ in CLAUSAL_SUBJECT_DEPS]
+    siblings = [clause(c) for c in verb.children
+            if c.dep_ == 'conj' and is_verb(c) and has_subject(c)]
+    punct = [leaf(c) for c in verb.rights if c.dep_ == 'punct']
+    vp = verb_phrase(verb)
+    if subject and subject[0].tag_.startswith('W') and verb.dep_ in ['relcl', 'acl']:
+        return bracket('SBAR', [bracket('WHNP', flatten(subject[0])),
+            bracket('S', [vp])])
+    if subject:
+        return bracket('S', [subject_phrase(subject[0]), vp] + siblings + punct)
+    if clausal_subject:
+        return bracket('S', [subject_phrase(clausal_subject[0]), vp] +
+                siblings + punct)
+    return bracket('S', [vp] + siblings + punct)
+
+def sentence_tree(sent):
+    root = sent.root
+    if is_verb(root):
+        return clause(root)
+    return bracket('NP', flatten(root))
+
+
+class SpacyPredictor():
+    """predict_json compatible wrapper around a spacy model"""
+    def __init__(self, model='en_core_web_sm'):
+        self.nlp = spacy.load(model)
+
+    def predict_json(self, inputs):
+        sents = [sentence_tree(s) for s in self.nlp(inputs['sentence']).sents]
+        if len(sents) == 1:
+            return {'trees': sents[0]}
+        return {'trees': bracket('S', sents)}
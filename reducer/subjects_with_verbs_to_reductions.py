@@ -1,23 +1,42 @@
 import json
 from collections import Counter
+from functools import lru_cache
+from hashlib import blake2b
 from pattern.en import mood,lemma,tenses
-from hashlib import sha256
+from tense_codes import tense_code, TENSE_INVENTORY
+from vocabulary import format_reduction
 import top100
 import literals
+import tense_codes
 
 TEST_DATA='../test/data/sentences.json'
 
+# noun phrase classes by the labels of their words. LITERAL means the word
+# itself (upper case) is the class
+LITERAL = object()
+NOUN_PHRASE_OTHER = 'OTHER' # phrases none of the classes fit
+NOUN_PHRASE_CLASSES = {
+    ('NN',): 'SG', ('NNP',): 'SG', # a singular noun
+    ('NNS',): 'PL', ('NNPS',): 'PL', # a plural noun
+    ('DT',): LITERAL, # a single determiner
+    ('PRP',): LITERAL, # a single pronoun
+    ('JJ',): 'MOD', ('RB',): 'MOD', # a single adjective or adverb
+    ('VBG',): 'VBG', # a single gerund
+}
+NOUN_AND_PRONOUN_TAGS = frozenset(['PRP','NN','NNP','NNS','NNPS'])
+MODIFIER_TAGS = frozenset(['JJ', 'RB'])
+
+@lru_cache(maxsize=100000)
 def get_verb_reduction(verb, tag):
     """Given string of existing verb, returns its corresponding reduction
-    That's the verb itself if its lemma is in the top100, else its hash"""
+    That's the verb itself if its lemma is in the top100, else the code of
+    its tenses"""
     if lemma(verb.lower()) in literals.verbs:
         return verb.upper()
     if lemma(verb.lower()) in top100.verbs:
         return verb.upper()
     else:
-        h = sha256(str(tenses(verb)).encode('utf_8')).hexdigest()
-        result = tag + '_' + h
-        return result
+        return tag + '_' + tense_code(verb)
 
 
 def get_mood(sentence):
@@ -37,51 +56,68 @@ def get_mood(sentence):
         return 'subjunctive'
     return 'nonconditional' # indicative
 
+def word_tuples(word_list):
+    """[{'word': .., 'label': ..}, ...] => [(word, label), ...]"""
+    return [(w['word'], w['label']) for w in word_list]
+
+def verb_phrase_reduction(words):
+    """Given the (word, label) tuples of a verb phrase, returns its reduction"""
+    return ':'.join([get_verb_reduction(word, label) for word, label in words])
+
+@lru_cache(maxsize=10000)
+def noun_phrase_class(labels):
+    """Class of a noun phrase with words labelled labels (a tuple), LITERAL or
+    NOUN_PHRASE_OTHER if it's none of them"""
+    if labels in NOUN_PHRASE_CLASSES:
+        return NOUN_PHRASE_CLASSES[labels]
+    if len(labels) > 1:
+        label_set = set(labels)
+        # THEYLIKE, filled with nouns and pronouns
+        if label_set <= NOUN_AND_PRONOUN_TAGS:
+            return 'THEYLIKE'
+        # MODS, filled with adverbs and adjectives
+        if label_set <= MODIFIER_TAGS:
+            return 'MODS'
+        # INF, an infinitive, maybe followed by gerunds
+        if labels[:2] == ('TO', 'VB') and set(labels[2:]) <= {'VBG'}:
+            return 'INF'
+    return NOUN_PHRASE_OTHER
+
+def noun_phrase_reduction(words):
+    """Given the (word, label) tuples of a noun phrase, returns its reduction"""
+    c = noun_phrase_class(tuple(label for word, label in words))
+    if c is LITERAL:
+        return words[0][0].upper()
+    return c
+
+def rules_version():
+    """A hash of what verb phrase reductions depend on, the modules with the
+    rules and pattern's tense table. It changes whenever a phrase's reduction
+    could, see rereduce.py"""
+    h = blake2b(digest_size=16)
+    for path in (__file__, top100.__file__, literals.__file__, tense_codes.__file__):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(repr(TENSE_INVENTORY).encode('utf-8'))
+    return h.hexdigest()
+
 def get_verb_phrase_reduction(verb_phrase_word_list):
-    rl = [get_verb_reduction(vpw['word'], vpw['label']) for vpw in
-            verb_phrase_word_list]
-    return ':'.join(rl)
+    return verb_phrase_reduction(word_tuples(verb_phrase_word_list))
 
 def get_noun_phrase_reduction(noun_phrase_word_list):
-    npwl = noun_phrase_word_list
-    # SG, list len is 1, a singular noun
-    if (len(npwl) == 1 and npwl[0]['label'] in
-            ['NN', 'NNP']):
-        return 'SG'
-    # PL, list len is 1, a plural noun
-    elif len(npwl) == 1 and npwl[0]['label'] in ['NNS','NNPS']:
-        return 'PL'
-    # THEYLIKE, list len > 1 and is filled with nouns and pronouns
-    elif len(npwl) > 1 and all(npw['label'] in ['PRP','NN','NNP','NNS','NNPS'] for npw in npwl):
-        return 'THEYLIKE'
-    # <determiner literal>, list len is 1, a single determiner
-    elif len(npwl) == 1 and npwl[0]['label'] == 'DT':
-        return npwl[0]['word'].upper()
-    # <pronoun literal>, list len is 1, a single pronoun
-    elif len(npwl) == 1 and npwl[0]['label'] == 'PRP':
-        return npwl[0]['word'].upper()
-    # MOD, list len is 1, a single adjective or adverb
-    elif len(npwl) == 1 and npwl[0]['label'] in ['JJ', 'RB']:
-        return 'MOD'
-    # MODS, list len > 1 and is filled with adverbs and adjectives
-    elif len(npwl) > 1 and all(npw['label'] in ['JJ', 'RB'] for npw in npwl):
-        return 'MODS'
-    # VBG, list len is 1, a single gerund
-    elif len(npwl) == 1 and npwl[0]['label'] == 'VBG':
-        return 'VBG'
-    # INF, list len is >= 2, a single infinitive
-    elif (len(npwl) >= 2 and npwl[0]['label'] == 'TO' and
-            npwl[1]['label'] == 'VB' and
-            all(npw['label'] == 'VBG' for npw in npwl[2:])):
-        return 'INF'
+    return noun_phrase_reduction(word_tuples(noun_phrase_word_list))
 
 
-def get_reduction(subject_with_verb, sentence):
-    result = "{m}-{vp}>{np}"
+def get_reduction_components(subject_with_verb, sentence):
+    """Returns (mood, verb phrase, noun phrase) reductions of the pair"""
     m = get_mood(sentence).upper()
     vp = get_verb_phrase_reduction(subject_with_verb['vp'])
     np = get_noun_phrase_reduction(subject_with_verb['np'])
-    return result.format(m=m, vp=vp, np=np)
+    return m, vp, np
+
+def get_reduction(subject_with_verb, sentence):
+    return format_reduction(get_reduction_components(subject_with_verb,
+        sentence))
 
 
 #########################
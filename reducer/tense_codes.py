@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Short, stable codes for the tense signature (pattern's tenses()) of verbs
+outside the top 100."""
+from functools import lru_cache
+from hashlib import sha256
+from pattern.en import tenses
+from pattern.text import TENSES
+import re
+import sys
+import zlib
+
+
+def tense_inventory(table):
+    """Every distinct (tense, person, number, mood, aspect) in pattern's tense
+    table, the tuples tenses() returns, in id order. Negated tenses differ
+    from the plain ones only in fields tenses() drops, they're left out"""
+    inventory = []
+    for id in sorted(id for id in table if id is not None):
+        tense = table[id][:-2]
+        if tense not in inventory:
+            inventory.append(tense)
+    return inventory
+
+# A signature is coded as a bitmask over this, so the order is part of every
+# stored reduction. pattern only ever adds tense ids, new tenses get new bits.
+TENSE_INVENTORY = tense_inventory(TENSES)
+# built once, tense => its bit in the signature code
+TENSE_BITS = {tense: 1 << i for i, tense in enumerate(TENSE_INVENTORY)}
+# the old reductions, <tag>_<sha256 of str(tenses(verb))>
+LEGACY_CODE_RE = re.compile(r'\b([A-Z]{2,3})_([0-9a-f]{64})\b')
+
+
+def signature_code(signature):
+    """Given a list of tenses, return its code. That's the bitmask of the
+    tenses in hex, or an x and the crc32 of the signature if any of its tenses
+    aren't in the inventory (a pattern that doesn't match its own table), so
+    two signatures never share a code"""
+    mask = 0
+    for tense in signature:
+        if tense not in TENSE_BITS:
+            key = repr(sorted(tuple(signature), key=repr)).encode('utf_8')
+            return 'x{:08x}'.format(zlib.crc32(key))
+        mask |= TENSE_BITS[tense]
+    return '{:x}'.format(mask)
+
+@lru_cache(maxsize=100000)
+def tense_code(verb):
+    """Return the code of the verb's tense signature, cached per verb"""
+    return signature_code(tenses(verb))
+
+def legacy_codes():
+    """Return {sha256 hexdigest: code} for every signature of every verb form
+    pattern knows, to migrate reductions made before tense codes"""
+    from pattern.en import lexeme, verbs
+    codes = {}
+    for infinitive in verbs.infinitives:
+        for form in lexeme(infinitive):
+            signature = tenses(form)
+            h = sha256(str(signature).encode('utf_8')).hexdigest()
+            codes[h] = signature_code(signature)
+    return codes
+
+def migrate(path):
+    """Rewrite the legacy verb hashes in a file (like the test data) as
+    tense codes. Returns the hashes it didn't know"""
+    codes = legacy_codes()
+    unknown = set()
+    def repl(match):
+        tag, h = match.groups()
+        if h not in codes:
+            unknown.add(h)
+            return match.group(0)
+        return tag + '_' + codes[h]
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        f.write(LEGACY_CODE_RE.sub(repl, text))
+    return unknown
+
+
+if __name__ == '__main__':
+    print('{} tenses in TENSE_INVENTORY'.format(len(TENSE_INVENTORY)))
+    for path in sys.argv[1:]:
+        print(path, 'unknown hashes:', migrate(path))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Find the REDUCER_WORKERS x REDUCER_THREADS that parse fastest on this box.
+
+Usage: python thread_sweep.py [seconds] [workersxthreads ...]
+
+e.g. python thread_sweep.py 60 8x1 4x2 2x4. Without settings it tries every
+power of two threads a worker, with as many workers as fit the cores. Each
+setting starts its workers the way cpu_budget.py does (REDUCER_PIN_CORES
+applies), waits for them all to load the model, lets them parse the test
+sentences for the given seconds (120 by default) and adds up their sentences a
+second. The parser is whatever PREDICTOR_BACKEND says, so this should be run
+with the model the reducers use.
+"""
+from cpu_budget import apply_budget, usable_cores, worker_env
+import json
+import subprocess
+import sys
+import time
+
+TEST_PATH = '../test/data/sentences.json'
+SWEEP_SECONDS = 120
+
+
+def settings(cores):
+    """(workers, threads) for each power of two threads, cores all in use"""
+    threads = 1
+    while threads <= cores:
+        yield cores // threads, threads
+        threads *= 2
+
+def sweep(workers, threads, seconds, cores):
+    """Sentences a second all workers parsed together"""
+    processes = [subprocess.Popen([sys.executable, __file__, '--worker',
+        str(seconds)], env=worker_env(i, threads, cores),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        for i in range(workers)]
+    # start timing once every worker has the model loaded
+    for process in processes:
+        process.stdout.readline()
+    for process in processes:
+        process.stdin.write('go\n')
+        process.stdin.flush()
+    return sum(float(process.communicate()[0]) for process in processes)
+
+def worker(seconds):
+    """Parse test sentences for seconds, print sentences a second"""
+    apply_budget()
+    from reducer_helper import load_predictor, sentence_tree
+    predictor = load_predictor()
+    with open(TEST_PATH) as test_file:
+        sentences = [s['text'] for s in json.load(test_file)['sentences']]
+    sentence_tree(sentences[0], predictor) # warm up
+    print('ready', flush=True)
+    sys.stdin.readline()
+    parsed, start = 0, time.time()
+    while time.time() - start < seconds:
+        sentence_tree(sentences[parsed % len(sentences)], predictor)
+        parsed += 1
+    print(parsed / (time.time() - start))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        worker(float(sys.argv[2]))
+        sys.exit()
+    seconds = float(sys.argv[1]) if sys.argv[1:] else SWEEP_SECONDS
+    cores = usable_cores()
+    to_try = [tuple(int(n) for n in s.split('x')) for s in sys.argv[2:]] or \
+            list(settings(len(cores)))
+    results = []
+    for workers, threads in to_try:
+        rate = sweep(workers, threads, seconds, cores)
+        print('{} workers x {} threads: {:.2f} sentences/s'.format(
+            workers, threads, rate), flush=True)
+        results.append((rate, workers, threads))
+    rate, workers, threads = max(results)
+    print('BEST: REDUCER_WORKERS={} REDUCER_THREADS={} ({:.2f} sentences/s)'
+            .format(workers, threads, rate))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Reductions straight from a parse tree, in one walk.
+
+Same rules as reducer_helper.get_verb_subject_phrases and
+subjects_with_verbs_to_reductions, and the same pairs in the same order, but
+the tree is walked once (not once per clause label), words are (word, label)
+tuples rather than dicts, and mood is worked out once a sentence rather than
+once a pair. reducer_helper's __main__ checks the two give the same
+reductions on the test sentences.
+"""
+from subjects_with_verbs_to_reductions import (get_mood, noun_phrase_reduction,
+        verb_phrase_reduction)
+
+# in the order reducer_helper.get_verb_subject_phrases collects them
+CLAUSE_LABELS = ('S', 'SQ', 'SBARQ', 'SBAR', 'FRAG', 'SINV')
+VERB_TAGS = frozenset(['MD', 'VB', 'VBZ', 'VBP', 'VBD', 'VBN', 'VBG'])
+VERB_WORD_TAGS = VERB_TAGS | {'TO'}
+NOUN_TAGS = frozenset(['PRP', 'NN', 'NNP', 'NNS', 'NNPS'])
+ADJ_TAGS = frozenset(['JJ', 'JJR', 'JJS'])
+
+
+def clauses_by_label(tree):
+    """{label: [subtrees]} for CLAUSE_LABELS, each list in the order
+    Tree.subtrees() would give them (pre-order)"""
+    clauses = {label: [] for label in CLAUSE_LABELS}
+    stack = [tree]
+    while stack:
+        t = stack.pop()
+        found = clauses.get(t.label())
+        if found is not None:
+            found.append(t)
+        stack.extend(child for child in reversed(t) if not isinstance(child, str))
+    return clauses
+
+def verb_words(vp):
+    """reducer_helper.verb_words_from_phrase, as (word, label) tuples"""
+    words = []
+    for child in vp:
+        label = child.label()
+        if label in VERB_WORD_TAGS:
+            words.append((child[0], label))
+        elif label == 'VP':
+            words += verb_words(child)
+    return words
+
+def subject_words(subject):
+    """reducer_helper.subject_words_from_phrase, as (word, label) tuples"""
+    if subject.label() == 'S':
+        return verb_words(subject)
+    if len(subject) == 1 and subject[0].label() == 'DT':
+        return [(subject[0][0], 'DT')]
+    noun_words, adj_words = [], []
+    for child in subject:
+        label = child.label()
+        if label == 'NP':
+            noun_words += subject_words(child)
+        elif label in NOUN_TAGS:
+            noun_words.append((child[0], label))
+        elif label in ADJ_TAGS:
+            adj_words.append((child[0], label))
+    return noun_words if noun_words else adj_words
+
+def declarative_pairs(clause):
+    np, s_child, vps = None, None, []
+    for child in clause:
+        label = child.label()
+        if label == 'NP':
+            np = child
+        elif label == 'S':
+            s_child = child
+        elif label == 'VP':
+            nested = [c for c in child if c.label() == 'VP']
+            vps += nested if len(nested) > 1 else [child]
+    subject = np if np is not None else s_child
+    if subject is None or not vps:
+        return []
+    words = subject_words(subject)
+    return [(verb_words(vp), words) for vp in vps]
+
+def sq_pairs(clause):
+    np = None
+    for child in clause:
+        if child.label() == 'NP':
+            np = child
+    if np is None:
+        return []
+    return [(verb_words(clause), subject_words(np))]
+
+def sbarq_pairs(clause):
+    for i in range(len(clause) - 1):
+        wh, sq = clause[i], clause[i + 1]
+        if wh.label() == 'WHNP' and sq.label() == 'SQ':
+            words = subject_words(wh)
+            if words:
+                return [(verb_words(sq), words)]
+    return []
+
+def sbar_pairs(clause):
+    for i in range(len(clause) - 1):
+        whnp, s = clause[i], clause[i + 1]
+        if whnp.label() == 'WHNP' and s.label() == 'S':
+            words = subject_words(whnp)
+            if words:
+                return [(verb_words(s), words)]
+    return []
+
+def sinv_pairs(clause):
+    for i in range(len(clause)):
+        if clause[i].label() == 'NP':
+            for j in reversed(range(i)):
+                label = clause[j].label()
+                if label == 'VP':
+                    return [(verb_words(clause[j]), subject_words(clause[i]))]
+                if label in VERB_TAGS:
+                    return [([(clause[j][0], label)], subject_words(clause[i]))]
+    return []
+
+PAIRS_FOR = {
+    'S': declarative_pairs,
+    'SQ': sq_pairs,
+    'SBARQ': sbarq_pairs,
+    'SBAR': sbar_pairs,
+    'FRAG': declarative_pairs,
+    'SINV': sinv_pairs,
+}
+
+def pairs(tree):
+    """(verb words, subject words) for each subject verb pair in the tree"""
+    clauses = clauses_by_label(tree)
+    found = []
+    for label in CLAUSE_LABELS:
+        pairs_for = PAIRS_FOR[label]
+        for clause in clauses[label]:
+            found += pairs_for(clause)
+    return found
+
+def sentence_mood(found, sentence):
+    """Mood of the sentence with pairs found, None without pairs (it's only
+    needed for them)"""
+    return get_mood(sentence).upper() if found else None
+
+def pair_reductions(found, m):
+    """(mood, verb phrase, noun phrase) for each of the pairs found"""
+    return [(m, verb_phrase_reduction(vw), noun_phrase_reduction(sw))
+            for vw, sw in found]
+
+def tree_reductions(tree, sentence):
+    """(mood, verb phrase, noun phrase) for each pair in the tree of sentence"""
+    found = pairs(tree)
+    return pair_reductions(found, sentence_mood(found, sentence))
+
+def batch_reductions(trees, sentences):
+    """tree_reductions for each (tree, sentence), as a list of lists"""
+    return [tree_reductions(tree, sentence)
+            for tree, sentence in zip(trees, sentences)]
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from connections import Rabbit
+from reduction_vectors import ReductionColumns, VectorShards
+from vocabulary import decode_reduction_ids, REDUCTION_IDS_CONTENT_TYPE
+from wire import encode_text
+import logging
+import os
+import socket
+
+FNAME=os.path.basename(__file__)
+PID=os.getpid()
+HOST=socket.gethostname()
+
+# set up logging
+log_filename='vectorizer_{}.log'.format(os.getpid())
+log_format = '%(levelname)s %(asctime)s {pid} {filename} %(lineno)d %(message)s'.format(
+        pid=PID, filename=FNAME)
+logging.basicConfig(format=log_format,
+    filename='/var/log/vectorizerlogs/{}'.format(log_filename),
+    datefmt='%Y-%m-%dT%H:%M:%S%z',
+    level=logging.INFO)
+logger = logging.getLogger('vectorizer')
+
+try:
+    JOB_NAME = os.environ['JOB_NAME']
+    PRE_VECTORS_BASE = os.environ['PRE_VECTORS_QUEUE_BASE']
+    PRE_VECTORS_QUEUE = PRE_VECTORS_BASE + '_' + JOB_NAME
+    RABBIT = os.environ.get('RABBITMQ_LOCATION', 'localhost')
+    VECTORIZER_FLUSH_INTERVAL = int(os.environ.get('VECTORIZER_FLUSH_INTERVAL', 60))
+    VECTORIZER_OUTPUT_DIR = os.environ.get('VECTORIZER_OUTPUT_DIR', 'vectors')
+    # unacked reductions at most, they're spilled to disk and acked when
+    # there are this many. basic.qos takes 65535 at most
+    VECTORIZER_PREFETCH_COUNT = min(int(os.environ.get('VECTORIZER_PREFETCH_COUNT',
+        1000)), 65535)
+    # reductions a shard holds at most, whatever the prefetch
+    VECTORIZER_SHARD_SIZE = int(os.environ.get('VECTORIZER_SHARD_SIZE', 100000))
+    VECTORIZER_VOCABULARY = os.environ['VECTORIZER_VOCABULARY']
+    VECTORS_BASE = os.environ['VECTORS_QUEUE_BASE']
+    VECTORS_QUEUE = VECTORS_BASE + '_' + JOB_NAME
+except KeyError as e:
+    logger.critical('important environment variables were not set')
+    raise Exception('Warning: Important environment variables were not set')
+
+# Turns reductions into sparse count matrices, see reduction_vectors.py.
+# Reducers publish a copy of each reduction to pre-vectors when
+# VECTORIZER_MODE=queue. (With VECTORIZER_MODE=inline the reduction writer
+# does this itself and this isn't needed.) Each shard written is announced on
+# the vectors queue, by path, for the trainer. Reductions are acked once
+# they're spilled to disk or in a shard, a shard is written once it has
+# VECTORIZER_SHARD_SIZE reductions, or when the queue goes quiet.
+
+def announce_shard(channel, path):
+    body, properties = encode_text(os.path.abspath(path))
+    channel.basic_publish(exchange='', routing_key=VECTORS_QUEUE, body=body,
+            properties=properties)
+
+def ack():
+    global unacked
+    if unacked:
+        rabbit.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        unacked = 0
+
+def flush():
+    """Write a shard of what was collected and spilled, and ack it"""
+    path = vector_shards.flush()
+    if path is None:
+        return
+    announce_shard(rabbit.channel, path)
+    ack()
+    logger.info('wrote {}'.format(path))
+
+def spill():
+    """Spill what was collected to disk and ack it, the prefetch is used up"""
+    path = vector_shards.spill()
+    if path is not None:
+        ack()
+        logger.info('spilled {}'.format(path))
+
+def flush_periodically():
+    """Write a shard if nothing came since last time, spill if something did"""
+    global collected
+    if len(vector_shards) == collected:
+        flush()
+    else:
+        spill()
+    collected = len(vector_shards)
+    rabbit.connection.add_timeout(VECTORIZER_FLUSH_INTERVAL, flush_periodically)
+
+def handle_message(ch, method, properties, body):
+    """Collect the reduction, it's acked when it's spilled or its shard is
+    written"""
+    global last_tag, unacked
+    if properties.content_type != REDUCTION_IDS_CONTENT_TYPE:
+        logger.error('dropping reduction in an old format, {}'.format(
+            properties.content_type))
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+    headers = properties.headers or {}
+    last_tag = method.delivery_tag
+    unacked += 1
+    if vector_shards.add(headers.get('key'), headers.get('index'),
+            decode_reduction_ids(body)):
+        flush()
+    elif unacked >= VECTORIZER_PREFETCH_COUNT:
+        spill()
+
+def setup(connection, channel):
+    """Declare queues, QoS and the consumer, again on every reconnect"""
+    channel.queue_declare(queue=PRE_VECTORS_QUEUE)
+    channel.queue_declare(queue=VECTORS_QUEUE)
+    channel.basic_qos(prefetch_count=VECTORIZER_PREFETCH_COUNT)
+    channel.basic_consume(handle_message, queue=PRE_VECTORS_QUEUE, no_ack=False)
+    connection.add_timeout(VECTORIZER_FLUSH_INTERVAL, flush_periodically)
+
+
+if __name__ == '__main__':
+    vector_shards = VectorShards(ReductionColumns(VECTORIZER_VOCABULARY),
+            VECTORIZER_OUTPUT_DIR, VECTORIZER_SHARD_SIZE)
+    last_tag = None # of the last reduction collected
+    unacked = 0 # reductions collected since the last ack
+    collected = len(vector_shards) # at the last flush tick
+
+    def forget():
+        """What wasn't spilled or written is redelivered on the new channel"""
+        global unacked
+        vector_shards.forget()
+        unacked = 0
+
+    rabbit = Rabbit(RABBIT, setup=setup, on_reconnect=forget)
+    rabbit.run(lambda connection, channel: channel.start_consuming())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Interned reduction components.
+
+A reduction like NONCONDITIONAL-WAS:VBG_...>I is made of three components,
+the mood, the verb phrase and the noun phrase. Each distinct component gets a
+small integer id in the reduction_components table, reducers send the three
+ids and writers store them. Reduction strings are only rebuilt on read.
+"""
+import struct
+
+REDUCTION_FORMAT = "{m}-{vp}>{np}"
+# reductions on the wire, three unsigned ints (mood, verb phrase, noun phrase)
+REDUCTION_IDS = struct.Struct('!III')
+REDUCTION_IDS_CONTENT_TYPE = 'application/x-reduction-ids'
+
+
+def format_reduction(components):
+    """(mood, verb phrase, noun phrase) => reduction string"""
+    m, vp, np = components
+    return REDUCTION_FORMAT.format(m=m, vp=vp, np=np)
+
+def parse_reduction(reduction):
+    """reduction string => (mood, verb phrase, noun phrase)"""
+    m, rest = reduction.split('-', 1)
+    vp, np = rest.rsplit('>', 1)
+    return m, vp, np
+
+def encode_reduction_ids(ids):
+    return REDUCTION_IDS.pack(*ids)
+
+def decode_reduction_ids(body):
+    return REDUCTION_IDS.unpack(body)
+
+
+class ReductionVocabulary():
+    """Maps reduction components to ids and back.
+
+    Ids are assigned by the database so they are the same on every droplet,
+    each process caches the ones it has seen.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = {} # component => id
+        self.components = {} # id => component
+
+    def create_table(self):
+        cur = self.conn.cursor()
+        # serialize, concurrent CREATE TABLE IF NOT EXISTS can still collide
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('reduction_components'))")
+        cur.execute("""CREATE TABLE IF NOT EXISTS reduction_components (
+                        id serial PRIMARY KEY,
+                        component text NOT NULL UNIQUE
+                    )""")
+        self.conn.commit()
+        cur.close()
+
+    def intern(self, component):
+        """Return the id of component, adding it to the table if it's new"""
+        if component in self.ids:
+            return self.ids[component]
+        cur = self.conn.cursor()
+        # DO UPDATE rather than DO NOTHING so the existing id is returned
+        cur.execute("""INSERT INTO reduction_components (component) VALUES (%s)
+                        ON CONFLICT (component)
+                        DO UPDATE SET component=EXCLUDED.component
+                        RETURNING id
+                    """, (component,))
+        id = cur.fetchone()[0]
+        self.conn.commit()
+        cur.close()
+        self._remember(id, component)
+        return id
+
+    def component(self, id):
+        """Return the component with this id"""
+        if id not in self.components:
+            cur = self.conn.cursor()
+            cur.execute("SELECT component FROM reduction_components WHERE id=%s",
+                    (id,))
+            self._remember(id, cur.fetchone()[0])
+            cur.close()
+        return self.components[id]
+
+    def encode(self, components):
+        """(mood, verb phrase, noun phrase) => (id, id, id)"""
+        return tuple(self.intern(str(c)) for c in components)
+
+    def expand(self, ids):
+        """(id, id, id) => reduction string"""
+        return format_reduction([self.component(id) for id in ids])
+
+    def _remember(self, id, component):
+        self.ids[component] = id
+        self.components[id] = component
@@ -1,11 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from collections import Counter
+from connections import Database, Rabbit
+from job_ledger import JobLedger
 from psycopg2.extras import execute_values
+from reduction_vectors import ReductionColumns, VectorShards
+from shards import claim_shards, declare_shard_queues, OrphanShards
+from shards import shard_queue, shard_role
+from vocabulary import ReductionVocabulary, decode_reduction_ids, parse_reduction
+from vocabulary import REDUCTION_IDS_CONTENT_TYPE
 import io
 import json
 import logging
 import os
-import pika
 import psycopg2
 import socket
 
@@ -33,15 +40,37 @@ try:
     RABBIT = os.environ.get('RABBITMQ_LOCATION', 'localhost')
     REDUCTIONS_BASE = os.environ['REDUCTIONS_QUEUE_BASE']
     REDUCTIONS_QUEUE = REDUCTIONS_BASE + '_' + JOB_NAME
-    WRITER_PREFETCH_COUNT = int(os.environ.get('WRITER_PREFETCH_COUNT', 100))
+    # 'aggregate' keeps counts per reduction, 'raw' writes a row per reduction
+    # (for debugging)
+    WRITER_MODE = os.environ.get('REDUCTION_WRITER_MODE', 'aggregate')
+    WRITER_FLUSH_INTERVAL = int(os.environ.get('REDUCTION_WRITER_FLUSH_INTERVAL', 30))
+    WRITER_PREFETCH_COUNT = int(os.environ.get('WRITER_PREFETCH_COUNT', 1000))
+    # 'inline' also writes count vectors of what's written, no vectorizer
+    # needed, see reduction_vectors.py
+    VECTORIZER_MODE = os.environ.get('VECTORIZER_MODE', 'off')
+    if VECTORIZER_MODE == 'inline':
+        VECTORIZER_OUTPUT_DIR = os.environ.get('VECTORIZER_OUTPUT_DIR', 'vectors')
+        VECTORIZER_VOCABULARY = os.environ['VECTORIZER_VOCABULARY']
 except KeyError as e:
     logger.critical('important environment variables were not set')
     raise Exception('Warning: Important environment variables were not set')
 
+shards = [] # the writer shards this process holds
+
+def restore_session():
+    """The shard locks and staging table went with the old connection"""
+    for shard in shards:
+        if not ledger.try_lead(shard_role('reduction_writer', shard)):
+            logger.critical('lost writer shard {}, exiting'.format(shard))
+            raise Exception('Lost a reduction writer shard. Exiting')
+    if WRITER_MODE != 'raw':
+        reduction_copy_manager.create_stage_table()
+
 # Connect to the database
-conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-        host='localhost')
-cur = conn.cursor()
+conn = Database(DB_NAME, DB_USER, DB_PASSWORD, on_reconnect=restore_session)
+vocabulary = ReductionVocabulary(conn)
+ledger = JobLedger(conn, JOB_ID)
+orphan_shards = OrphanShards(ledger, 'reduction_writer', REDUCTIONS_QUEUE)
 
 class LogManager():
     def __init__(self):
@@ -59,73 +88,293 @@ def add_logger_info(msg):
 
 
 class ReductionCopyManager():
+    """Writes a row per reduction, as a string, to reductions. Doesn't drop
+    repeats, reductions redelivered after a restart are written and counted
+    again, so the ledger can overshoot and the job not finish. For debugging"""
     def __init__(self):
         self.f = io.StringIO()
-        self.max_len = 1000
+        # flush before the prefetch runs out, we don't get more until we ack
+        self.max_len = min(1000, WRITER_PREFETCH_COUNT)
         self.length = 0
+        self.last_tag = None
     
-    def insert(self, reduction, job_id):
-        self.f.write(reduction + '\t' + job_id + '\n')
+    def insert(self, ids, job_id, key, tag):
+        self.f.write(vocabulary.expand(ids) + '\t' + job_id + '\n')
         self.length += 1
+        self.last_tag = tag
         if self.length >= self.max_len:
-            self.f.seek(0) # be kind, rewind
-            cur.copy_from(self.f, 'reductions', columns=('reduction', 'job_id'))
-            conn.commit()
-            self.f.close()
-            self.f = io.StringIO()
-            self.length = 0
+            self.flush(job_id)
+
+    def flush(self, job_id):
+        if not self.length:
+            return
+        self.f.seek(0) # be kind, rewind
+        cur = conn.cursor()
+        cur.copy_from(self.f, 'reductions', columns=('reduction', 'job_id'))
+        # counted in the same transaction as the rows, see job_ledger.py
+        ledger.record('reductions', committed=self.length, commit=False)
+        write_vectors()
+        conn.commit()
+        self.f.close()
+        self.f = io.StringIO()
+        self.length = 0
+        rabbit.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+
+    def forget(self):
+        """Drop what was collected, it's redelivered on the new channel"""
+        self.f = io.StringIO()
+        self.length = 0
+
 
-reduction_copy_manager = ReductionCopyManager()
+class ReductionCountManager():
+    """Counts reductions, by component ids, in memory. On flush, COPYs the
+    counts into a staging table and adds them onto reduction_counts, one row
+    per distinct reduction. Read them back as strings through
+    reduction_counts_expanded.
+
+    Messages are acked once their counts are committed. Reductions are keyed
+    by (sentence id, index in the sentence) and reduced_sentences keeps how
+    many of each sentence's reductions were counted, so the ones redelivered
+    after a restart aren't counted again. A sentence's reductions arrive in
+    order, from the one reducer that reduced it. That's a row per sentence,
+    the publisher drops the job's once its counts are final, reduction_counts
+    is all that's kept.
+    """
+    def __init__(self):
+        self.counts = Counter() # (sentence key, index, m, vp, np) => count
+        # flush before the prefetch runs out, we don't get more until we ack
+        self.max_len = WRITER_PREFETCH_COUNT
+        self.length = 0
+        self.last_tag = None
+
+    def create_tables(self):
+        cur = conn.cursor()
+        # serialize, concurrent CREATE TABLE IF NOT EXISTS can still collide
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('reduction_counts'))")
+        cur.execute("""CREATE TABLE IF NOT EXISTS reduction_counts (
+                        job_id integer NOT NULL,
+                        mood_id integer NOT NULL REFERENCES reduction_components (id),
+                        vp_id integer NOT NULL REFERENCES reduction_components (id),
+                        np_id integer NOT NULL REFERENCES reduction_components (id),
+                        count bigint NOT NULL,
+                        PRIMARY KEY (job_id, mood_id, vp_id, np_id)
+                    )""")
+        cur.execute("""CREATE TABLE IF NOT EXISTS reduced_sentences (
+                        job_id integer NOT NULL,
+                        sentence_key bigint NOT NULL,
+                        seen integer NOT NULL,
+                        PRIMARY KEY (job_id, sentence_key)
+                    )""")
+        cur.execute("""CREATE OR REPLACE VIEW reduction_counts_expanded AS
+                        SELECT rc.job_id,
+                            m.component || '-' || vp.component || '>' || np.component
+                                AS reduction,
+                            rc.count
+                        FROM reduction_counts rc
+                        JOIN reduction_components m ON m.id=rc.mood_id
+                        JOIN reduction_components vp ON vp.id=rc.vp_id
+                        JOIN reduction_components np ON np.id=rc.np_id
+                    """)
+        conn.commit()
+        self.create_stage_table()
+
+    def create_stage_table(self):
+        """The staging table is per session, make it on every (re)connect"""
+        cur = conn.cursor()
+        cur.execute("""CREATE TEMP TABLE reduction_counts_stage (
+                        sentence_key bigint,
+                        idx integer,
+                        mood_id integer,
+                        vp_id integer,
+                        np_id integer,
+                        count bigint
+                    ) ON COMMIT DELETE ROWS""")
+        conn.commit()
+
+    def insert(self, ids, job_id, key, tag):
+        """key is (sentence key, index) or (None, None) for unkeyed reductions,
+        which are always counted"""
+        self.counts[key + ids] += 1
+        self.length += 1
+        self.last_tag = tag
+        if self.length >= self.max_len:
+            self.flush(job_id)
+
+    def flush(self, job_id):
+        if not self.counts:
+            return
+        f = io.StringIO()
+        for (key, index, m, vp, np), count in self.counts.items():
+            f.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+                '\\N' if key is None else key, '\\N' if index is None else index,
+                m, vp, np, count))
+        f.seek(0) # be kind, rewind
+        cur = conn.cursor()
+        cur.copy_from(f, 'reduction_counts_stage', columns=('sentence_key', 'idx',
+            'mood_id', 'vp_id', 'np_id', 'count'))
+        # count unkeyed reductions, and keyed ones past what was already
+        # counted of their sentence, returns how many that was
+        cur.execute("""WITH fresh AS (
+                            SELECT mood_id, vp_id, np_id, count
+                            FROM reduction_counts_stage
+                            WHERE sentence_key IS NULL
+                            UNION ALL
+                            SELECT DISTINCT ON (s.sentence_key, s.idx)
+                                s.mood_id, s.vp_id, s.np_id, 1
+                            FROM reduction_counts_stage s
+                            LEFT JOIN reduced_sentences r ON r.job_id=%(job_id)s
+                                AND r.sentence_key=s.sentence_key
+                            WHERE s.sentence_key IS NOT NULL
+                                AND s.idx >= coalesce(r.seen, 0)
+                        ), counted AS (
+                            INSERT INTO reduction_counts
+                            (job_id, mood_id, vp_id, np_id, count)
+                            SELECT %(job_id)s, mood_id, vp_id, np_id, sum(count)
+                            FROM fresh
+                            GROUP BY mood_id, vp_id, np_id
+                            -- same lock order in every shard's writer, no deadlocks
+                            ORDER BY mood_id, vp_id, np_id
+                            ON CONFLICT (job_id, mood_id, vp_id, np_id)
+                            DO UPDATE SET count=reduction_counts.count + EXCLUDED.count
+                        )
+                        SELECT coalesce(sum(count), 0)::bigint FROM fresh
+                    """, {'job_id': job_id})
+        fresh = cur.fetchone()[0]
+        cur.execute("""INSERT INTO reduced_sentences (job_id, sentence_key, seen)
+                        SELECT %s, sentence_key, max(idx) + 1
+                        FROM reduction_counts_stage
+                        WHERE sentence_key IS NOT NULL
+                        GROUP BY sentence_key
+                        ON CONFLICT (job_id, sentence_key) DO UPDATE SET
+                        seen=greatest(reduced_sentences.seen, EXCLUDED.seen)
+                    """, (job_id,))
+        # the redelivered ones aren't counted twice, see job_ledger.py
+        ledger.record('reductions', committed=fresh, commit=False)
+        write_vectors()
+        conn.commit()
+        self.counts = Counter()
+        self.length = 0
+        rabbit.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+
+    def forget(self):
+        """Drop what was collected, it's redelivered on the new channel"""
+        self.counts = Counter()
+        self.length = 0
+
+if WRITER_MODE == 'raw':
+    reduction_copy_manager = ReductionCopyManager()
+else:
+    reduction_copy_manager = ReductionCountManager()
+
+if VECTORIZER_MODE == 'inline':
+    # a shard per flush, at most the prefetch count
+    vector_shards = VectorShards(ReductionColumns(VECTORIZER_VOCABULARY),
+            VECTORIZER_OUTPUT_DIR, WRITER_PREFETCH_COUNT)
+else:
+    vector_shards = None
+
+def write_vectors():
+    """Write the flushed reductions' vectors, before they're committed so a
+    failed commit repeats them rather than losing them"""
+    if vector_shards is not None:
+        path = vector_shards.flush()
+        if path is not None:
+            add_logger_info('wrote {}'.format(path))
+
+def forget():
+    """Drop what was collected, it's redelivered on the new channel"""
+    reduction_copy_manager.forget()
+    if vector_shards is not None:
+        vector_shards.forget()
+
+def flush_periodically():
+    """Flush whatever has been collected, then schedule the next flush"""
+    try:
+        reduction_copy_manager.flush(JOB_ID)
+        add_logger_info('flushed reductions')
+    except psycopg2.Error as e:
+        logger.error('problem flushing reductions, psycopg2 error, {}'.format(
+            e.diag.message_primary))
+        conn.rollback()
+    adopt_orphan_shards()
+    rabbit.connection.add_timeout(WRITER_FLUSH_INTERVAL, flush_periodically)
+
+def adopt_orphan_shards():
+    """Also consume a shard no writer has consumed for a while, see shards.py"""
+    shard = orphan_shards.adopt(rabbit.channel, shards)
+    if shard is not None:
+        shards.append(shard)
+        rabbit.channel.basic_consume(handle_message,
+                queue=shard_queue(REDUCTIONS_QUEUE, shard), no_ack=False)
+        logger.info('adopted writer shard {}'.format(shard))
+
+def setup(connection, channel):
+    """Declare queues, QoS and consumers, again on every reconnect"""
+    declare_shard_queues(channel, REDUCTIONS_QUEUE) # create queues if they don't exist
+    # NOTE: a high prefetch count is not risky here because there will only ever
+    # be one writer per shard (so this guy can't starve anyone out)
+    channel.basic_qos(prefetch_count=WRITER_PREFETCH_COUNT) # limit num of unackd msgs per consumer
+    for shard in shards:
+        channel.basic_consume(handle_message,
+                queue=shard_queue(REDUCTIONS_QUEUE, shard), no_ack=False)
+    connection.add_timeout(WRITER_FLUSH_INTERVAL, flush_periodically)
 
 # #Steps:
-# 1. Read reduced strings from Reduction Queue
-# 2. Write reduced strings to database 
+# 1. Read reductions (component ids) from Reduction Queue
+# 2. Write reductions to database 
 
 def handle_message(ch, method, properties, body):
+    """Collect the reduction, it's acked when its batch is flushed"""
     try:
-        body = body.decode('utf-8')
-        reduction_copy_manager.insert(body, JOB_ID)
-        conn.commit()
+        if properties.content_type == REDUCTION_IDS_CONTENT_TYPE:
+            ids = decode_reduction_ids(body)
+        else: # reduction string, from an older reducer
+            ids = vocabulary.encode(parse_reduction(body.decode('utf-8')))
+            conn.commit()
+        headers = properties.headers or {}
+        key = (headers.get('key'), headers.get('index'))
+        if vector_shards is not None:
+            vector_shards.add(key[0], key[1], ids)
+        reduction_copy_manager.insert(ids, JOB_ID, key, method.delivery_tag)
         add_logger_info('inserted reduction')
     except psycopg2.Error as e:
-        logger.error('problem handling message, psycopg2 error, {}'.format(
-            e.diag.message_primary))
+        # what was collected and not acked goes back to the queue, this
+        # message with it
+        logger.error('problem handling message, requeueing, psycopg2 error, {}'
+                .format(e.diag.message_primary))
         conn.rollback()
+        forget()
+        ch.basic_nack(delivery_tag=method.delivery_tag, multiple=True, requeue=True)
     except UnicodeError as e:
         logger.error("problem handling message, unicode error - {}".format(
             e))
-        
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 if __name__ == '__main__':
 
-    # Check if a writer is already running for this job, if so, exit, if not
-    # mark that one is running then continue.
-    cur.execute("""UPDATE jobs SET meta=jsonb_set(meta, '{reduction_writer}', %s), updated=DEFAULT
-                    WHERE NOT(meta ? 'reduction_writer')
-                    AND id=%s
-                """, (json.dumps(DROPLET_NAME),JOB_ID))
+    ledger.create_table()
+
+    # Claim a writer shard for this job, if they're all taken, exit, if not
+    # mark that we hold it then continue. The advisory lock is released if
+    # this process dies, the meta flag just shows who it is.
+    shards.extend(claim_shards(ledger, 'reduction_writer', limit=1))
+    if not shards:
+        logger.info('every shard has a dedicated reduction writer. exiting')
+        raise Exception('This job already has a dedicated reduction writer for every shard. Exiting')
+    cur = conn.cursor()
+    cur.execute("""UPDATE jobs SET meta=jsonb_set(meta, %s, %s), updated=DEFAULT
+                    WHERE id=%s
+                """, ([shard_role('reduction_writer', shards[0])],
+                    json.dumps(DROPLET_NAME), JOB_ID))
     conn.commit()
-    cur.execute("""SELECT COUNT(*) FROM jobs
-                    WHERE meta->'reduction_writer'=%s
-                    AND id=%s
-                """,
-            (json.dumps(DROPLET_NAME),JOB_ID))
-    continue_running = cur.fetchone()[0] == 1
-    if not continue_running:
-        logger.info('job has dedicated reduction writer. exiting')
-        raise Exception('This job already has a dedicated reduction writer. Exiting')
-
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBIT))
-    channel = connection.channel()
-    channel.queue_declare(queue=REDUCTIONS_QUEUE) # create queue if doesn't exist
+    cur.close()
 
-    # NOTE: a high prefetch count is not risky here because there will only ever
-    # be one writer (so this guy can't starve anyone out)
-    channel.basic_qos(prefetch_count=WRITER_PREFETCH_COUNT) # limit num of unackd msgs on channel
-    channel.basic_consume(handle_message, queue=REDUCTIONS_QUEUE, no_ack=False)
-    channel.start_consuming()
+    vocabulary.create_table()
+    if WRITER_MODE != 'raw':
+        reduction_copy_manager.create_tables()
+
+    rabbit = Rabbit(RABBIT, setup=setup, on_reconnect=forget)
+    rabbit.run(lambda connection, channel: channel.start_consuming())
 
-    cur.close()
     conn.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import deque
+from multiprocessing import Pool
+from sentence_helper import get_text_members, sentences_from_bytes
+import logging
+import os
+
+logger = logging.getLogger('sentencer')
+
+
+def download_book(link):
+    """Pool task, returns the book's [(fname, bytes), ...]"""
+    return get_text_members(link)
+
+def sentence_member(raw):
+    """Pool task, returns the list of sentences in one archive member"""
+    return list(sentences_from_bytes(raw))
+
+
+class BookPool():
+    """Spreads the text members of every book over a process pool.
+
+    Books are submitted with a tag (the delivery tag of their message) and
+    come back out of collect() member by member, named by their archive file
+    name, with a flag saying when the last member of that book is done and the
+    message can be acked. With
+    ordered=True members come out in the order they were submitted, otherwise
+    as soon as they're finished. Books are downloaded in the pool too, so the
+    caller's connection isn't held up by it. At most max_in_flight members are
+    sentenced at once, the rest wait their turn, callers should stop
+    submitting while full() is True.
+
+    Create the pool before opening any connections, the workers are forked
+    from this process (and share its spacy model).
+    """
+    def __init__(self, processes=None, max_in_flight=None, ordered=True):
+        self.processes = processes or os.cpu_count()
+        self.max_in_flight = max_in_flight or self.processes * 2
+        self.ordered = ordered
+        self.pool = Pool(self.processes)
+        self.downloads = deque() # [(tag, AsyncResult), ...]
+        self.waiting = deque() # [(tag, fname, bytes or None), ...] to sentence
+        self.pending = deque() # [(tag, fname, AsyncResult or None), ...]
+        self.members_left = {} # tag => members of the book not yet collected
+
+    def submit(self, tag, link):
+        """Queue a book for download, its members are sentenced once it's in"""
+        self.downloads.append((tag, self.pool.apply_async(download_book, (link,))))
+
+    def full(self):
+        return (len(self.downloads) + len(self.waiting) + len(self.pending)
+                >= self.max_in_flight)
+
+    def collect(self):
+        """Yield (tag, fname, sentences, book_done) for every finished member"""
+        self._unpack_downloads()
+        self._start_members()
+        if self.ordered:
+            while self.pending and self._ready(self.pending[0]):
+                yield self._finish(self.pending.popleft())
+        else:
+            finished, waiting = [], deque()
+            for member in self.pending:
+                (finished if self._ready(member) else waiting).append(member)
+            self.pending = waiting
+            for member in finished:
+                yield self._finish(member)
+
+    def forget(self):
+        """Drop every book in flight, for when their messages will be
+        redelivered. Members being sentenced finish in the background"""
+        self.downloads = deque()
+        self.waiting = deque()
+        self.pending = deque()
+        self.members_left = {}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _unpack_downloads(self):
+        """Queue the members of downloaded books, in order if ordered"""
+        done, downloading = [], deque()
+        for tag, result in self.downloads:
+            if result.ready() and not (self.ordered and downloading):
+                done.append((tag, result))
+            else:
+                downloading.append((tag, result))
+        self.downloads = downloading
+        for tag, result in done:
+            try:
+                members = result.get()
+            except Exception as e:
+                logger.error("problem downloading book - {}".format(e))
+                members = []
+            if not members:
+                # nothing to sentence, still needs to come out so it gets acked
+                members = [(None, None)]
+            self.members_left[tag] = len(members)
+            for fname, raw in members:
+                self.waiting.append((tag, fname, raw))
+
+    def _start_members(self):
+        """Hand waiting members to the pool, max_in_flight at a time"""
+        while self.waiting and len(self.pending) < self.max_in_flight:
+            tag, fname, raw = self.waiting.popleft()
+            self.pending.append((tag, fname, None if raw is None else
+                self.pool.apply_async(sentence_member, (raw,))))
+
+    def _ready(self, member):
+        return member[2] is None or member[2].ready()
+
+    def _finish(self, member):
+        tag, fname, result = member
+        sentences = []
+        if result is not None:
+            try:
+                sentences = result.get()
+            except Exception as e:
+                logger.error("problem sentencing book member - {}".format(e))
+        self.members_left[tag] -= 1
+        book_done = self.members_left[tag] == 0
+        if book_done:
+            del self.members_left[tag]
+        return tag, fname, sentences, book_done
@@ -1,10 +1,10 @@
+from connections import Database, Rabbit
+from job_ledger import JobLedger
+from wire import encode_text
 from time import sleep
 import json
 import logging
 import os
-import pika
-import psycopg2
-import random
 import socket
 
 FNAME=os.path.basename(__file__)
@@ -42,77 +42,94 @@ except KeyError as e:
 # 1. Connect to the database
 # 2. Start adding sentences to PRE_SENTENCES_QUEUE
 
+def stay_leader():
+    """The advisory lock went with the old connection, take it back"""
+    if not ledger.try_lead('sentence_publisher'):
+        logger.critical('lost the pre-sentence publisher lock, exiting')
+        raise Exception('Lost the sentence publisher lock. Exiting')
+
+def declare_queue(connection, channel):
+    channel.queue_declare(queue=PRE_SENTENCES_QUEUE)
+
+def publish_rows(connection, channel, rows):
+    for key, sent_str in rows:
+        # the book id keys its sentences, so the writer can drop repeats
+        body, properties = encode_text(sent_str, headers={'key': key})
+        channel.basic_publish(exchange='', routing_key=PRE_SENTENCES_QUEUE,
+                body=body, properties=properties)
+
+def queued_count(connection, channel):
+    return channel.queue_declare(queue=PRE_SENTENCES_QUEUE).method.message_count
+
 
 if __name__ == '__main__':
     # Connect to the database
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-            host='localhost')
+    conn = Database(DB_NAME, DB_USER, DB_PASSWORD, on_reconnect=stay_leader)
     cur = conn.cursor()
 
+    ledger = JobLedger(conn, JOB_ID)
+    ledger.create_table()
+
     # Check if a publisher is already running for this job, if so exit, if not
-    # mark that one is running then continue.
+    # mark that one is running then continue. The advisory lock is released if
+    # this process dies, the data flag just shows who it is.
+    if not ledger.try_lead('sentence_publisher'):
+        logger.info('job already has dedicated pre-sentence publisher, exiting')
+        raise Exception('This job already has a dedicated sentence publisher. Exiting')
     cur.execute("""UPDATE nlpjobs SET data=jsonb_set(data, '{sentence_publisher}', %s)
-                    WHERE NOT(data ? 'sentence_publisher')
-                    AND id=%s
+                    WHERE id=%s
                 """, (json.dumps(DROPLET_NAME),JOB_ID))
     conn.commit()
-    cur.execute("""SELECT COUNT(*) FROM nlpjobs WHERE
-                    data->'sentence_publisher'=%s
-                    AND id=%s
-                """,
-            (json.dumps(DROPLET_NAME), JOB_ID))
-    continue_running = cur.fetchone()[0] == 1
-    if not continue_running:
-        logger.info('job already has dedicated pre-sentence publisher, exiting')
-        raise Exception('This job already has a dedicated sentence publisher. Exiting')
+    cur.close()
+
+    # Books go out in id order, resuming after the last one a previous
+    # publisher checkpointed
+    last_key = ledger.checkpoint('sentence_publisher')
+    if last_key:
+        logger.info('resuming after book {}'.format(last_key))
 
-    # Issue select statements - cast to json from jsonb
-    cur.execute("SELECT data->>'link' FROM nlpdata WHERE setname='gutenberg' and typename='booklink' ORDER BY RANDOM()")
-
-    # Connect to pika
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBIT))
-    channel = connection.channel()
-
-    # Declare queue if doesn't exist, get reference to queue
-    q = channel.queue_declare(queue=PRE_SENTENCES_QUEUE)
-    q_len = q.method.message_count
-    some_pre_sentences_not_queued = True
-    while some_pre_sentences_not_queued:
-        messages = []
-        some_pre_sentences_not_queued = False
-        for row in cur.fetchmany(MAX_QUEUE_LEN):
-            some_pre_sentences_not_queued = True # at least one row
-            sent_str = row[0]
-            channel.basic_publish(exchange='', routing_key=PRE_SENTENCES_QUEUE,
-                    body=json.dumps(sent_str))
-            messages.append('queued pre-sentence')
-        for message in messages:
-            logger.info(message)
-        q = channel.queue_declare(queue=PRE_SENTENCES_QUEUE)
-        q_len = q.method.message_count
-        while q_len > MAX_QUEUE_LEN:
+    # Connect to pika, declare queue if doesn't exist
+    rabbit = Rabbit(RABBIT, setup=declare_queue)
+
+    while True:
+        # a page at a time, by key, so a dropped connection loses nothing -
+        # cast to json from jsonb
+        cur = conn.cursor()
+        cur.execute("""SELECT id, data->>'link' FROM nlpdata
+                        WHERE setname='gutenberg' and typename='booklink' AND id > %s
+                        ORDER BY id LIMIT %s
+                    """, (last_key, MAX_QUEUE_LEN))
+        rows = cur.fetchall()
+        cur.close()
+        if not rows:
+            break
+        rabbit.run(lambda connection, channel: publish_rows(connection, channel, rows))
+        last_key = rows[-1][0]
+        # counts and checkpoint together, a batch is either both or neither
+        ledger.save_checkpoint('sentence_publisher', last_key,
+                {'pre-sentences': len(rows)})
+        for row in rows:
+            logger.info('queued pre-sentence')
+        while rabbit.run(queued_count) > MAX_QUEUE_LEN:
             sleep(.1) # max speed w sleep (1) is MAX_QUEUE_LEN / s
             logger.info('pre sentences queue at capacity, sleeping')
-            q = channel.queue_declare(queue=PRE_SENTENCES_QUEUE)
-            q_len = q.method.message_count
 
     # update state to pre-sentences-queued
+    ledger.finish_publishing('pre-sentences')
+    cur = conn.cursor()
     cur.execute("""UPDATE nlpjobs SET data=jsonb_set(data, '{state}', %s)
                     WHERE id=%s
                 """, (json.dumps('pre-sentences-queued'),JOB_ID))
     conn.commit()
     logger.info('all pre-sentences have been queued. waiting for acks')
 
-    # wait until all messages have been acked
-    q = channel.queue_declare(queue=PRE_SENTENCES_QUEUE)
-    q_len = q.method.message_count
-    while q_len > 0:
-        sleep(2)
-        q = channel.queue_declare(queue=PRE_SENTENCES_QUEUE)
-        q_len = q.method.message_count
+    # wait until every book has been sentenced and every sentence written
+    ledger.wait(['pre-sentences', 'sentences'])
+    ledger.forget_keys(['pre-sentences'])
 
-    logger.info('all pre-sentences have been acked. setting state to sentenced.')
+    logger.info('all sentences have been written. setting state to sentenced.')
     # update state to sentenced
+    cur = conn.cursor()
     cur.execute("""UPDATE nlpjobs SET data=jsonb_set(data, '{state}', %s)
                     WHERE id=%s
                 """, (json.dumps('sentenced'),JOB_ID))
@@ -120,4 +137,5 @@ if __name__ == '__main__':
 
     logger.info('exiting')
     cur.close()
+    rabbit.close()
     conn.close()
@@ -1,55 +1,119 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from normalize import decode_book, normalize
 import requests, zipfile, io
 import spacy
-import json
 import re
 nlp = spacy.load('en_core_web_sm')
 
 CHUNK_SIZE = 1000
 
+# Project Gutenberg wraps every book in a license header and footer. Both are
+# marked with a line like "*** START OF THIS PROJECT GUTENBERG EBOOK ... ***",
+# older books use "*END*THE SMALL PRINT!" to end the header instead.
+GUTENBERG_START_RE = re.compile(
+        r'^\s*\*+\s*START OF (THIS|THE) PROJECT GUTENBERG|^\s*\*END\*THE SMALL PRINT',
+        re.IGNORECASE)
+GUTENBERG_END_RE = re.compile(
+        r'^\s*\*+\s*END OF (THIS|THE) PROJECT GUTENBERG|^\s*END OF (THIS|THE) PROJECT GUTENBERG',
+        re.IGNORECASE)
+CONTENTS_RE = re.compile(r'^\s*(TABLE OF )?CONTENTS\.?\s*$', re.IGNORECASE)
+# a table of contents entry is short, prose lines are wrapped at ~70 chars
+CONTENTS_LINE_MAX_LEN = 60
+ODD_SENT_RE = re.compile('''"?[A-Z][a-z][0-9a-zA-Z'.\s?!()\\"/,;–:-]+[.!?]"?''')
+
 def get_sentences(link):
-    link = json.loads(link) # unquoute the quoted string
+    """Yield the sentences of every text member of the book's archive"""
+    for fname, raw in get_text_members(link):
+        for sentence in sentences_from_bytes(raw):
+            yield sentence
+
+def get_text_members(link):
+    """Download the book's zip archive, return [(fname, bytes), ...] for each
+    text file in it. Gutenberg archives can hold more than one"""
     r = requests.get(link)
     z = zipfile.ZipFile(io.BytesIO(r.content))
-    for fname in z.namelist():
-        text = str(z.open(fname).read())
-        # strip out newline characters
-        text = text.replace('\\n', ' ').replace('\\r', ' ')
-        # Replace all runs of whitespace with a single space
-        text = re.sub(r"\s+", ' ', text)
-        # TODO: we should get rid of the licence and stuff too probly
-        sents = get_sents_from_text(text)
-        return remove_odd_sents(sents)
+    return [(fname, z.read(fname)) for fname in z.namelist()
+            if fname.lower().endswith('.txt')]
+
+def sentences_from_bytes(raw):
+    """Yield the sentences of one archive member"""
+    text = decode_book(raw)
+    # cut the license, contents and headings before the text reaches spacy
+    text = ' '.join(iter_paragraphs(text.splitlines()))
+    # one space between words, straight quotes
+    text = normalize(text)
+    sents = get_sents_from_text(text)
+    return remove_odd_sents(sents)
+
+def strip_gutenberg_license(lines):
+    """Given the lines of a book, return only the lines between the Project
+    Gutenberg START and END markers. Books without markers are returned whole"""
+    start, end = 0, len(lines)
+    for i, line in enumerate(lines):
+        if GUTENBERG_START_RE.match(line):
+            start = i + 1
+            break
+    for i in range(start, len(lines)):
+        if GUTENBERG_END_RE.match(lines[i]):
+            end = i
+            break
+    return lines[start:end]
+
+def is_heading(paragraph):
+    """A paragraph with letters in it, all of which are upper case"""
+    return paragraph.isupper()
+
+def is_contents_entry(lines):
+    """A paragraph made only of short lines, like a table of contents"""
+    return all(len(line) <= CONTENTS_LINE_MAX_LEN for line in lines)
+
+def iter_paragraphs(lines):
+    """Yield the paragraphs of a book worth sentencing, one string per
+    paragraph. Drops the license, tables of contents and all-caps headings"""
+    in_contents = False
+    paragraph = []
+    for line in strip_gutenberg_license(lines) + ['']:
+        line = line.strip()
+        if line:
+            paragraph.append(line)
+            continue
+        if not paragraph:
+            continue
+        text = ' '.join(paragraph)
+        if CONTENTS_RE.match(text):
+            in_contents = True
+        elif in_contents and (is_contents_entry(paragraph) or is_heading(text)):
+            pass # the contents end at the first paragraph that looks like prose
+        elif not is_heading(text):
+            in_contents = False
+            yield text
+        paragraph = []
 
 def get_sents_from_text(text):
+    """Yield sentence strings from text as spacy finds them"""
     # we use spacy to extract sentences from the whole book at once (memory
     # problem) instead, break the text into chunks.
-    sents = [] 
     text_left = len(text)
     start_index=0
     leftovers = ''
-    while CHUNK_SIZE < text_left: 
+    while CHUNK_SIZE < text_left:
         # create text chunk
         chunk = leftovers + text[start_index:start_index+CHUNK_SIZE]
         # collect sentences
-        doc = nlp(chunk)
-        sents += list(doc.sents)[:-1]
+        sents = list(nlp(chunk).sents)
+        for s in sents[:-1]:
+            yield str(s)
         # store leftovers
-        leftovers = chunk[list(doc.sents)[-1].start_char:]
+        leftovers = chunk[sents[-1].start_char:]
         start_index += CHUNK_SIZE
         text_left -= CHUNK_SIZE
     # last chunk may not be even chunk.
     chunk = leftovers + text[start_index:-1]
     # collect sentences
-    doc = nlp(chunk)
-    sents += list(doc.sents)
-    return [str(s) for s in sents]
+    for s in nlp(chunk).sents:
+        yield str(s)
 
 def remove_odd_sents(sents):
-    result = []
-    for s in sents:
-        if re.match('''"?[A-Z][a-z][0-9a-zA-Z'.\s?!()\\"/,;–:-]+[.!?]"?''', s):
-            result.append(s)
-    return result
-
+    """Lazily filter out sentences that don't look like prose"""
+    return (s for s in sents if ODD_SENT_RE.match(s))
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from sentence_helper import get_sentences
+from book_pool import BookPool
+from connections import Database, Rabbit
+from job_ledger import JobLedger
+from prefetch import consumer_prefetch, PrefetchController
+from shards import declare_shard_queues, route_to_shard
+from wire import batches, decode_text, encode_text, encode_text_batch
+from wire import WIRE_FORMAT
 import logging
 import os
-import pika
 import io
+import psycopg2
 import re
 import socket
-import json
+import time
 
 FNAME=os.path.basename(__file__)
 PID=os.getpid()
@@ -25,10 +31,18 @@ logger = logging.getLogger('sentencer')
 
 
 try:
+    DB_NAME = os.environ.get('DB_NAME', 'nlp')
+    DB_PASSWORD = os.environ.get('DB_PASS', '')
+    DB_USER = os.environ.get('DB_USER', DB_NAME)
+    JOB_ID = os.environ['JOB_ID']
     JOB_NAME = os.environ['JOB_NAME']
     PRE_SENTENCES_BASE = os.environ['PRE_SENTENCES_QUEUE_BASE']
     PRE_SENTENCES_QUEUE = PRE_SENTENCES_BASE + '_' + JOB_NAME
     RABBIT = os.environ.get('RABBITMQ_LOCATION', 'localhost')
+    SENTENCER_MAX_IN_FLIGHT = int(os.environ.get('SENTENCER_MAX_IN_FLIGHT', 0)) or None
+    SENTENCER_ORDERED = os.environ.get('SENTENCER_ORDERED', '1') == '1'
+    SENTENCER_POLL_INTERVAL = float(os.environ.get('SENTENCER_POLL_INTERVAL', .1))
+    SENTENCER_POOL_SIZE = int(os.environ.get('SENTENCER_POOL_SIZE', 0)) or None
     SENTENCER_PREFETCH_COUNT = int(os.environ.get('SENTENCER_PREFETCH_COUNT', 10))
     SENTENCES_BASE = os.environ['SENTENCES_QUEUE_BASE']
     SENTENCES_QUEUE = SENTENCES_BASE + '_' + JOB_NAME
@@ -37,25 +51,103 @@ except KeyError as e:
     raise Exception('important environment variables were not set')
 
 def handle_message(ch, method, properties, body):
+    """Hand a book to the pool, it gets acked once all its members are done"""
     try:
-        body = body.decode('utf-8')
-        for sentence in get_sentences(body):
-            channel.basic_publish(exchange='', routing_key=SENTENCES_QUEUE,
-                    body=json.dumps(sentence))
-        logger.info("queued sentences")
+        body = decode_text(properties, body)
+        book_keys[method.delivery_tag] = (properties.headers or {}).get('key')
+        book_started[method.delivery_tag] = time.time()
+        book_pool.submit(method.delivery_tag, body)
     except Exception as e:
         logger.error("problem handling message - {}".format(e))
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        book_keys.pop(method.delivery_tag, None)
+        book_started.pop(method.delivery_tag, None)
+        # counted before it's acked, see job_ledger.py
+        count_book(ch, method.delivery_tag, (properties.headers or {}).get('key'))
 
+def count_book(ch, tag, book_key, published=0):
+    """Count the book and the sentences we published of it, together and once
+    per book, then ack it, see job_ledger.py. A dropped connection is retried
+    there, anything else and the book comes back"""
+    try:
+        ledger.commit_message('pre-sentences', book_key, {'sentences': published})
+        ch.basic_ack(delivery_tag=tag)
+    except psycopg2.Error as e:
+        logger.error("problem counting book, requeueing it - {}".format(e))
+        conn.rollback()
+        ch.basic_nack(delivery_tag=tag, requeue=True)
 
-if __name__ == '__main__':
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBIT))
-    channel = connection.channel()
-    channel.queue_declare(queue=PRE_SENTENCES_QUEUE) # create queue if doesn't exist
-    channel.queue_declare(queue=SENTENCES_QUEUE)
+def sentence_message(book_key, fname, start, batch):
+    """Returns (body, properties) for a batch of a member's sentences, see
+    wire.py. Sentences are keyed by book, member and position, so a book
+    sentenced twice (after a restart) is only written once; a batch carries
+    the key of its first sentence. Unkeyed books, unkeyed sentences"""
+    headers = None if book_key is None else {'key': [book_key, fname, start]}
+    if WIRE_FORMAT == 'json':
+        return encode_text(batch[0], headers)
+    return encode_text_batch(batch, headers)
 
+def publish_finished(ch):
+    """Queue the sentences of finished book members, ack finished books"""
+    for tag, fname, sentences, book_done in book_pool.collect():
+        for start, batch in batches(sentences):
+            body, properties = sentence_message(book_keys[tag], fname, start, batch)
+            # a book's sentences all go to the same writer shard
+            ch.basic_publish(exchange='',
+                    routing_key=route_to_shard(SENTENCES_QUEUE, book_keys[tag]),
+                    body=body, properties=properties)
+            book_published[tag] = book_published.get(tag, 0) + len(batch)
+        logger.info("queued sentences")
+        if not book_done:
+            continue
+        count_book(ch, tag, book_keys.pop(tag), book_published.pop(tag, 0))
+        # books are sentenced side by side, one at a time they'd take
+        prefetch_controller.observe(
+                (time.time() - book_started.pop(tag)) / book_pool.processes)
+
+
+def setup(connection, channel):
+    """Declare queues and QoS, again on every reconnect"""
+    channel.queue_declare(queue=PRE_SENTENCES_QUEUE) # create queue if doesn't exist
+    declare_shard_queues(channel, SENTENCES_QUEUE)
     # NOTE: if the prefetch count is too high, some workers could starve. If it
     # is too low, we make an unneccessary amount of requests to rabbitmq server
-    channel.basic_qos(prefetch_count=SENTENCER_PREFETCH_COUNT) # limit num of unackd msgs on channel
-    channel.basic_consume(handle_message, queue=PRE_SENTENCES_QUEUE, no_ack=False)
-    channel.start_consuming()
+    channel.basic_qos(prefetch_count=consumer_prefetch(SENTENCER_PREFETCH_COUNT)) # limit num of unackd msgs on channel
+    # and one that follows how fast we are, see prefetch.py
+    prefetch_controller.apply(channel)
+
+def forget_books():
+    """Books we hadn't acked are redelivered on the new channel"""
+    book_pool.forget()
+    book_keys.clear()
+    book_published.clear()
+    book_started.clear()
+
+def consume(connection, channel):
+    for method, properties, body in channel.consume(PRE_SENTENCES_QUEUE,
+            no_ack=False, inactivity_timeout=SENTENCER_POLL_INTERVAL):
+        if method is not None:
+            handle_message(channel, method, properties, body)
+        publish_finished(channel)
+        prefetch_controller.adjust(channel)
+        # bound memory, stop taking books until some members are done
+        while book_pool.full():
+            connection.sleep(SENTENCER_POLL_INTERVAL)
+            publish_finished(channel)
+
+
+if __name__ == '__main__':
+    # fork the pool before connecting, workers share the loaded spacy model
+    book_pool = BookPool(processes=SENTENCER_POOL_SIZE,
+            max_in_flight=SENTENCER_MAX_IN_FLIGHT, ordered=SENTENCER_ORDERED)
+    book_keys = {} # delivery tag => book id, for books in the pool
+    book_published = {} # delivery tag => sentences published of the book
+    book_started = {} # delivery tag => when the book was handed to the pool
+    prefetch_controller = PrefetchController([PRE_SENTENCES_QUEUE],
+            SENTENCER_PREFETCH_COUNT)
+
+    conn = Database(DB_NAME, DB_USER, DB_PASSWORD)
+    ledger = JobLedger(conn, JOB_ID)
+    ledger.create_table()
+
+    rabbit = Rabbit(RABBIT, setup=setup, on_reconnect=forget_books)
+    rabbit.run(consume)
@@ -1,9 +1,13 @@
+from connections import Database, Rabbit
+from job_ledger import JobLedger
 from psycopg2.extras import execute_values
+from shards import claim_shards, declare_shard_queues, OrphanShards
+from shards import shard_queue, shard_role
+from wire import decode_texts, is_batch
 import io
 import json
 import logging
 import os
-import pika
 import psycopg2
 import socket
 
@@ -31,15 +35,25 @@ try:
     RABBIT = os.environ.get('RABBITMQ_LOCATION', 'localhost')
     SENTENCES_BASE = os.environ['SENTENCES_QUEUE_BASE']
     SENTENCES_QUEUE = SENTENCES_BASE + '_' + JOB_NAME
-    WRITER_PREFETCH_COUNT = int(os.environ.get('WRITER_PREFETCH_COUNT', 100))
+    WRITER_FLUSH_INTERVAL = int(os.environ.get('SENTENCE_WRITER_FLUSH_INTERVAL', 30))
+    WRITER_PREFETCH_COUNT = int(os.environ.get('WRITER_PREFETCH_COUNT', 1000))
 except KeyError as e:
     logger.critical('important environment variables were not set')
     raise Exception('Warning: Important environment variables were not set')
 
+shards = [] # the writer shards this process holds
+
+def keep_shards():
+    """The shard locks went with the old connection, take them back"""
+    for shard in shards:
+        if not ledger.try_lead(shard_role('sentence_writer', shard)):
+            logger.critical('lost writer shard {}, exiting'.format(shard))
+            raise Exception('Lost a sentence writer shard. Exiting')
+
 # Connect to the database
-conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
-        host='localhost')
-cur = conn.cursor()
+conn = Database(DB_NAME, DB_USER, DB_PASSWORD, on_reconnect=keep_shards)
+ledger = JobLedger(conn, JOB_ID)
+orphan_shards = OrphanShards(ledger, 'sentence_writer', SENTENCES_QUEUE)
 
 class LogManager():
     def __init__(self):
@@ -57,72 +71,143 @@ def add_logger_info(msg):
 
 
 class SentenceCopyManager():
+    """Collects sentences and inserts them in batches. Messages are acked once
+    their batch is committed, so a writer that dies loses nothing; sentences
+    it wrote but didn't ack come back and are dropped by their key"""
     def __init__(self):
         self.f = io.StringIO()
         self.argslist = []
-        self.max_len = 1000
+        # flush before the prefetch runs out, we don't get more until we ack
+        self.max_len = min(1000, WRITER_PREFETCH_COUNT)
+        self.last_tag = None
+
+    def create_index(self):
+        cur = conn.cursor()
+        cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS nlpdata_sentence_key
+                        ON nlpdata (generator, (data->'key'))
+                        WHERE typename='sentence'
+                    """)
+        conn.commit()
 
-    def insert(self, sentence, job_id):
-        sdata = json.dumps({'text':json.loads(sentence)})
-        argslist = []
-        self.argslist.append(('gutenberg','sentence',job_id, sdata))
+    def insert(self, sentences, job_id, keys, tag):
+        """Collect the sentences of one message, with their keys"""
+        for sentence, key in zip(sentences, keys):
+            sdata = {'text':sentence}
+            if key is not None:
+                sdata['key'] = key # [book id, archive member, position]
+            self.argslist.append(('gutenberg','sentence',job_id, json.dumps(sdata)))
+        self.last_tag = tag
         if len(self.argslist) >= self.max_len:
-            self.f.seek(0) # be kind, rewind
-            stmt = "insert into nlpdata (setname, typename, generator, data) values %s"
-            psycopg2.extras.execute_values(cur, stmt, self.argslist)
-            self.argslist = []
-            conn.commit()
+            self.flush()
+
+    def flush(self):
+        if not self.argslist:
+            return
+        cur = conn.cursor()
+        stmt = """insert into nlpdata (setname, typename, generator, data) values %s
+                    on conflict (generator, (data->'key')) where typename='sentence'
+                    do nothing"""
+        # one statement, so rowcount is every sentence it inserted
+        psycopg2.extras.execute_values(cur, stmt, self.argslist,
+                page_size=len(self.argslist))
+        # the ones that weren't there already, counted in the same transaction
+        # as the rows, see job_ledger.py
+        ledger.record('sentences', committed=cur.rowcount, commit=False)
+        conn.commit()
+        self.argslist = []
+        rabbit.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+
+    def forget(self):
+        """Drop what was collected, it's redelivered on the new channel"""
+        self.argslist = []
 
 sentence_copy_manager = SentenceCopyManager()
 
+def flush_periodically():
+    """Flush whatever has been collected, then schedule the next flush"""
+    try:
+        sentence_copy_manager.flush()
+    except psycopg2.Error as e:
+        logger.error('problem flushing sentences, psycopg2 error, {}'.format(
+            e.diag.message_primary))
+        conn.rollback()
+    adopt_orphan_shards()
+    rabbit.connection.add_timeout(WRITER_FLUSH_INTERVAL, flush_periodically)
+
+def adopt_orphan_shards():
+    """Also consume a shard no writer has consumed for a while, see shards.py"""
+    shard = orphan_shards.adopt(rabbit.channel, shards)
+    if shard is not None:
+        shards.append(shard)
+        rabbit.channel.basic_consume(handle_message,
+                queue=shard_queue(SENTENCES_QUEUE, shard), no_ack=False)
+        logger.info('adopted writer shard {}'.format(shard))
+
+def setup(connection, channel):
+    """Declare queues, QoS and consumers, again on every reconnect"""
+    declare_shard_queues(channel, SENTENCES_QUEUE) # create queues if they don't exist
+    # NOTE: a high prefetch count is not risky here because there will only ever
+    # be one writer per shard (so this guy can't starve anyone out)
+    channel.basic_qos(prefetch_count=WRITER_PREFETCH_COUNT) # limit num of unackd msgs per consumer
+    for shard in shards:
+        channel.basic_consume(handle_message,
+                queue=shard_queue(SENTENCES_QUEUE, shard), no_ack=False)
+    connection.add_timeout(WRITER_FLUSH_INTERVAL, flush_periodically)
+
 # #Steps:
 # 1. Read sentenced strings from Sentence Queue
 # 2. Write sentenced strings to database
 
+def sentence_keys(properties, count):
+    """Keys of the sentences in a message, a batch carries its first one's"""
+    key = (properties.headers or {}).get('key')
+    if key is None:
+        return [None] * count
+    if not is_batch(properties):
+        return [key]
+    return [key[:-1] + [key[-1] + i] for i in range(count)]
+
 def handle_message(ch, method, properties, body):
+    """Collect the sentences, they're acked when their batch is flushed"""
     try:
-        body = body.decode('utf-8')
-        sentence_copy_manager.insert(body, JOB_ID)
-        conn.commit()
-        add_logger_info('inserted sentence')
+        sentences = decode_texts(properties, body)
+        sentence_copy_manager.insert(sentences, JOB_ID,
+                sentence_keys(properties, len(sentences)), method.delivery_tag)
+        add_logger_info('inserted sentences')
     except psycopg2.Error as e:
-        logger.error('problem handling message, psycopg2 error, {}'.format(
-            e.diag.message_primary))
+        # what was collected and not acked goes back to the queue, this
+        # message with it
+        logger.error('problem handling message, requeueing, psycopg2 error, {}'
+                .format(e.diag.message_primary))
         conn.rollback()
-    except UnicodeError as e:
-        logger.error("problem handling message, unicode error - {}".format(
+        sentence_copy_manager.forget()
+        ch.basic_nack(delivery_tag=method.delivery_tag, multiple=True, requeue=True)
+    except (UnicodeError, ValueError) as e:
+        logger.error("problem handling message, can't decode it - {}".format(
             e))
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 if __name__ == '__main__':
-    # Check if a publisher is already running for this job, if so exit, if not
-    # mark that one is running then continue.
-    cur.execute("""UPDATE nlpjobs SET data=jsonb_set(data, '{sentence_writer}', %s)
-                    WHERE NOT(data ? 'sentence_writer')
-                    AND id=%s
-                """, (json.dumps(DROPLET_NAME),JOB_ID))
+    ledger.create_table()
+
+    # Claim a writer shard for this job, if they're all taken, exit, if not
+    # mark that we hold it then continue. The advisory lock is released if
+    # this process dies, the data flag just shows who it is.
+    shards.extend(claim_shards(ledger, 'sentence_writer', limit=1))
+    if not shards:
+        logger.info('every shard has a dedicated sentence writer. exiting')
+        raise Exception('This job already has a dedicated sentence writer for every shard. Exiting')
+    cur = conn.cursor()
+    cur.execute("""UPDATE nlpjobs SET data=jsonb_set(data, %s, %s)
+                    WHERE id=%s
+                """, ([shard_role('sentence_writer', shards[0])],
+                    json.dumps(DROPLET_NAME), JOB_ID))
     conn.commit()
-    cur.execute("""SELECT COUNT(*) FROM nlpjobs WHERE
-                    data->'sentence_writer'=%s
-                    AND id=%s
-                """,
-            (json.dumps(DROPLET_NAME), JOB_ID))
-    continue_running = cur.fetchone()[0] == 1
-    if not continue_running:
-        logger.info('job has dedicated sentence writer. exiting')
-        raise Exception('This job already has a dedicated sentence writer. Exiting')
-
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBIT))
-    channel = connection.channel()
-    channel.queue_declare(queue=SENTENCES_QUEUE) # create queue if doesn't exist
+    cur.close()
+    sentence_copy_manager.create_index()
 
-    # NOTE: a high prefetch count is not risky here because there will only ever
-    # be one writer (so this guy can't starve anyone out)
-    channel.basic_qos(prefetch_count=WRITER_PREFETCH_COUNT) # limit num of unackd msgs on channel
-    channel.basic_consume(handle_message, queue=SENTENCES_QUEUE, no_ack=False)
-    channel.start_consuming()
+    rabbit = Rabbit(RABBIT, setup=setup, on_reconnect=sentence_copy_manager.forget)
+    rabbit.run(lambda connection, channel: channel.start_consuming())
 
-    cur.close()
     conn.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Split a writer's queue into shards, so several writers share a job.
+
+Producers publish each message to <base>_w<n>, n picked by a hash of the
+message's partition key (the book for sentences, the sentence for reductions),
+so everything with the same key goes through the same writer. Writers claim a
+shard with an advisory lock (see job_ledger.py) and consume its queue. Once
+they're running they also adopt a shard whose queue has had no consumer for
+SHARD_ADOPT_AFTER seconds, one at a time, for when there are fewer writers
+than shards or a writer died and hasn't come back. Writers starting together
+get a shard each first. With one shard (the default) the queue is just
+<base>, as before.
+
+WRITER_SHARDS has to be the same on every droplet and can't change during a
+job.
+"""
+from time import time
+from zlib import crc32
+import os
+import random
+
+SHARD_ADOPT_AFTER = float(os.environ.get('SHARD_ADOPT_AFTER', 300)) # seconds
+WRITER_SHARDS = int(os.environ.get('WRITER_SHARDS', 1))
+
+
+def shard_queue(base_queue, shard):
+    if WRITER_SHARDS == 1:
+        return base_queue
+    return '{}_w{}'.format(base_queue, shard)
+
+def shard_queues(base_queue):
+    return [shard_queue(base_queue, s) for s in range(WRITER_SHARDS)]
+
+def declare_shard_queues(channel, base_queue):
+    for queue in shard_queues(base_queue):
+        channel.queue_declare(queue=queue)
+
+def shard_of(key):
+    """The shard for a partition key, a random one if there's no key"""
+    if key is None:
+        return random.randrange(WRITER_SHARDS)
+    return crc32(str(key).encode('utf_8')) % WRITER_SHARDS
+
+def route_to_shard(base_queue, key):
+    return shard_queue(base_queue, shard_of(key))
+
+def shard_role(role, shard):
+    """Leader role of a shard's writer, just <role> with one shard"""
+    if WRITER_SHARDS == 1:
+        return role
+    return '{}_{}'.format(role, shard)
+
+def claim_shards(ledger, role, held=(), limit=None):
+    """Claim up to limit (default all) of the shards nobody holds, returns the
+    shards claimed. Pass the ones already held, advisory locks are reentrant"""
+    claimed = []
+    for shard in range(WRITER_SHARDS):
+        if limit is not None and len(claimed) >= limit:
+            break
+        if shard not in held and ledger.try_lead(shard_role(role, shard)):
+            claimed.append(shard)
+    return claimed
+
+
+class OrphanShards():
+    """Finds shards of role whose queues have gone unconsumed, see adopt()"""
+    def __init__(self, ledger, role, base_queue):
+        self.ledger = ledger
+        self.role = role
+        self.base_queue = base_queue
+        self.unconsumed_since = {} # shard => when its queue was first seen idle
+
+    def adopt(self, channel, held):
+        """Claim one shard whose queue has had no consumer for
+        SHARD_ADOPT_AFTER seconds, returns it (None if there's none)"""
+        now = time()
+        for shard in range(WRITER_SHARDS):
+            if shard in held:
+                self.unconsumed_since.pop(shard, None)
+                continue
+            declared = channel.queue_declare(queue=shard_queue(self.base_queue,
+                shard), passive=True)
+            if declared.method.consumer_count:
+                self.unconsumed_since.pop(shard, None)
+                continue
+            since = self.unconsumed_since.setdefault(shard, now)
+            if now - since >= SHARD_ADOPT_AFTER and \
+                    self.ledger.try_lead(shard_role(self.role, shard)):
+                del self.unconsumed_since[shard]
+                return shard
+        return None
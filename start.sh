@@ -29,21 +29,27 @@ link_publisher_process=$!
 nohup /var/lib/jobs/$JOB_NAME/sentencer/venv/bin/python3 /var/lib/jobs/$JOB_NAME/sentencer/writer.py &
 sentence_writer_process=$!
 
-# start sentence extractor (2 per box, memory overhead)
-#cpu_count=$(grep -c ^processor /proc/cpuinfo)
-#worker_count=$(( cpu_count / 1 ))
-worker_count=$(( 2 / 1 ))
-extractor_processes=()
-for i in $(seq 1 $worker_count)
-do
-  nohup /var/lib/jobs/$JOB_NAME/sentencer/venv/bin/python3 /var/lib/jobs/$JOB_NAME/sentencer/sentencer.py &
-  extractor_processes+=($!)
-done
-
-# TODO: bad code, remove this - fix should be in reducers where job state is
-# updated
-# wait for all reducers in queue to finish
-sleep 5m
+# start sentence extractor (1 per box, it forks a pool of workers sized to the
+# box, see SENTENCER_POOL_SIZE). With AUTOSCALE=1 the autoscaler runs more of
+# them while the box has cpu and memory to spare
+if [ "$AUTOSCALE" = "1" ]; then
+  nohup /var/lib/jobs/$JOB_NAME/venv/bin/python3 /var/lib/jobs/$JOB_NAME/autoscaler.py /var/lib/jobs/$JOB_NAME/sentencer/venv/bin/python3 /var/lib/jobs/$JOB_NAME/sentencer/sentencer.py &
+  extractor_processes=($!)
+else
+  #cpu_count=$(grep -c ^processor /proc/cpuinfo)
+  #worker_count=$(( cpu_count / 1 ))
+  worker_count=1
+  extractor_processes=()
+  for i in $(seq 1 $worker_count)
+  do
+    nohup /var/lib/jobs/$JOB_NAME/sentencer/venv/bin/python3 /var/lib/jobs/$JOB_NAME/sentencer/sentencer.py &
+    extractor_processes+=($!)
+  done
+fi
+
+# wait until every book has been sentenced and every sentence written, the
+# job progress ledger knows exactly when that is
+/var/lib/jobs/$JOB_NAME/sentencer/venv/bin/python3 /var/lib/jobs/$JOB_NAME/job_ledger.py pre-sentences sentences
 
 # the droplet is no longer needed, droplet makes
 # a DELETE request on itself.
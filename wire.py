@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""How text goes over the wire between publishers, workers and writers.
+
+A message's content_type says how its body is encoded:
+
+    TEXT_CONTENT_TYPE        one string, UTF-8
+    TEXT_BATCH_CONTENT_TYPE  strings, each a 4 byte big endian length and
+                             UTF-8, zstd compressed if content_encoding says so
+    (none)                   a JSON string, the original format
+
+Consumers read all of them, producers write what WIRE_FORMAT says, 'binary'
+(the default) or 'json' for consumers that haven't been updated. Reductions
+have their own binary format, see vocabulary.py.
+"""
+import json
+import os
+import pika
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TEXT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+TEXT_BATCH_CONTENT_TYPE = 'application/x-text-batch; v=1'
+WIRE_BATCH_SIZE = int(os.environ.get('WIRE_BATCH_SIZE', 1000))
+WIRE_COMPRESS_MIN = int(os.environ.get('WIRE_COMPRESS_MIN', 4096)) # bytes
+WIRE_FORMAT = os.environ.get('WIRE_FORMAT', 'binary')
+LENGTH = struct.Struct('!I')
+
+
+def encode_text(text, headers=None):
+    """Returns (body, properties) for a message holding one string"""
+    if WIRE_FORMAT == 'json':
+        return json.dumps(text), pika.BasicProperties(headers=headers)
+    return text.encode('utf_8'), pika.BasicProperties(
+            content_type=TEXT_CONTENT_TYPE, headers=headers)
+
+def decode_text(properties, body):
+    if properties.content_type == TEXT_CONTENT_TYPE:
+        return body.decode('utf_8')
+    return json.loads(body.decode('utf_8'))
+
+def encode_text_batch(texts, headers=None):
+    """Returns (body, properties) for a message holding a list of strings"""
+    parts = []
+    for text in texts:
+        data = text.encode('utf_8')
+        parts.append(LENGTH.pack(len(data)))
+        parts.append(data)
+    body = b''.join(parts)
+    encoding = None
+    if zstandard is not None and len(body) >= WIRE_COMPRESS_MIN:
+        body = zstandard.ZstdCompressor().compress(body)
+        encoding = 'zstd'
+    return body, pika.BasicProperties(content_type=TEXT_BATCH_CONTENT_TYPE,
+            content_encoding=encoding, headers=headers)
+
+def decode_texts(properties, body):
+    """The strings in a message, whichever way it was encoded"""
+    if properties.content_type != TEXT_BATCH_CONTENT_TYPE:
+        return [decode_text(properties, body)]
+    if properties.content_encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compressed batch, zstandard is not installed')
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    texts, offset = [], 0
+    while offset < len(body):
+        length, = LENGTH.unpack_from(body, offset)
+        offset += LENGTH.size
+        texts.append(body[offset:offset + length].decode('utf_8'))
+        offset += length
+    return texts
+
+def is_batch(properties):
+    return properties.content_type == TEXT_BATCH_CONTENT_TYPE
+
+def batches(texts):
+    """Split texts into (start, texts) batches of at most WIRE_BATCH_SIZE, or
+    single texts when WIRE_FORMAT is json"""
+    size = 1 if WIRE_FORMAT == 'json' else WIRE_BATCH_SIZE
+    for start in range(0, len(texts), size):
+        yield start, texts[start:start + size]